@@ -13,21 +13,53 @@ import time
 import zipfile
 import base64
 from selenium.webdriver.common.keys import Keys
+import argparse
+import heapq
+import random
+import threading
+import multiprocessing
+import queue
+from collections import deque, OrderedDict
+import csv
+import sqlite3
+import itertools
+import hashlib
+import contextlib
+import abc
+import io
+import asyncio
+import sys
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import socket
+from selenium.common.exceptions import WebDriverException
+
+try:
+    import aiohttp  # Không bắt buộc: có aiohttp thì AsyncPikbestResolver gửi HTTP bất đồng bộ thật sự
+except ImportError:
+    aiohttp = None
 
 # Tải biến môi trường từ file .env
 load_dotenv()
 
-# Thiết lập logging
-logging.basicConfig(
-    level=logging.INFO, 
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("pikbest_extractor.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def setup_logging(log_file="pikbest_extractor.log"):
+    """Thiết lập logging ra file và console khi chạy như công cụ dòng lệnh
+    
+    Không gọi lúc import để ứng dụng nhúng PikbestResolver tự cấu hình logging của mình.
+    """
+    logging.basicConfig(
+        level=logging.INFO, 
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
+
 # Khởi tạo cookies từ biến môi trường
 def load_cookies_from_env():
     cookies_str = os.getenv('PIKBEST_COOKIES')
@@ -57,8 +89,409 @@ headers = {
     "Referer": "https://www.pikbest.com/",
 }
 
-def setup_chrome_with_extension():
-    """Thiết lập Chrome với extension giải captcha và ngăn tải xuống tự động"""
+# Resolver đang hoạt động trên luồng hiện tại (PikbestResolver.activate); không có thì dùng cấu hình của module
+_resolver_state = threading.local()
+
+def current_resolver():
+    """PikbestResolver đang hoạt động trên luồng hiện tại (None nếu dùng cấu hình chung của module)"""
+    return getattr(_resolver_state, 'resolver', None)
+
+def get_http_session():
+    """Session HTTP của resolver đang hoạt động, hoặc session chung của module"""
+    resolver = current_resolver()
+    return resolver.session if resolver is not None else session
+
+def get_http_headers():
+    """Headers HTTP của resolver đang hoạt động, hoặc headers chung của module"""
+    resolver = current_resolver()
+    return resolver.headers if resolver is not None else headers
+
+def get_pikbest_cookies():
+    """Cookies đăng nhập của resolver đang hoạt động, hoặc cookies đọc từ .env"""
+    resolver = current_resolver()
+    return resolver.cookies if resolver is not None else PIKBEST_COOKIES
+
+def get_captcha_api_key():
+    """API key giải captcha của resolver đang hoạt động, hoặc key đọc từ .env"""
+    resolver = current_resolver()
+    return resolver.captcha_api_key if resolver is not None else CAPTCHA_API_KEY
+
+def get_failure_cache():
+    """Cache lỗi của resolver đang hoạt động, hoặc cache chung của module"""
+    resolver = current_resolver()
+    return resolver.failure_cache if resolver is not None and resolver.failure_cache is not None else failure_cache
+
+def get_clock():
+    """Đồng hồ (time/sleep) của resolver đang hoạt động, hoặc module time (đồng hồ ảo khi phát lại)"""
+    resolver = current_resolver()
+    return resolver.clock if resolver is not None and resolver.clock is not None else time
+
+def debug_dumps_enabled():
+    """Có lưu screenshot và source HTML để debug không (tắt khi phát lại để không ghi đè bản ghi đầu vào)"""
+    resolver = current_resolver()
+    return resolver.debug_dumps if resolver is not None else True
+
+# Hạn chót xử lý của URL hiện tại, riêng cho từng luồng
+_deadline_state = threading.local()
+
+class DeadlineExceeded(TimeoutError):
+    """Đã hết thời gian xử lý cho phép của URL hiện tại"""
+
+def get_url_deadline_seconds():
+    """Thời gian xử lý tối đa của một URL: url_deadline của resolver đang hoạt động, hoặc URL_DEADLINE (0 = không giới hạn)"""
+    resolver = current_resolver()
+    if resolver is not None and resolver.url_deadline is not None:
+        return resolver.url_deadline
+    return float(os.getenv('URL_DEADLINE', '90'))
+
+@contextlib.contextmanager
+def url_deadline(seconds=None):
+    """Đặt hạn chót cho việc xử lý một URL; các bước con (đợi trang, captcha, HTTP) đều không chờ quá hạn này
+    
+    seconds mặc định lấy từ get_url_deadline_seconds(), nên các bước bên trong một resolver dùng đúng
+    url_deadline của resolver đó. Nếu đã có hạn chót bên ngoài thì dùng hạn sớm hơn.
+    """
+    if seconds is None:
+        seconds = get_url_deadline_seconds()
+    previous = getattr(_deadline_state, 'deadline', None)
+    deadline = previous
+    if seconds and seconds > 0:
+        deadline = get_clock().time() + seconds
+        if previous is not None:
+            deadline = min(previous, deadline)
+    _deadline_state.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _deadline_state.deadline = previous
+
+def deadline_remaining():
+    """Số giây còn lại đến hạn chót của URL hiện tại (None nếu không có hạn chót)"""
+    deadline = getattr(_deadline_state, 'deadline', None)
+    return None if deadline is None else deadline - get_clock().time()
+
+def deadline_expired():
+    """URL hiện tại đã hết thời gian xử lý chưa"""
+    remaining = deadline_remaining()
+    return remaining is not None and remaining <= 0
+
+def bounded_timeout(timeout):
+    """Thời gian chờ của một bước con, không vượt quá thời gian còn lại đến hạn chót"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return timeout
+    return max(0, min(timeout, remaining))
+
+def http_timeout(timeout):
+    """Timeout cho request HTTP trong hạn chót; raise DeadlineExceeded nếu đã hết hạn"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded("Đã hết thời gian xử lý URL")
+    return min(timeout, remaining)
+
+class PhaseProfiler:
+    """Đo thời gian và chênh lệch bộ nhớ (tracemalloc) của từng giai đoạn xử lý khi chạy với --profile
+    
+    Mọi giai đoạn đo chênh lệch tổng bộ nhớ bằng tracemalloc.get_traced_memory() (rẻ). Chỉ giai đoạn
+    ngoài cùng trên mỗi luồng mới chụp snapshot trước và sau để cộng dồn chênh lệch theo dòng code,
+    vì snapshot tốn kém và chụp ở mọi giai đoạn lồng nhau sẽ làm chậm và nhiễu số liệu cProfile.
+    Bộ nhớ của tracemalloc tính cho cả tiến trình nên khi nhiều luồng chạy song song, số liệu của một
+    giai đoạn gồm cả cấp phát của luồng khác và chỉ mang tính xấp xỉ. Khi không bật thì chỉ tốn một phép kiểm tra.
+    """
+    
+    def __init__(self, top=15):
+        self.enabled = False
+        self.top = top
+        # tên -> {'calls', 'seconds', 'memory': tổng chênh lệch byte, 'lines': {dòng code: [size_diff, count_diff]}}
+        self.phases = {}
+        self._lock = threading.Lock()
+        self._depth = threading.local()  # số giai đoạn đang mở trên luồng hiện tại
+    
+    def _snapshot(self):
+        # Bỏ các cấp phát của chính tracemalloc để không làm nhiễu kết quả
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Đo một giai đoạn (các giai đoạn lồng nhau được tính cả vào giai đoạn bên ngoài)"""
+        if not self.enabled or not tracemalloc.is_tracing():
+            yield
+            return
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+        before = self._snapshot() if depth == 0 else None
+        memory_before = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            memory_diff = tracemalloc.get_traced_memory()[0] - memory_before
+            diff = self._snapshot().compare_to(before, 'lineno') if before is not None else ()
+            self._depth.value = depth
+            with self._lock:
+                phase = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'memory': 0, 'lines': {}})
+                phase['calls'] += 1
+                phase['seconds'] += seconds
+                phase['memory'] += memory_diff
+                for stat in diff:
+                    if not stat.size_diff and not stat.count_diff:
+                        continue
+                    frame = stat.traceback[0]
+                    totals = phase['lines'].setdefault(f"{frame.filename}:{frame.lineno}", [0, 0])
+                    totals[0] += stat.size_diff
+                    totals[1] += stat.count_diff
+    
+    def report(self):
+        """Báo cáo dạng văn bản: thời gian và các dòng code cấp phát nhiều nhất của từng giai đoạn
+        
+        Dòng code chỉ có ở giai đoạn từng chạy ngoài cùng; số liệu bộ nhớ là xấp xỉ khi nhiều luồng chạy song song.
+        """
+        lines = ["# Bộ nhớ tính cho cả tiến trình: xấp xỉ khi nhiều luồng xử lý song song", ""]
+        with self._lock:
+            for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]['seconds']):
+                lines.append(f"== {name}: {phase['calls']} lần, {phase['seconds']:.3f} giây, "
+                             f"bộ nhớ còn giữ {phase['memory'] / 1024:+.1f} KiB ==")
+                ranked = sorted(phase['lines'].items(), key=lambda item: -abs(item[1][0]))
+                for location, (size, count) in ranked[:self.top]:
+                    lines.append(f"  {size / 1024:+10.1f} KiB {count:+7d} khối  {location}")
+                lines.append("")
+        return "\n".join(lines)
+
+phase_profiler = PhaseProfiler()
+
+def profile_phase(name):
+    """Decorator đánh dấu một hàm là một giai đoạn được đo bộ nhớ khi chạy với --profile"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not phase_profiler.enabled:
+                return func(*args, **kwargs)
+            with phase_profiler.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def pstats_to_collapsed(stats, min_microseconds=1):
+    """Chuyển kết quả cProfile (pstats.Stats) thành các dòng collapsed stack "a;b;c <micro giây>"
+    
+    Dùng được với flamegraph.pl, speedscope hoặc inferno. cProfile chỉ lưu cặp hàm gọi -> hàm được gọi,
+    nên stack được dựng lại bằng cách chia thời gian của mỗi hàm theo tỉ lệ thời gian từng hàm gọi nó (xấp xỉ).
+    """
+    entries = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((func, caller_stats[3]))
+    
+    def label(func):
+        filename, line, name = func
+        if filename == '~':
+            return name  # Hàm built-in
+        return f"{name} ({os.path.basename(filename)}:{line})"
+    
+    stacks = {}
+    
+    def walk(func, stack, on_stack, scale):
+        _, _, own_time, _, _ = entries[func]
+        stack = stack + [label(func)]
+        microseconds = own_time * scale * 1e6
+        if microseconds >= min_microseconds:
+            key = ";".join(stack)
+            stacks[key] = stacks.get(key, 0) + microseconds
+        for callee, edge_time in callees.get(func, ()):
+            callee_time = entries[callee][3]
+            # Bỏ đệ quy và các nhánh quá nhỏ để số stack không tăng theo cấp số nhân
+            if callee in on_stack or callee_time <= 0 or edge_time * scale * 1e6 < min_microseconds:
+                continue
+            on_stack.add(callee)
+            walk(callee, stack, on_stack, scale * min(1.0, edge_time / callee_time))
+            on_stack.discard(callee)
+    
+    for func, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(func, [], {func}, 1.0)
+    return [f"{stack} {int(round(value))}" for stack, value in sorted(stacks.items()) if round(value) > 0]
+
+def run_with_profiling(func, output_dir="pikbest_profile"):
+    """Chạy func dưới cProfile (mọi luồng) và tracemalloc, ghi kết quả vào output_dir
+    
+    Ghi ra: profile.pstats (mở bằng pstats/snakeviz), profile.collapsed (flame graph),
+    profile_top.txt (các hàm tốn thời gian nhất) và memory_phases.txt (chênh lệch bộ nhớ theo giai đoạn).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    profilers = []
+    profilers_lock = threading.Lock()
+    
+    def profile_new_thread(frame, event, arg):
+        # Chạy một lần ở sự kiện đầu tiên của luồng mới, thay bằng cProfile riêng cho luồng đó
+        profiler = cProfile.Profile()
+        with profilers_lock:
+            profilers.append(profiler)
+        profiler.enable()
+    
+    tracemalloc.start()
+    phase_profiler.enabled = True
+    main_profiler = cProfile.Profile()
+    profilers.append(main_profiler)
+    threading.setprofile(profile_new_thread)
+    print(f"🔬 Đang chạy với --profile, kết quả sẽ được ghi vào {output_dir}")
+    main_profiler.enable()
+    try:
+        return func()
+    finally:
+        main_profiler.disable()
+        threading.setprofile(None)
+        phase_profiler.enabled = False
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        with profilers_lock:
+            stats = None
+            for profiler in profilers:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profiler)
+                    else:
+                        stats.add(profiler)
+                except TypeError:
+                    continue  # Luồng chưa ghi nhận lời gọi nào
+        if stats is None:
+            print("⚠️ Không có dữ liệu profile")
+        else:
+            stats.dump_stats(os.path.join(output_dir, "profile.pstats"))
+            with open(os.path.join(output_dir, "profile.collapsed"), "w", encoding="utf-8") as f:
+                f.write("\n".join(pstats_to_collapsed(stats)) + "\n")
+            with open(os.path.join(output_dir, "profile_top.txt"), "w", encoding="utf-8") as f:
+                stats.stream = f
+                stats.sort_stats('cumulative').print_stats(60)
+                stats.sort_stats('tottime').print_stats(60)
+        with open(os.path.join(output_dir, "memory_phases.txt"), "w", encoding="utf-8") as f:
+            f.write(f"Bộ nhớ Python: hiện tại {current / 1024 / 1024:.1f} MiB, đỉnh {peak / 1024 / 1024:.1f} MiB\n\n")
+            f.write(phase_profiler.report())
+        print(f"🔬 Đã ghi kết quả profile vào {output_dir} "
+              "(profile.collapsed cho flame graph, memory_phases.txt cho bộ nhớ theo giai đoạn)")
+
+# Các nhóm mẫu URL bị chặn khi tải trang (Network.setBlockedURLs, dấu * là ký tự đại diện).
+# Mẫu chỉ bắt đầu bằng http nên không ảnh hưởng đến tài nguyên chrome-extension:// của extension giải captcha.
+# Mỗi nhóm chỉ nhắm vào host/thư mục cụ thể: ảnh giao diện của Pikbest (không bao giờ là file tải, xem
+# DOWNLOAD_URL_BLACKLIST), font và video của Pikbest; không dùng mẫu chung kiểu *.woff* vì sẽ chặn cả captcha.
+RESOURCE_BLOCK_PATTERNS = {
+    'images': [
+        f"http*://{folder}*.{ext}*"
+        for folder in ("*pikbest.com/images/", "*pikbest.com/static/", "js.pikbest.com/best/images/")
+        for ext in ("jpg", "jpeg", "png", "gif", "webp", "svg", "ico")
+    ],
+    'fonts': [
+        "http*://*pikbest.com/*.woff*", "http*://*pikbest.com/*.ttf*", "http*://*pikbest.com/*.otf*",
+        "http*://*pikbest.com/*.eot*",
+    ],
+    'css': ["http*://*pikbest.com/*.css*"],
+    'media': [
+        "http*://*pikbest.com/*.mp4*", "http*://*pikbest.com/*.webm*", "http*://*pikbest.com/*.mp3*",
+        "http*://*pikbest.com/*.m3u8*",
+    ],
+    'ads': [
+        "*doubleclick.net*", "*googlesyndication.com*", "*googleadservices.com*", "*adservice.google.*",
+        "*amazon-adsystem.com*", "*adnxs.com*", "*criteo.*", "*taboola.com*", "*outbrain.com*",
+    ],
+    'analytics': [
+        "*google-analytics.com*", "*googletagmanager.com*", "*analytics.google.com*", "*connect.facebook.net*",
+        "*facebook.com/tr*", "*hotjar.com*", "*clarity.ms*", "*bat.bing.com*", "*hm.baidu.com*",
+        "*cnzz.com*", "*tiktok.com/i18n/pixel*", "*static.ads-twitter.com*",
+    ],
+}
+
+# Host luôn được phép tải: các dịch vụ captcha (kể cả font, ảnh, âm thanh của chúng) và script của Pikbest
+RESOURCE_BLOCK_ALLOWLIST = [
+    "www.google.com/recaptcha", "www.recaptcha.net", "www.gstatic.com", "fonts.gstatic.com", "fonts.googleapis.com",
+    "js.hcaptcha.com", "hcaptcha.com", "newassets.hcaptcha.com", "imgs.hcaptcha.com", "challenges.cloudflare.com",
+    "api.captchasonic.com", "static.geetest.com", "api.geetest.com", "client-api.arkoselabs.com",
+]
+
+# Script của Pikbest (trang download cần chúng để hiện nút tải và gọi Ajax)
+PIKBEST_SCRIPT_PROBES = [
+    "https://js.pikbest.com/best/js/download.js?v=1", "https://pikbest.com/static/js/download.js?v=1",
+    "https://js.pikbest.com/static/js/download.js?v=1",
+]
+
+# URL mẫu của link tải (các cách tìm link qua performance entries/XHR cần chúng không bị chặn)
+DOWNLOAD_URL_PROBES = [
+    "https://pikbest.com/download/file.zip?e=1", "https://dl.pikbest.com/file.png?e=1",
+    "https://cdn.pikbest.com/files/file.jpg?e=1", "https://pikbest.com/file.psd",
+]
+
+def _resource_probe_urls():
+    """URL đại diện cho tài nguyên không được chặn: mọi loại file trên các host được phép, và link tải"""
+    extensions = ('.js', '.css', '.html', '.json', '.woff2', '.ttf', '.png', '.jpg', '.svg', '.gif', '.webp',
+                  '.mp3', '.mp4', '.wav')
+    probes = ["chrome-extension://extension/background.js", "chrome-extension://extension/font.woff2"]
+    for host in RESOURCE_BLOCK_ALLOWLIST:
+        probes.extend(f"https://{host}/asset{ext}?v=1" for ext in extensions)
+    return probes + PIKBEST_SCRIPT_PROBES + DOWNLOAD_URL_PROBES
+
+def blocked_pattern_conflict(pattern, probes=None):
+    """URL được phép đầu tiên mà mẫu chặn (dấu * như Network.setBlockedURLs) sẽ chặn, None nếu không có"""
+    regex = re.compile(".*".join(re.escape(part) for part in pattern.split("*")) + r"\Z", re.I)
+    for url in probes if probes is not None else _resource_probe_urls():
+        if regex.match(url):
+            return url
+    return None
+
+def get_blocked_url_patterns():
+    """Lấy danh sách mẫu URL cần chặn theo cấu hình BLOCK_RESOURCES và BLOCK_URL_PATTERNS"""
+    groups = os.getenv('BLOCK_RESOURCES', 'images,fonts,media,ads,analytics')
+    patterns = []
+    for group in groups.split(','):
+        group = group.strip().lower()
+        if not group or group == 'none':
+            continue
+        if group not in RESOURCE_BLOCK_PATTERNS:
+            logger.warning(f"Không có nhóm tài nguyên chặn tên: {group}")
+            continue
+        patterns.extend(RESOURCE_BLOCK_PATTERNS[group])
+    
+    # Mẫu bổ sung do người dùng cấu hình, phân tách bằng dấu phẩy
+    extra = os.getenv('BLOCK_URL_PATTERNS', '')
+    patterns.extend(p.strip() for p in extra.split(',') if p.strip())
+    
+    # Không bao giờ chặn tài nguyên của extension/dịch vụ captcha, script của Pikbest hoặc link tải:
+    # mẫu nào khớp với một URL đại diện của chúng thì bị bỏ
+    allowed = []
+    probes = _resource_probe_urls()
+    for pattern in patterns:
+        conflict = blocked_pattern_conflict(pattern, probes)
+        if conflict:
+            logger.warning(f"Bỏ qua mẫu chặn {pattern} vì sẽ chặn tài nguyên được phép: {conflict}")
+            continue
+        if pattern not in allowed:
+            allowed.append(pattern)
+    return allowed
+
+def apply_resource_blocking(driver, patterns=None):
+    """Chặn các tài nguyên nặng (ảnh, font, quảng cáo, analytics...) qua CDP Network.setBlockedURLs"""
+    if patterns is None:
+        patterns = get_blocked_url_patterns()
+    if not patterns:
+        logger.debug("Không chặn tài nguyên nào")
+        return False
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': patterns})
+        logger.info(f"Đã chặn {len(patterns)} mẫu URL tài nguyên không cần thiết")
+        return True
+    except Exception as e:
+        logger.warning(f"Không thể thiết lập chặn tài nguyên: {e}")
+        return False
+
+def setup_chrome_with_extension(profile_path=None, configure_extension=True):
+    """Thiết lập Chrome với extension giải captcha và ngăn tải xuống tự động
+    
+    profile_path: thư mục profile riêng cho driver này (mặc định lấy từ CHROME_PROFILE_PATH)
+    configure_extension: False khi profile đã có sẵn API key (ví dụ bản sao của golden profile)
+    """
     options = Options()
     
     logger.info("Bắt đầu thiết lập Chrome với extension")
@@ -67,9 +500,17 @@ def setup_chrome_with_extension():
     options.add_argument("--disable-blink-features=AutomationControlled")
     options.add_experimental_option("excludeSwitches", ["enable-automation"])
     options.add_experimental_option("useAutomationExtension", False)
-    options.add_argument(f"user-agent={headers['User-Agent']}")
+    options.add_argument(f"user-agent={get_http_headers()['User-Agent']}")
     logger.debug("Đã thêm các options chống phát hiện automation")
     
+    # Không đợi sự kiện load của toàn bộ tài nguyên bên thứ ba, dùng tín hiệu sẵn sàng riêng
+    page_load_strategy = os.getenv('PAGE_LOAD_STRATEGY', 'eager').lower()
+    if page_load_strategy in ('normal', 'eager', 'none'):
+        options.page_load_strategy = page_load_strategy
+        logger.info(f"Đã thiết lập page load strategy: {page_load_strategy}")
+    else:
+        logger.warning(f"PAGE_LOAD_STRATEGY không hợp lệ: {page_load_strategy}, dùng mặc định")
+    
     # Thiết lập preferences để ngăn tải xuống tự động
     prefs = {
         "download.default_directory": "/dev/null",  # Đường dẫn không tồn tại
@@ -146,7 +587,7 @@ def setup_chrome_with_extension():
         logger.warning("Không tìm thấy đường dẫn extension trong biến môi trường CAPTCHA_EXTENSION_PATH")
     
     # Tạo thư mục profile nếu cần
-    chrome_profile = os.getenv('CHROME_PROFILE_PATH', '')
+    chrome_profile = profile_path if profile_path is not None else os.getenv('CHROME_PROFILE_PATH', '')
     if chrome_profile:
         try:
             # Chuyển đổi đường dẫn tương đối thành tuyệt đối
@@ -172,6 +613,11 @@ def setup_chrome_with_extension():
     else:
         logger.debug("Không sử dụng profile Chrome (không tìm thấy CHROME_PROFILE_PATH)")
     
+    # Không giảm tốc các tab chạy nền (cần cho chế độ nhiều tab)
+    options.add_argument("--disable-background-timer-throttling")
+    options.add_argument("--disable-backgrounding-occluded-windows")
+    options.add_argument("--disable-renderer-backgrounding")
+    
     # Thêm các options để debug extension
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
@@ -209,9 +655,12 @@ def setup_chrome_with_extension():
         """)
         
         # Cấu hình API key cho extension CaptchaSonic
-        if CAPTCHA_API_KEY:
+        if get_captcha_api_key() and configure_extension:
             configure_captcha_extension(driver)
         
+        # Chặn các tài nguyên nặng không cần thiết cho việc lấy link
+        apply_resource_blocking(driver)
+        
         return driver
     except Exception as e:
         logger.error(f"Lỗi khi khởi tạo trình duyệt Chrome: {e}")
@@ -262,6 +711,109 @@ def create_temp_crx_from_folder(folder_path):
         logger.error(f"Lỗi khi tạo file .crx tạm thời: {e}", exc_info=True)
         return None
 
+# Script bắt XHR trong trang: chỉ giữ request liên quan đến tải file, chỉ lưu response của AjaxDownload
+# và giới hạn số mục (ring buffer) để mỗi lần đọc qua WebDriver không phải truyền cả mảng lớn
+NETWORK_CAPTURE_SCRIPT = """
+    var maxEntries = arguments[0] || 50;
+    var downloadExts = ['.zip', '.psd', '.ai', '.jpg', '.png', '.pdf', '.eps', '.rar'];
+    
+    function boundedPush() {
+        Array.prototype.push.apply(this, arguments);
+        while (this.length > maxEntries) this.shift();
+        return this.length;
+    }
+    
+    window.ajaxRequests = [];
+    window.ajaxRequests.push = boundedPush;
+    window.downloadLinks = [];
+    window.downloadLinks.push = boundedPush;
+    window.__captureSeq = 0;
+    
+    function isDownloadUrl(url) {
+        for (var i = 0; i < downloadExts.length; i++) {
+            if (url.indexOf(downloadExts[i]) !== -1) return true;
+        }
+        return false;
+    }
+    
+    if (window.__networkCaptureInstalled) return;
+    window.__networkCaptureInstalled = true;
+    
+    // Bắt XHR requests
+    var originalXHROpen = XMLHttpRequest.prototype.open;
+    var originalXHRSend = XMLHttpRequest.prototype.send;
+    
+    XMLHttpRequest.prototype.open = function(method, url) {
+        this._url = url;
+        this._method = method;
+        originalXHROpen.apply(this, arguments);
+    };
+    
+    XMLHttpRequest.prototype.send = function() {
+        var xhr = this;
+        this.addEventListener('load', function() {
+            try {
+                var url = String(xhr._url || xhr.responseURL || '');
+                var isAjaxDownload = url.indexOf('AjaxDownload') !== -1 && url.indexOf('a=open') !== -1;
+                if (!url || !(isAjaxDownload || isDownloadUrl(url))) return;
+                
+                window.__captureSeq += 1;
+                window.ajaxRequests.push({
+                    seq: window.__captureSeq,
+                    url: url,
+                    method: xhr._method,
+                    status: xhr.status,
+                    response: isAjaxDownload ? xhr.responseText : null
+                });
+                
+                // Kiểm tra nếu là Ajax download request
+                if (isAjaxDownload) {
+                    try {
+                        var jsonResponse = JSON.parse(xhr.responseText);
+                        if (jsonResponse && jsonResponse.url) {
+                            window.downloadLinks.push(jsonResponse.url);
+                        }
+                    } catch (e) {
+                        console.error('Error parsing JSON:', e);
+                    }
+                } else if (url.indexOf('logo') === -1 && url.indexOf('icon') === -1 &&
+                           url.indexOf('favicon') === -1 && url.indexOf('avatar') === -1) {
+                    window.downloadLinks.push(url);
+                }
+            } catch (e) {
+                console.error('Error in XHR tracking:', e);
+            }
+        });
+        originalXHRSend.apply(this, arguments);
+    };
+"""
+
+def install_network_capture(driver, max_entries=None):
+    """Cài script bắt XHR có lọc và giới hạn số mục vào trang hiện tại"""
+    if max_entries is None:
+        max_entries = int(os.getenv('CAPTURE_MAX_ENTRIES', '50'))
+    driver.execute_script(NETWORK_CAPTURE_SCRIPT, max_entries)
+
+@profile_phase('ajax_requests')
+def read_captured_requests(driver, cursor=None):
+    """Đọc các request đã bắt được; nếu có cursor thì chỉ đọc các mục mới kể từ lần đọc trước"""
+    since = cursor['seq'] if cursor else 0
+    entries = driver.execute_script("""
+        var since = arguments[0];
+        return (window.ajaxRequests || []).filter(function(r) { return r.seq > since; });
+    """, since) or []
+    if cursor is not None and entries:
+        cursor['seq'] = max((entry.get('seq', 0) for entry in entries if isinstance(entry, dict)), default=since)
+    return entries
+
+# Số trang có captcha mà luồng hiện tại đã gặp, dùng để thống kê tỉ lệ captcha của batch
+_captcha_state = threading.local()
+
+def captcha_encounters():
+    """Tổng số lần luồng hiện tại gặp captcha (so sánh trước/sau khi xử lý một URL)"""
+    return getattr(_captcha_state, 'count', 0)
+
+@profile_phase('captcha')
 def handle_captcha(driver):
     """Xử lý captcha nếu xuất hiện"""
     logger.info("Đang kiểm tra và xử lý captcha...")
@@ -270,27 +822,32 @@ def handle_captcha(driver):
         captcha_frames = driver.find_elements(By.XPATH, "//iframe[contains(@src, 'captcha') or contains(@title, 'captcha')]")
         if captcha_frames:
             logger.info(f"Phát hiện captcha, đang cố gắng giải... (tìm thấy {len(captcha_frames)} frames)")
+            _captcha_state.count = captcha_encounters() + 1
             
-            # Lưu screenshot để debug
+            # Lưu screenshot và source HTML để debug
             screenshot_path = "captcha_detected.png"
-            driver.save_screenshot(screenshot_path)
-            logger.info(f"Đã lưu screenshot tại: {screenshot_path}")
-            
-            # Lưu source HTML để debug
-            with open("captcha_page.html", "w", encoding="utf-8") as f:
-                f.write(driver.page_source)
-            logger.debug("Đã lưu source HTML tại: captcha_page.html")
+            if debug_dumps_enabled():
+                driver.save_screenshot(screenshot_path)
+                logger.info(f"Đã lưu screenshot tại: {screenshot_path}")
+                with open("captcha_page.html", "w", encoding="utf-8") as f:
+                    f.write(driver.page_source)
+                logger.debug("Đã lưu source HTML tại: captcha_page.html")
             
             # Kiểm tra xem extension có hoạt động không
-            if CAPTCHA_API_KEY:
-                logger.info(f"Tìm thấy CAPTCHA_API_KEY: {CAPTCHA_API_KEY[:5]}...")
+            if get_captcha_api_key():
+                logger.info(f"Tìm thấy CAPTCHA_API_KEY: {get_captcha_api_key()[:5]}...")
                 
-                # Đợi extension giải captcha (thời gian tùy thuộc vào extension)
+                # Đợi extension giải captcha (tối đa 15 giây, không quá hạn chót của URL)
                 logger.info("Đang đợi extension giải captcha...")
-                time.sleep(15)  # Đợi extension giải captcha
+                clock = get_clock()
+                wait_until = clock.time() + bounded_timeout(15)
+                while True:
+                    clock.sleep(max(0, min(1, wait_until - clock.time())))
+                    captcha_frames = driver.find_elements(By.XPATH, "//iframe[contains(@src, 'captcha') or contains(@title, 'captcha')]")
+                    if not captcha_frames or clock.time() >= wait_until:
+                        break
                 
                 # Kiểm tra xem captcha đã được giải chưa
-                captcha_frames = driver.find_elements(By.XPATH, "//iframe[contains(@src, 'captcha') or contains(@title, 'captcha')]")
                 if not captcha_frames:
                     logger.info("Captcha đã được giải thành công!")
                     return True
@@ -301,10 +858,24 @@ def handle_captcha(driver):
             
             # Nếu extension không hoạt động, thông báo cho người dùng
             print("\n⚠️ Phát hiện captcha! Vui lòng giải captcha thủ công.")
-            print(f"Đã lưu screenshot tại: {screenshot_path}")
+            if debug_dumps_enabled():
+                print(f"Đã lưu screenshot tại: {screenshot_path}")
             
             # Nếu không chạy headless, đợi người dùng giải captcha
-            if os.getenv('RUN_HEADLESS', 'false').lower() != 'true':
+            remaining = deadline_remaining()
+            if os.getenv('RUN_HEADLESS', 'false').lower() != 'true' and remaining is not None:
+                # Có hạn chót cho URL thì không dùng input() (không có giới hạn thời gian) mà đợi captcha biến mất
+                print(f"⏳ Đang đợi giải captcha trong trình duyệt (tối đa {max(0, remaining):.0f} giây)...")
+                clock = get_clock()
+                while not deadline_expired():
+                    clock.sleep(max(0, min(1, deadline_remaining())))
+                    captcha_frames = driver.find_elements(By.XPATH, "//iframe[contains(@src, 'captcha') or contains(@title, 'captcha')]")
+                    if not captcha_frames:
+                        logger.info("Captcha đã được giải thủ công!")
+                        return True
+                logger.error("Hết thời gian xử lý URL khi đang đợi giải captcha thủ công")
+                return False
+            elif os.getenv('RUN_HEADLESS', 'false').lower() != 'true':
                 input("Nhấn Enter sau khi đã giải captcha...")
                 logger.info("Người dùng đã xác nhận giải captcha")
                 
@@ -344,7 +915,7 @@ def get_real_download_link(file_id):
         # Thêm cookies vào trình duyệt
         driver.get("https://pikbest.com")
         logger.info("Đang thêm cookies vào trình duyệt...")
-        for name, value in PIKBEST_COOKIES.items():
+        for name, value in get_pikbest_cookies().items():
             driver.add_cookie({"name": name, "value": value})
         
         # Truy cập trang chính để xác nhận đăng nhập
@@ -379,67 +950,8 @@ def get_real_download_link(file_id):
         logger.info("Đã lưu source HTML tại: page_source.html")
         
         # Thêm script để bắt Ajax requests
-        driver.execute_script("""
-            window.ajaxRequests = [];
-            window.downloadLinks = [];
-            
-            // Bắt XHR requests
-            var originalXHROpen = XMLHttpRequest.prototype.open;
-            var originalXHRSend = XMLHttpRequest.prototype.send;
-            
-            XMLHttpRequest.prototype.open = function(method, url) {
-                this._url = url;
-                this._method = method;
-                originalXHROpen.apply(this, arguments);
-            };
-            
-            XMLHttpRequest.prototype.send = function() {
-                var xhr = this;
-                this.addEventListener('load', function() {
-                    try {
-                        var url = xhr._url || xhr.responseURL;
-                        if (url) {
-                            window.ajaxRequests.push({
-                                url: url,
-                                method: xhr._method,
-                                status: xhr.status,
-                                response: xhr.responseText
-                            });
-                            
-                            // Kiểm tra nếu là Ajax download request
-                            if (url.includes('AjaxDownload') && url.includes('a=open')) {
-                                console.log('Detected AjaxDownload request:', url);
-                                console.log('Response:', xhr.responseText);
-                                
-                                // Thử parse JSON response
-                                try {
-                                    var jsonResponse = JSON.parse(xhr.responseText);
-                                    if (jsonResponse && jsonResponse.url) {
-                                        window.downloadLinks.push(jsonResponse.url);
-                                    }
-                                } catch (e) {
-                                    console.error('Error parsing JSON:', e);
-                                }
-                            }
-                            
-                            // Kiểm tra các URL tải
-                            if (url && (url.includes('.zip') || url.includes('.psd') || 
-                                       url.includes('.ai') || url.includes('.jpg') || 
-                                       url.includes('.png') || url.includes('.pdf') || 
-                                       url.includes('.eps') || url.includes('.rar'))) {
-                                if (!url.includes('logo') && !url.includes('icon') && 
-                                    !url.includes('favicon') && !url.includes('avatar')) {
-                                    window.downloadLinks.push(url);
-                                }
-                            }
-                        }
-                    } catch (e) {
-                        console.error('Error in XHR tracking:', e);
-                    }
-                });
-                originalXHRSend.apply(this, arguments);
-            };
-        """)
+        install_network_capture(driver)
+        capture_cursor = {'seq': 0}
         
         # Phương pháp 1: Tìm và click nút "Click here" trực tiếp
         logger.info("Đang tìm nút 'Click here'...")
@@ -475,7 +987,7 @@ def get_real_download_link(file_id):
                     return None
                 
                 # Kiểm tra Ajax requests
-                ajax_requests = driver.execute_script("return window.ajaxRequests;")
+                ajax_requests = read_captured_requests(driver, capture_cursor)
                 if ajax_requests:
                     logger.info(f"Tìm thấy {len(ajax_requests)} Ajax requests")
                     
@@ -508,7 +1020,7 @@ def get_real_download_link(file_id):
                                 # Nếu không tìm thấy URL trong response, thử gọi trực tiếp Ajax request
                                 try:
                                     logger.info(f"Đang gọi trực tiếp Ajax request: {url}")
-                                    ajax_response = session.get(url, headers=headers)
+                                    ajax_response = get_http_session().get(url, headers=get_http_headers(), timeout=http_timeout(15))
                                     if ajax_response.status_code == 200:
                                         try:
                                             ajax_data = ajax_response.json()
@@ -541,9 +1053,8 @@ def get_real_download_link(file_id):
                     page_source = driver.page_source
                     
                     # Tìm hash trong HTML
-                    hash_match = re.search(r'__hash__=([a-f0-9_]+)', page_source)
-                    if hash_match:
-                        hash_value = hash_match.group(1)
+                    hash_value = scan_download_page(page_source)['hash']
+                    if hash_value:
                         logger.info(f"Tìm thấy hash: {hash_value}")
                         
                         # Tạo Ajax URL
@@ -551,7 +1062,7 @@ def get_real_download_link(file_id):
                         logger.info(f"Đang gọi Ajax URL: {ajax_url}")
                         
                         # Gọi Ajax URL
-                        ajax_response = session.get(ajax_url, headers=headers)
+                        ajax_response = get_http_session().get(ajax_url, headers=get_http_headers(), timeout=http_timeout(15))
                         if ajax_response.status_code == 200:
                             try:
                                 ajax_data = ajax_response.json()
@@ -575,35 +1086,26 @@ def get_real_download_link(file_id):
         # Phương pháp 2: Tìm trong HTML và JavaScript
         logger.info("Đang tìm trong HTML và JavaScript...")
         try:
-            # Tìm tất cả các script tags
-            scripts = driver.find_elements(By.TAG_NAME, "script")
-            for script in scripts:
-                try:
-                    script_content = script.get_attribute("innerHTML")
-                    if script_content:
-                        # Tìm URL trong script
-                        url_matches = re.findall(r'(https?://[^"\'\s]+\.(?:zip|psd|ai|jpg|png|pdf|eps|rar)[^"\'\s]*)', script_content)
-                        for url in url_matches:
-                            if "pikbest" in url and is_valid_download_file(url):
-                                logger.info(f"Tìm thấy link tải trong JavaScript: {url}")
-                                return url
-                except Exception as e:
-                    logger.error(f"Lỗi khi phân tích script: {e}")
-                    continue
+            # Quét toàn bộ HTML một lần thay vì đọc innerHTML của từng thẻ script qua driver
+            for url in scan_download_page(driver.page_source)['urls']:
+                if "pikbest" in url and is_valid_download_file(url):
+                    logger.info(f"Tìm thấy link tải trong HTML/JavaScript: {url}")
+                    return url
         except Exception as e:
             logger.error(f"Lỗi khi tìm trong JavaScript: {e}")
         
         # Phương pháp 3: Phân tích network requests
         logger.info("Đang phân tích network requests...")
         try:
-            # Lấy tất cả network requests
-            all_requests = driver.execute_script("return window.ajaxRequests;")
+            # Lấy các network request đã bắt được
+            all_requests = read_captured_requests(driver)
             if all_requests:
                 logger.info(f"Tìm thấy {len(all_requests)} requests")
                 
                 # Lọc các URL có thể là link tải
                 download_candidates = []
-                for url in all_requests:
+                for req in all_requests:
+                    url = req.get('url') if isinstance(req, dict) else req
                     if isinstance(url, str) and "pikbest" in url:
                         if is_valid_download_file(url):
                             download_candidates.append(url)
@@ -645,39 +1147,56 @@ def get_real_download_link(file_id):
 
     return None
 
-def is_valid_download_file(url):
-    """Kiểm tra xem URL có phải là file tải hợp lệ không (loại trừ logo, icon, v.v.)"""
+# Các URL cần loại trừ khi tìm link tải
+DOWNLOAD_URL_BLACKLIST = [
+    "js.pikbest.com/best/images/personal/designer-prize.png",
+    "pikbest.com/best/images/personal",
+    "pikbest.com/images/",
+    "pikbest.com/static/"
+]
+
+DOWNLOAD_URL_EXTENSION_PATTERN = re.compile(r'\.(zip|psd|ai|jpg|png|pdf|eps|rar)(\?|$)')
+DOWNLOAD_URL_EXCLUDED_KEYWORDS = ['logo', 'icon', 'favicon', 'avatar', 'prize', 'personal']
+
+def download_url_rejection(url):
+    """Kiểm tra offline (không gửi request) URL có thể là file tải không
+    
+    Trả về lý do loại ('blacklist', 'extension', 'keyword') hoặc None nếu URL hợp lệ.
+    """
+    for item in DOWNLOAD_URL_BLACKLIST:
+        if item in url:
+            return 'blacklist'
+    lowered = url.lower()
+    if not DOWNLOAD_URL_EXTENSION_PATTERN.search(lowered):
+        return 'extension'
+    if any(keyword in lowered for keyword in DOWNLOAD_URL_EXCLUDED_KEYWORDS):
+        return 'keyword'
+    return None
+
+def is_valid_download_file(url, response_headers=None):
+    """Kiểm tra xem URL có phải là file tải hợp lệ không (loại trừ logo, icon, v.v.)
+    
+    response_headers: header HEAD của URL nếu đã lấy sẵn (ví dụ qua HTTP bất đồng bộ), để không phải gửi lại
+    """
     if not url:
         return False
-        
-    # Danh sách các URL cần loại trừ
-    blacklist = [
-        "js.pikbest.com/best/images/personal/designer-prize.png",
-        "pikbest.com/best/images/personal",
-        "pikbest.com/images/",
-        "pikbest.com/static/"
-    ]
     
-    # Kiểm tra xem URL có trong danh sách đen không
-    for item in blacklist:
-        if item in url:
-            logger.warning(f"URL nằm trong danh sách đen: {url}")
-            return False
-        
-    # Kiểm tra phần mở rộng file
-    ext_match = re.search(r'\.(zip|psd|ai|jpg|png|pdf|eps|rar)(\?|$)', url.lower())
-    if not ext_match:
+    # Kiểm tra danh sách đen, phần mở rộng file và các từ khóa logo, icon, v.v.
+    rejection = download_url_rejection(url)
+    if rejection == 'blacklist':
+        logger.warning(f"URL nằm trong danh sách đen: {url}")
         return False
-        
-    # Loại trừ các file logo, icon, v.v.
-    if any(keyword in url.lower() for keyword in ['logo', 'icon', 'favicon', 'avatar', 'prize', 'personal']):
+    if rejection == 'keyword':
         logger.warning(f"URL chứa từ khóa bị loại trừ: {url}")
         return False
+    if rejection:
+        return False
         
     # Kiểm tra kích thước file (nếu có thể)
     try:
-        response = session.head(url, headers=headers, timeout=5)
-        content_length = response.headers.get('Content-Length')
+        if response_headers is None:
+            response_headers = get_http_session().head(url, headers=get_http_headers(), timeout=http_timeout(5)).headers
+        content_length = response_headers.get('Content-Length')
         if content_length:
             size_kb = int(content_length) / 1024
             if size_kb < 50:  # Nhỏ hơn 50KB có thể là icon hoặc hình ảnh nhỏ
@@ -688,17 +1207,19 @@ def is_valid_download_file(url):
         
     return True
 
-def get_file_info(url):
-    """Lấy thông tin về file từ URL"""
+@profile_phase('file_info')
+def get_file_info(url, response_headers=None):
+    """Lấy thông tin về file từ URL (response_headers: header HEAD đã lấy sẵn nếu có)"""
     try:
-        response = session.head(url, headers=headers, timeout=5)
+        if response_headers is None:
+            response_headers = get_http_session().head(url, headers=get_http_headers(), timeout=http_timeout(5)).headers
         
         # Lấy kích thước file
-        content_length = response.headers.get('Content-Length')
+        content_length = response_headers.get('Content-Length')
         size_mb = int(content_length) / (1024 * 1024) if content_length else 0
         
         # Lấy loại file từ Content-Type
-        content_type = response.headers.get('Content-Type', '')
+        content_type = response_headers.get('Content-Type', '')
         
         # Lấy tên file
         filename = url.split('/')[-1].split('?')[0]
@@ -735,6 +1256,8 @@ def get_file_info(url):
         return {
             'filename': filename,
             'size': f"{size_mb:.2f} MB",
+            'size_bytes': int(content_length) if content_length else None,
+            'accept_ranges': response_headers.get('Accept-Ranges', ''),
             'type': content_type,
             'format': file_format,
             'url': url,
@@ -777,12 +1300,211 @@ def get_file_info(url):
         return {
             'filename': url.split('/')[-1].split('?')[0],
             'size': 'Không xác định',
+            'size_bytes': None,
+            'accept_ranges': '',
             'type': 'Không xác định',
             'format': file_format,
             'url': url,
             'expiry': expiry_time
         }
 
+def get_link_expiry(url):
+    """Lấy timestamp hết hạn (tham số e=) từ link tải, trả về None nếu không có"""
+    if not url:
+        return None
+    expiry_match = re.search(r'[?&]e=(\d+)', url)
+    if not expiry_match:
+        return None
+    try:
+        return int(expiry_match.group(1))
+    except ValueError:
+        return None
+
+class RangeNotSupported(IOError):
+    """Máy chủ bỏ qua header Range và trả về toàn bộ file (HTTP 200)"""
+
+def _download_range(url, path, segment, state_lock, deadline, chunk_size=1024 * 1024, cancel=None):
+    """Tải một đoạn [start, end] của file vào đúng vị trí trong file .part
+    
+    cancel: Event để dừng sớm (trả về False) khi đoạn khác phát hiện máy chủ không hỗ trợ Range.
+    """
+    start, end = segment['start'], segment['end']
+    offset = start + segment['done']
+    if offset > end:
+        return True
+    
+    range_headers = dict(get_http_headers())
+    range_headers['Range'] = f"bytes={offset}-{end}"
+    read_timeout = 30
+    if deadline:
+        read_timeout = max(1, min(read_timeout, deadline - time.time()))
+    
+    with get_http_session().get(url, headers=range_headers, stream=True, timeout=(10, read_timeout)) as response:
+        if response.status_code == 200:
+            raise RangeNotSupported("Máy chủ bỏ qua Range và trả về toàn bộ file (HTTP 200)")
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Máy chủ không hỗ trợ tải theo đoạn (HTTP {response.status_code})")
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if cancel is not None and cancel.is_set():
+                    return False
+                if deadline and time.time() >= deadline:
+                    raise TimeoutError("Link tải đã hết hạn trong khi đang tải")
+                if not chunk:
+                    continue
+                # Không ghi quá cuối đoạn nếu máy chủ trả thừa dữ liệu
+                chunk = chunk[:end - offset + 1]
+                f.write(chunk)
+                offset += len(chunk)
+                with state_lock:
+                    segment['done'] = offset - start
+                if offset > end:
+                    break
+    return offset > end
+
+def _save_download_state(state_path, state, state_lock):
+    """Ghi trạng thái tải (để có thể tải tiếp khi bị gián đoạn)"""
+    with state_lock:
+        data = json.dumps(state)
+    with open(state_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+
+def _preallocate_file(path, size):
+    """Cấp phát trước dung lượng cho file đích"""
+    with open(path, 'ab') as f:
+        pass
+    with open(path, 'r+b') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            f.truncate(size)
+
+def _download_single_stream(url, path, deadline):
+    """Tải file bằng một kết nối (dùng khi máy chủ không hỗ trợ Range hoặc không rõ kích thước)"""
+    read_timeout = 30
+    if deadline:
+        read_timeout = max(1, min(read_timeout, deadline - time.time()))
+    with get_http_session().get(url, headers=get_http_headers(), stream=True, timeout=(10, read_timeout)) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                if deadline and time.time() >= deadline:
+                    raise TimeoutError("Link tải đã hết hạn trong khi đang tải")
+                if chunk:
+                    f.write(chunk)
+
+def download_file(url, output_dir, filename=None, segments=None, file_info=None):
+    """Tải file từ link tải thật bằng nhiều đoạn HTTP Range song song, hỗ trợ tải tiếp khi bị gián đoạn
+    
+    Toàn bộ quá trình tải phải hoàn tất trước thời điểm hết hạn (tham số e=) của link.
+    Trả về đường dẫn file đã tải hoặc None nếu thất bại.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    if segments is None:
+        segments = int(os.getenv('DOWNLOAD_SEGMENTS', '4'))
+    min_segment_size = int(os.getenv('DOWNLOAD_MIN_SEGMENT_MB', '4')) * 1024 * 1024
+    
+    deadline = get_link_expiry(url)
+    if deadline and deadline <= time.time():
+        logger.error(f"Link tải đã hết hạn, không thể tải: {url}")
+        print("❌ Link tải đã hết hạn, không thể tải file.")
+        return None
+    
+    if file_info is None:
+        file_info = get_file_info(url)
+    filename = filename or file_info['filename'] or "pikbest_download"
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, filename)
+    part_path = f"{path}.part"
+    state_path = f"{part_path}.json"
+    size = file_info.get('size_bytes')
+    
+    print(f"⬇️ Đang tải file: {filename} ({file_info['size']})")
+    start_time = time.time()
+    try:
+        if not size or 'bytes' not in (file_info.get('accept_ranges') or '').lower():
+            logger.info("Máy chủ không hỗ trợ Range hoặc không rõ kích thước, tải bằng một kết nối")
+            _download_single_stream(url, part_path, deadline)
+        else:
+            url_key = url.split('?')[0]
+            state = None
+            
+            # Tải tiếp nếu đã có trạng thái của lần tải trước cho cùng file
+            if os.path.exists(state_path) and os.path.exists(part_path):
+                try:
+                    with open(state_path, 'r', encoding='utf-8') as f:
+                        state = json.load(f)
+                    if state.get('url') != url_key or state.get('size') != size:
+                        state = None
+                    else:
+                        done = sum(seg['done'] for seg in state['segments'])
+                        logger.info(f"Tải tiếp file {filename} từ {done / (1024 * 1024):.1f} MB")
+                        print(f"↪️ Tải tiếp từ {done / (1024 * 1024):.1f} MB")
+                except Exception as e:
+                    logger.warning(f"Không thể đọc trạng thái tải cũ, tải lại từ đầu: {e}")
+                    state = None
+            
+            if state is None:
+                count = max(1, min(segments, size // min_segment_size or 1))
+                step = size // count
+                state = {'url': url_key, 'size': size, 'segments': []}
+                for i in range(count):
+                    start = i * step
+                    end = size - 1 if i == count - 1 else start + step - 1
+                    state['segments'].append({'start': start, 'end': end, 'done': 0})
+                _preallocate_file(part_path, size)
+            
+            state_lock = threading.Lock()
+            _save_download_state(state_path, state, state_lock)
+            stop_saving = threading.Event()
+            
+            def save_periodically():
+                while not stop_saving.wait(2):
+                    _save_download_state(state_path, state, state_lock)
+            
+            saver = threading.Thread(target=save_periodically, daemon=True)
+            saver.start()
+            cancel = threading.Event()
+            try:
+                with ThreadPoolExecutor(max_workers=len(state['segments'])) as executor:
+                    futures = [executor.submit(_download_range, url, part_path, seg, state_lock, deadline,
+                                               cancel=cancel)
+                               for seg in state['segments']]
+                    for future in futures:
+                        try:
+                            future.result()
+                        except RangeNotSupported as e:
+                            # Dừng các đoạn còn lại, toàn bộ file sẽ được tải lại bằng một kết nối
+                            if not cancel.is_set():
+                                logger.warning(f"{e}, chuyển sang tải bằng một kết nối")
+                            cancel.set()
+            finally:
+                stop_saving.set()
+                saver.join()
+                _save_download_state(state_path, state, state_lock)
+            
+            if cancel.is_set():
+                # Trạng thái các đoạn không còn đúng với file tải lại từ đầu
+                os.remove(state_path)
+                _download_single_stream(url, part_path, deadline)
+        
+        os.replace(part_path, path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        
+        elapsed = max(time.time() - start_time, 0.001)
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        logger.info(f"Đã tải xong {path} ({size_mb:.2f} MB trong {elapsed:.1f} giây)")
+        print(f"✅ Đã tải xong: {path} ({size_mb / elapsed:.2f} MB/s)")
+        return path
+    except Exception as e:
+        logger.error(f"Lỗi khi tải file {url}: {e}")
+        print(f"❌ Lỗi khi tải file: {e} (có thể chạy lại để tải tiếp)")
+        return None
+
 def extract_file_id(url):
     # Xử lý nhiều định dạng URL khác nhau
     patterns = [
@@ -880,21 +1602,26 @@ def process_multiple_urls(urls):
     
     return results
 
-def verify_download_link(url):
-    """Xác minh link tải có hợp lệ không và có phải là link tải thật không"""
+@profile_phase('verify')
+def verify_download_link(url, response_headers=None):
+    """Xác minh link tải có hợp lệ không và có phải là link tải thật không
+    
+    response_headers: header HEAD của link nếu đã lấy sẵn, dùng chung cho mọi bước kiểm tra
+    """
     if not url:
         return None
         
     # Kiểm tra tính hợp lệ của URL
-    if not is_valid_download_file(url):
+    if not is_valid_download_file(url, response_headers=response_headers):
         logger.warning(f"Link không hợp lệ: {url}")
         return None
         
     # Kiểm tra xem URL có phải là link tải thật không
     try:
         # Kiểm tra kích thước file
-        response = session.head(url, headers=headers, timeout=5)
-        content_length = response.headers.get('Content-Length')
+        if response_headers is None:
+            response_headers = get_http_session().head(url, headers=get_http_headers(), timeout=http_timeout(5)).headers
+        content_length = response_headers.get('Content-Length')
         
         if content_length:
             size_mb = int(content_length) / (1024 * 1024)
@@ -904,7 +1631,7 @@ def verify_download_link(url):
                 logger.warning(f"File quá nhỏ ({size_mb:.2f} MB), có thể không phải là file tải thật: {url}")
                 
                 # Kiểm tra thêm nếu là file hình ảnh
-                content_type = response.headers.get('Content-Type', '')
+                content_type = response_headers.get('Content-Type', '')
                 if 'image' in content_type:
                     logger.warning(f"File là hình ảnh, không phải file tải thật: {url}")
                     return None
@@ -1026,7 +1753,7 @@ def configure_captcha_extension(driver):
             api_input.clear()
             
             # Nhập API key
-            api_input.send_keys(CAPTCHA_API_KEY)
+            api_input.send_keys(get_captcha_api_key())
             logger.info("Đã nhập API key vào input field")
             
             # Tìm và nhấn nút Save hoặc Submit
@@ -1058,7 +1785,7 @@ def configure_captcha_extension(driver):
                     // Nếu không tìm thấy nút, thử lưu bằng cách khác
                     localStorage.setItem('captchasonic_apikey', arguments[0]);
                     return false;
-                """, CAPTCHA_API_KEY)
+                """, get_captcha_api_key())
             
             # Đợi để đảm bảo API key được lưu
             time.sleep(2)
@@ -1069,7 +1796,7 @@ def configure_captcha_extension(driver):
                        localStorage.getItem('captchasonic_apikey');
             """)
             
-            if saved_api_key and saved_api_key == CAPTCHA_API_KEY:
+            if saved_api_key and saved_api_key == get_captcha_api_key():
                 logger.info("Xác nhận API key đã được lưu thành công")
             else:
                 logger.warning(f"Không thể xác nhận API key đã được lưu. Giá trị hiện tại: {saved_api_key}")
@@ -1113,7 +1840,7 @@ def configure_captcha_extension(driver):
                         console.error('Error:', e);
                         return false;
                     }
-                """, CAPTCHA_API_KEY)
+                """, get_captcha_api_key())
                 
                 if success:
                     logger.info("Đã cấu hình API key bằng JavaScript")
@@ -1129,7 +1856,64 @@ def configure_captcha_extension(driver):
     driver.get("https://pikbest.com")
     logger.info("Đã hoàn tất cấu hình extension và trở về trang chính")
 
+def parse_args():
+    """Đọc tham số dòng lệnh"""
+    parser = argparse.ArgumentParser(description="Lấy link tải trực tiếp từ Pikbest.com")
+    parser.add_argument("--input", metavar="FILE",
+                        help="File chứa danh sách URL (mỗi dòng một URL)")
+    parser.add_argument("--refresh", metavar="STORE",
+                        help="Chạy chế độ làm mới link nền, lưu các link vào file JSON STORE")
+    parser.add_argument("--download-dir", metavar="DIR",
+                        help="Tải file về thư mục DIR ngay sau khi lấy được link")
+    parser.add_argument("--check", nargs="+", metavar="FILE",
+                        help="Kiểm tra link trong các file kết quả (pikbest_results_*.txt, .jsonl, .csv) còn sống hay đã hết hạn")
+    parser.add_argument("--output", metavar="FILE",
+                        help="Ghi từng kết quả ngay khi xong vào FILE (.jsonl, .csv, .sqlite/.db)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Xử lý theo pipeline nhiều giai đoạn (phân tích -> lấy link -> xác minh -> ghi kết quả)")
+    parser.add_argument("--drivers", type=int, default=None, metavar="N",
+                        help="Số trình duyệt cho giai đoạn lấy link trong chế độ --pipeline")
+    parser.add_argument("--verify-workers", type=int, default=None, metavar="N",
+                        help="Số luồng cho giai đoạn xác minh link trong chế độ --pipeline")
+    parser.add_argument("--tabs", type=int, default=None, metavar="N",
+                        help="Xử lý đồng thời N file ID trên N tab của một trình duyệt")
+    parser.add_argument("--build-golden-profile", action="store_true",
+                        help="Tạo golden profile (CHROME_GOLDEN_PROFILE) để các trình duyệt mới sao chép khi khởi động")
+    parser.add_argument("--record", metavar="DIR",
+                        help="Ghi lại tương tác với trang download của từng URL vào DIR để phát lại offline")
+    parser.add_argument("--replay", nargs="+", metavar="FILE",
+                        help="Phát lại các bản ghi (replay_*.json hoặc page_source_*.html) không cần Chrome, đo thời gian lấy link")
+    parser.add_argument("--repeat", type=int, default=5, metavar="N",
+                        help="Số lần chạy mỗi bản ghi/trang trong chế độ --replay và --scan")
+    parser.add_argument("--scan", nargs="+", metavar="FILE",
+                        help="Quét các trang đã lưu (page_source_*.html): hash, URL file, nút tải và đo thời gian quét")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="Số tiến trình xử lý song song, mỗi tiến trình có trình duyệt riêng (0 = số nhân CPU)")
+    parser.add_argument("--queue", metavar="DB",
+                        help="Xử lý ID từ hàng đợi SQLite dùng chung giữa nhiều máy (URL trong --input được thêm vào hàng đợi trước)")
+    parser.add_argument("--enqueue-only", action="store_true",
+                        help="Chỉ thêm URL trong --input vào hàng đợi --queue rồi thoát, không mở trình duyệt")
+    parser.add_argument("--profile", nargs="?", const="pikbest_profile", metavar="DIR",
+                        help="Chạy dưới cProfile + tracemalloc, ghi collapsed stacks (flame graph) và chênh lệch bộ nhớ "
+                             "theo giai đoạn vào DIR (mặc định pikbest_profile); không đo được các tiến trình con của --workers")
+    args = parser.parse_args()
+    # Các chế độ này tự xử lý --input cục bộ, chạy cùng --queue thì URL vừa thêm vào hàng đợi bị xử lý hai lần
+    if args.queue and (args.pipeline or args.workers != 1 or args.tabs):
+        parser.error("--queue không dùng cùng --pipeline, --workers hoặc --tabs "
+                     "(chạy nhiều node --queue để xử lý song song)")
+    return args
+
 def main():
+    args = parse_args()
+    setup_logging()
+    
+    if args.profile:
+        run_with_profiling(lambda: run_cli(args), args.profile)
+    else:
+        run_cli(args)
+
+def run_cli(args):
+    """Chạy chế độ được chọn bằng tham số dòng lệnh"""
     print("=" * 60)
     print("🔍 PIKBEST LINK EXTRACTOR 🔍".center(60))
     print("=" * 60)
@@ -1138,29 +1922,115 @@ def main():
     print("Để kết thúc nhập, hãy nhấn Enter ở dòng trống.")
     print("-" * 60)
     
-    # Khởi tạo trình duyệt một lần duy nhất
+    if args.build_golden_profile:
+        build_golden_profile()
+        return
+    
+    if args.scan:
+        # Quét offline các trang download đã lưu, không cần trình duyệt
+        benchmark_page_scan(args.scan, repeat=args.repeat)
+        return
+    
+    if args.replay:
+        # Đo hiệu năng và kiểm tra hồi quy logic lấy link trên bản ghi, không cần trình duyệt
+        run_replay_benchmark(args.replay, repeat=args.repeat)
+        return
+    
+    if args.check:
+        # Chỉ kiểm tra link đã lưu, không cần trình duyệt
+        check_saved_links(args.check)
+        return
+    
+    if args.queue and args.input:
+        # Thêm URL vào hàng đợi dùng chung, ID đã có (do node khác thêm) được bỏ qua
+        with SqliteWorkQueue(args.queue) as work_queue:
+            added = work_queue.add(load_urls_from_file(args.input))
+        print(f"📥 Đã thêm {added} ID mới vào hàng đợi {args.queue}")
+    if args.enqueue_only:
+        return
+    
+    if args.pipeline:
+        # Chế độ pipeline: các giai đoạn chạy song song, nối với nhau bằng hàng đợi có giới hạn
+        urls = load_urls_from_file(args.input) if args.input else get_urls_from_user()
+        if urls:
+            sink = open_result_sink(args.output) if args.output else None
+            session_watchdog.start()
+            try:
+                results = run_pipeline(urls, drivers=args.drivers, verify_workers=args.verify_workers, sink=sink)
+            finally:
+                session_watchdog.stop()
+                if sink:
+                    sink.close()
+            if args.download_dir:
+                for result in results:
+                    download_file(result['download_link'], args.download_dir)
+            print_results_summary(results)
+        return
+    
+    if args.workers != 1:
+        # Chế độ nhiều tiến trình: mỗi tiến trình tự khởi tạo trình duyệt
+        workers = args.workers or os.cpu_count() or 1
+        urls = load_urls_from_file(args.input) if args.input else get_urls_from_user()
+        if urls:
+            sink = open_result_sink(args.output) if args.output else None
+            try:
+                results = process_urls_multiprocess(urls, workers, on_result=sink.write if sink else None)
+            finally:
+                if sink:
+                    sink.close()
+            if args.download_dir:
+                for result in results:
+                    download_file(result['download_link'], args.download_dir)
+            print_results_summary(results)
+        return
+    
+    # Khởi tạo trình duyệt một lần duy nhất, driver được theo dõi và tái tạo khi cần
     logger.info("Khởi tạo trình duyệt cho toàn bộ phiên làm việc...")
+    manager = DriverManager()
+    sink = None
     try:
-        driver = setup_chrome_with_extension()
-        logger.info("Đã khởi tạo trình duyệt thành công cho phiên làm việc")
+        sink = open_result_sink(args.output) if args.output else None
         
-        # Đăng nhập vào Pikbest
-        login_to_pikbest(driver)
+        manager.start()
+        logger.info("Đã khởi tạo trình duyệt thành công cho phiên làm việc")
+        session_watchdog.start()
         
-        # Xử lý nhiều URL trong một phiên làm việc
-        process_urls_in_session(driver)
+        if args.tabs:
+            # Nhiều tab trong một trình duyệt, tiết kiệm bộ nhớ so với nhiều trình duyệt
+            urls = load_urls_from_file(args.input) if args.input else get_urls_from_user()
+            if urls:
+                results = process_urls_in_tabs(urls, manager, args.tabs, sink=sink)
+                if args.download_dir:
+                    for result in results:
+                        download_file(result['download_link'], args.download_dir)
+                print_results_summary(results)
+        elif args.queue:
+            # Một node của hàng đợi dùng chung: thuê ID, xử lý, báo kết quả cho đến khi hết việc
+            run_queue_node(SqliteWorkQueue(args.queue), manager, sink=sink)
+        elif args.record:
+            # Lấy link và ghi lại tương tác của trình duyệt để phát lại bằng --replay
+            urls = load_urls_from_file(args.input) if args.input else get_urls_from_user()
+            for url in iter_input_urls(urls):
+                file_id = extract_file_id(url)
+                if file_id:
+                    manager.run(lambda driver, file_id: record_download_page(file_id, driver, args.record), file_id)
+        elif args.refresh:
+            # Giữ cho các link trong STORE luôn còn hạn
+            urls = load_urls_from_file(args.input) if args.input else []
+            run_link_refresher(manager, args.refresh, urls)
+        else:
+            # Xử lý nhiều URL trong một phiên làm việc
+            process_urls_in_session(manager, download_dir=args.download_dir, sink=sink)
         
     except Exception as e:
         logger.error(f"Lỗi khi khởi tạo phiên làm việc: {e}", exc_info=True)
         print(f"❌ Lỗi khi khởi tạo: {e}")
     finally:
-        # Đóng trình duyệt khi hoàn tất
-        try:
-            if 'driver' in locals() and driver:
-                driver.quit()
-                logger.info("Đã đóng trình duyệt")
-        except Exception as e:
-            logger.error(f"Lỗi khi đóng trình duyệt: {e}")
+        # Đóng trình duyệt và ghi nốt các kết quả còn trong bộ đệm khi hoàn tất
+        session_watchdog.stop()
+        manager.close()
+        if sink:
+            sink.close()
 
 def login_to_pikbest(driver):
     """Đăng nhập vào Pikbest sử dụng cookies"""
@@ -1170,7 +2040,7 @@ def login_to_pikbest(driver):
         driver.get("https://pikbest.com")
         
         # Thêm cookies vào trình duyệt
-        for name, value in PIKBEST_COOKIES.items():
+        for name, value in get_pikbest_cookies().items():
             driver.add_cookie({"name": name, "value": value})
         
         # Truy cập trang thông tin người dùng để xác nhận đăng nhập
@@ -1191,8 +2061,13 @@ def login_to_pikbest(driver):
         print(f"❌ Lỗi khi đăng nhập: {e}")
         return False
 
-def process_urls_in_session(driver):
-    """Xử lý nhiều URL trong một phiên làm việc, tuần tự từng link"""
+def process_urls_in_session(manager, download_dir=None, sink=None):
+    """Xử lý nhiều URL trong một phiên làm việc, tuần tự từng link
+    
+    manager: DriverManager quản lý driver (tự tái tạo khi driver bị lỗi hoặc quá tải)
+    download_dir: nếu có, tải file về thư mục này ngay sau khi lấy được link
+    sink: nếu có, ghi từng kết quả (kèm thông tin file) ngay khi xử lý xong
+    """
     while True:
         # Nhận danh sách URL từ người dùng
         urls = get_urls_from_user()
@@ -1204,15 +2079,75 @@ def process_urls_in_session(driver):
                 break
             continue
         
-        # Xử lý từng URL một cách tuần tự
+        # Xử lý từng URL một cách tuần tự, URL trang danh sách được mở rộng dần khi đang xử lý
         results = []
-        for i, url in enumerate(urls, 1):
+        total = "?" if any(is_listing_url(url) for url in urls) else len(urls)
+        source = iter_input_urls(urls)
+        # Các URL kế tiếp được đọc trước để tải trước trang download của chúng trong lúc trình duyệt đang bận
+        prefetch = os.getenv('HTTP_FAST_PATH', 'true').lower() == 'true'
+        upcoming = deque(itertools.islice(source, max(1, get_page_prefetcher().lookahead if prefetch else 1)))
+        prefetch_hits = get_page_prefetcher().hits
+        # Chế độ tuần tự hỏi người dùng giữa các URL nên không vẽ lại dòng trạng thái, chỉ in sau mỗi URL
+        progress = BatchProgress(total=None if total == "?" else total)
+        index = 0
+        pending = deque()
+        attempts = {}
+        retries = RetryScheduler()
+        while pending or upcoming or retries:
+            retry = retries.pop_ready(drained=not (pending or upcoming))
+            if retry is not None:
+                i, url = retry
+                print(f"\n🔁 Thử lại URL #{i}")
+            elif pending:
+                i, url = pending.popleft()
+            elif upcoming:
+                index += 1
+                i, url = index, upcoming.popleft()
+                upcoming.extend(itertools.islice(source, 1))
+            else:
+                # Chỉ còn các URL đang đợi thử lại
+                wait = retries.wait_time(drained=True)
+                print(f"⏳ Đang đợi {wait:.0f} giây để thử lại {len(retries)} URL lỗi...")
+                time.sleep(wait)
+                continue
             print(f"\n{'='*50}")
-            print(f"[{i}/{len(urls)}] Đang xử lý: {url}")
+            print(f"[{i}/{total}] Đang xử lý: {url}")
             print(f"{'='*50}")
             
-            # Sử dụng driver đã khởi tạo để xử lý URL
-            result = process_pikbest_url_with_driver(url, driver)
+            if prefetch:
+                get_page_prefetcher().prefetch(upcoming)
+            
+            # Đợi nếu phiên đăng nhập đang được làm mới, rồi xử lý URL bằng driver đang được quản lý
+            login_generation = session_watchdog.before_task(manager)
+            progress.begin(i)
+            captchas = captcha_encounters()
+            result, crashed = manager.process_url(url)
+            if captcha_encounters() > captchas:
+                progress.mark_captcha(i)
+            attempts[i] = attempts.get(i, 0) + 1
+            if crashed and attempts[i] < manager.max_attempts:
+                # Trình duyệt bị chết giữa chừng, đưa URL lại vào hàng đợi với driver mới
+                print("⚠️ Trình duyệt bị lỗi, đang thử lại URL này với trình duyệt mới...")
+                pending.appendleft((i, url))
+                continue
+            
+            if not result and not crashed:
+                # Lỗi tạm thời được thử lại sau theo chính sách của loại lỗi, không chặn các URL khác
+                failure = get_failure_cache().last_failure(extract_file_id(url))
+                delay = retries.schedule(i, (i, url), failure)
+                if delay is not None:
+                    if retries.policy(failure)['relogin']:
+                        # Đăng nhập lại một lần cho cả batch, driver nhận cookies mới trước URL tiếp theo
+                        session_watchdog.report_expired(login_generation)
+                    when = "cuối batch" if delay == float('inf') else f"sau {delay:.0f} giây"
+                    print(f"\n🔁 Lỗi '{failure}', sẽ thử lại URL #{i} {when}")
+                    progress.retry(i)
+                    continue
+            
+            progress.finish(i, bool(result))
+            print(progress.format_status())
+            if sink:
+                sink.write(build_result_record(url, result))
             
             # Hiển thị kết quả ngay sau khi xử lý xong mỗi URL
             if result:
@@ -1221,8 +2156,12 @@ def process_urls_in_session(driver):
                 print(f"• Link tải: {result}")
                 results.append({"url": url, "download_link": result})
                 
+                # Tải file ngay khi link còn trong thời gian hiệu lực
+                if download_dir:
+                    download_file(result, download_dir)
+                
                 # Hỏi người dùng có muốn tiếp tục với URL tiếp theo không
-                if i < len(urls):
+                if pending or upcoming or retries:
                     continue_choice = input("\nTiếp tục với URL tiếp theo? (y/n): ").strip().lower()
                     if continue_choice != 'y':
                         print("Đã dừng xử lý các URL còn lại.")
@@ -1231,26 +2170,20 @@ def process_urls_in_session(driver):
                 print(f"\n❌ Không thể lấy link tải cho URL #{i}: {url}")
                 
                 # Hỏi người dùng có muốn tiếp tục với URL tiếp theo không
-                if i < len(urls):
+                if pending or upcoming or retries:
                     continue_choice = input("\nTiếp tục với URL tiếp theo? (y/n): ").strip().lower()
                     if continue_choice != 'y':
                         print("Đã dừng xử lý các URL còn lại.")
                         break
         
+        source.close()
+        get_page_prefetcher().close()
+        progress.stop()
+        if get_page_prefetcher().hits > prefetch_hits:
+            print(f"\n⚡ {get_page_prefetcher().hits - prefetch_hits} URL dùng trang download đã tải trước")
+        
         # Hiển thị tổng kết sau khi xử lý tất cả URL
-        if results:
-            print("\n" + "="*60)
-            print("📋 TỔNG KẾT KẾT QUẢ".center(60))
-            print("="*60)
-            for i, result in enumerate(results, 1):
-                print(f"{i}. {result['url']} -> {result['download_link']}")
-            
-            # Lưu kết quả vào file nếu người dùng muốn
-            save_choice = input("\nBạn có muốn lưu kết quả vào file không? (y/n): ").strip().lower()
-            if save_choice == 'y':
-                save_results_to_file(results)
-        else:
-            print("\n❌ Không có URL nào được xử lý thành công.")
+        print_results_summary(results)
         
         # Hỏi người dùng có muốn tiếp tục với batch URL mới không
         choice = input("\nBạn muốn nhập batch URL mới không? (y/n): ").strip().lower()
@@ -1258,121 +2191,987 @@ def process_urls_in_session(driver):
             print("Cảm ơn đã sử dụng tool. Tạm biệt!")
             break
 
-def get_urls_from_user():
-    """Nhận danh sách URL từ người dùng"""
-    print("\nNhập URL Pikbest (mỗi URL một dòng, Enter ở dòng trống để kết thúc):")
-    urls = []
-    while True:
-        url = input("> ").strip()
-        if not url:
-            break
-        urls.append(url)
-    
-    return urls
+# Các trường của một bản ghi kết quả, theo thứ tự cột khi ghi CSV/SQLite
+RESULT_FIELDS = [
+    'url', 'file_id', 'status', 'download_link', 'filename', 'size', 'size_bytes',
+    'format', 'type', 'expiry', 'expires_at', 'resolved_at',
+]
 
-def save_results_to_file(results):
-    """Lưu kết quả vào file"""
-    try:
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        filename = f"pikbest_results_{timestamp}.txt"
-        
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write("=== PIKBEST DOWNLOAD LINKS ===\n\n")
-            for i, result in enumerate(results, 1):
-                f.write(f"{i}. Original URL: {result['url']}\n")
-                f.write(f"   Download Link: {result['download_link']}\n\n")
-        
-        print(f"✅ Đã lưu kết quả vào file: {filename}")
-    except Exception as e:
+# Thông tin file gần đây do process_pikbest_url_with_driver đã lấy, tránh phải gửi lại HEAD.
+# Dùng chung cho cả tiến trình (mọi resolver): thông tin lấy theo link tải, không phụ thuộc tài khoản
+_recent_file_info = OrderedDict()
+_recent_file_info_lock = threading.Lock()
+
+def remember_file_info(download_link, file_info, max_entries=256):
+    """Ghi nhớ thông tin file của link vừa xác minh để bản ghi kết quả dùng lại"""
+    with _recent_file_info_lock:
+        _recent_file_info[download_link] = file_info
+        _recent_file_info.move_to_end(download_link)
+        while len(_recent_file_info) > max_entries:
+            _recent_file_info.popitem(last=False)
+
+def build_result_record(url, download_link, file_info=None):
+    """Tạo bản ghi kết quả đầy đủ (link tải, kích thước, định dạng, thời điểm hết hạn...)"""
+    record = dict.fromkeys(RESULT_FIELDS)
+    record.update({
+        'url': url,
+        'file_id': extract_file_id(url),
+        'status': 'ok' if download_link else 'failed',
+        'download_link': download_link,
+        'resolved_at': int(time.time()),
+    })
+    if download_link:
+        if file_info is None:
+            with _recent_file_info_lock:
+                file_info = _recent_file_info.get(download_link)
+        if file_info is None:
+            file_info = get_file_info(download_link)
+        for key in ('filename', 'size', 'size_bytes', 'format', 'type', 'expiry'):
+            record[key] = file_info.get(key)
+        record['expires_at'] = get_link_expiry(download_link)
+    return record
+
+class ResultSink(abc.ABC):
+    """Nơi ghi kết quả theo luồng: gom bản ghi vào bộ đệm và ghi theo lô"""
+
+    def __init__(self, path, batch_size=None, flush_interval=None):
+        self.path = path
+        self.batch_size = batch_size or int(os.getenv('RESULT_BATCH_SIZE', '20'))
+        # Ghi bộ đệm sau tối đa N giây để bên sử dụng không phải đợi đủ lô
+        if flush_interval is None:
+            flush_interval = float(os.getenv('RESULT_FLUSH_INTERVAL', '5'))
+        self.flush_interval = flush_interval
+        self.count = 0
+        self._buffer = []
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        # Luồng nền ghi bộ đệm khi không có bản ghi mới (lúc các URL còn lại xử lý lâu)
+        self._stop_timer = threading.Event()
+        self._timer = None
+        if self.flush_interval > 0:
+            self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._timer.start()
+
+    def _flush_periodically(self):
+        while not self._stop_timer.wait(self.flush_interval):
+            with self._lock:
+                due = self._buffer and time.time() - self._last_flush >= self.flush_interval
+            if due:
+                self.flush()
+
+    def write(self, record):
+        """Thêm một bản ghi, ghi ra đích khi đủ lô hoặc quá thời gian chờ"""
+        with self._lock:
+            self._buffer.append(record)
+            due = len(self._buffer) >= self.batch_size or time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Ghi toàn bộ bộ đệm ra đích"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._last_flush = time.time()
+            if not batch:
+                return
+            try:
+                self._write_batch(batch)
+                self.count += len(batch)
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi {len(batch)} kết quả vào {self.path}: {e}")
+
+    @abc.abstractmethod
+    def _write_batch(self, batch):
+        """Ghi một lô bản ghi ra đích (được gọi khi đang giữ khóa)"""
+
+    def _close(self):
+        pass
+
+    def close(self):
+        """Ghi nốt bộ đệm và đóng đích"""
+        self._stop_timer.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
+        self._close()
+        logger.info(f"Đã ghi {self.count} kết quả vào: {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class JsonlSink(ResultSink):
+    """Ghi mỗi kết quả thành một dòng JSON"""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _write_batch(self, batch):
+        self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch))
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+class CsvSink(ResultSink):
+    """Ghi kết quả thành các dòng CSV (tự thêm dòng tiêu đề cho file mới)"""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", encoding="utf-8", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        if is_new:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def _write_batch(self, batch):
+        self._writer.writerows(batch)
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+class SqliteSink(ResultSink):
+    """Ghi kết quả vào bảng SQLite, mỗi lô trong một transaction"""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(f"{field} {'INTEGER' if field in ('size_bytes', 'expires_at', 'resolved_at') else 'TEXT'}"
+                            for field in RESULT_FIELDS)
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_file_id ON results (file_id)")
+
+    def _write_batch(self, batch):
+        placeholders = ", ".join("?" for _ in RESULT_FIELDS)
+        rows = [tuple(record.get(field) for field in RESULT_FIELDS) for record in batch]
+        with self._conn:
+            self._conn.executemany(f"INSERT INTO results ({', '.join(RESULT_FIELDS)}) VALUES ({placeholders})", rows)
+
+    def _close(self):
+        self._conn.close()
+
+def open_result_sink(path):
+    """Chọn loại sink theo phần mở rộng của file (.jsonl, .csv, .sqlite/.db)"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return CsvSink(path)
+    if ext in ('.sqlite', '.sqlite3', '.db'):
+        return SqliteSink(path)
+    if ext not in ('.jsonl', '.json', '.ndjson'):
+        logger.warning(f"Không nhận diện được định dạng {ext}, ghi kết quả dạng JSONL")
+    return JsonlSink(path)
+
+def print_results_summary(results):
+    """Hiển thị tổng kết kết quả và hỏi người dùng có muốn lưu vào file không"""
+    if results:
+        print("\n" + "="*60)
+        print("📋 TỔNG KẾT KẾT QUẢ".center(60))
+        print("="*60)
+        for i, result in enumerate(results, 1):
+            print(f"{i}. {result['url']} -> {result['download_link']}")
+        
+        # Lưu kết quả vào file nếu người dùng muốn
+        save_choice = input("\nBạn có muốn lưu kết quả vào file không? (y/n): ").strip().lower()
+        if save_choice == 'y':
+            save_results_to_file(results)
+    else:
+        print("\n❌ Không có URL nào được xử lý thành công.")
+
+def get_urls_from_user():
+    """Nhận danh sách URL từ người dùng"""
+    print("\nNhập URL Pikbest (mỗi URL một dòng, Enter ở dòng trống để kết thúc):")
+    urls = []
+    while True:
+        url = input("> ").strip()
+        if not url:
+            break
+        urls.append(url)
+    
+    return urls
+
+def load_urls_from_file(path):
+    """Đọc danh sách URL từ file (mỗi dòng một URL, bỏ qua dòng trống và dòng bắt đầu bằng #)"""
+    urls = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    urls.append(line)
+        logger.info(f"Đã đọc {len(urls)} URL từ file: {path}")
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc file URL {path}: {e}")
+        print(f"❌ Lỗi khi đọc file URL: {e}")
+    return urls
+
+def save_results_to_file(results):
+    """Lưu kết quả vào file"""
+    try:
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        filename = f"pikbest_results_{timestamp}.txt"
+        
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write("=== PIKBEST DOWNLOAD LINKS ===\n\n")
+            for i, result in enumerate(results, 1):
+                f.write(f"{i}. Original URL: {result['url']}\n")
+                f.write(f"   Download Link: {result['download_link']}\n\n")
+        
+        print(f"✅ Đã lưu kết quả vào file: {filename}")
+    except Exception as e:
         logger.error(f"Lỗi khi lưu kết quả vào file: {e}")
         print(f"❌ Lỗi khi lưu kết quả: {e}")
 
 def process_pikbest_url_with_driver(url, driver):
-    """Xử lý URL Pikbest với driver đã khởi tạo"""
-    file_id = extract_file_id(url)
-    if not file_id:
-        logger.error(f"Không tìm thấy ID trong URL: {url}")
-        print("❌ Không tìm thấy ID trong URL.")
+    """Xử lý URL Pikbest với driver đã khởi tạo (dùng resolver đang hoạt động trên luồng, nếu có)"""
+    resolver = current_resolver() or get_default_resolver()
+    return resolver.resolve_with_driver(url, driver)
+
+# Các selector tìm nút "Click here" trên trang download, theo thứ tự ưu tiên
+CLICK_HERE_SELECTORS = [
+    "/html/body/div[3]/div/div[1]/div/div[2]/div/p[1]/a",
+    "//a[contains(text(), 'Click here')]",
+    "//a[@onclick='if (!window.__cfRLUnblockHandlers) return false; downloadImage()']",
+    "//a[contains(@onclick, 'downloadImage')]",
+    "//a[contains(@class, 'download')]",
+    "//button[contains(@class, 'download')]",
+    "//a[contains(@href, 'javascript')]"
+]
+
+# Chỉ các selector đặc trưng của nút tải mới được dùng làm tín hiệu trang đã sẵn sàng
+DOWNLOAD_READY_SELECTORS = CLICK_HERE_SELECTORS[:4]
+
+def check_download_page_ready(driver, file_id=None):
+    """Kiểm tra nhanh (một lần gọi script) trang download đã có đủ thông tin để lấy link chưa
+    
+    Trả về 'button', 'ajax', 'captcha', 'hash', 'loaded', 'login' (bị chuyển đến trang đăng nhập)
+    hoặc None nếu chưa sẵn sàng. file_id: chỉ chấp nhận trang của ID này; khi điều hướng chưa xong
+    (PAGE_LOAD_STRATEGY=none hoặc tab được dùng lại) tab vẫn hiện trang download của ID trước với đủ nút và hash.
+    """
+    try:
+        return driver.execute_script("""
+            var selectors = arguments[0];
+            var fileId = arguments[1];
+            if (fileId) {
+                var href = location.href;
+                if (href.toLowerCase().indexOf('login') !== -1) return 'login';
+                if (!new RegExp('[?&]id=' + fileId + '(?:[&#]|$)').test(href)) return null;
+            }
+            for (var i = 0; i < selectors.length; i++) {
+                try {
+                    var node = document.evaluate(selectors[i], document, null,
+                        XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+                    if (node && node.offsetParent !== null) return 'button';
+                } catch (e) {}
+            }
+            var entries = (window.performance && performance.getEntriesByType) ?
+                performance.getEntriesByType('resource') : [];
+            for (var j = 0; j < entries.length; j++) {
+                if (entries[j].name.indexOf('AjaxDownload') !== -1) return 'ajax';
+            }
+            if (document.querySelector("iframe[src*='captcha'], iframe[title*='captcha']")) return 'captcha';
+            var html = document.documentElement ? document.documentElement.innerHTML : '';
+            if (html.indexOf('__hash__=') !== -1) return 'hash';
+            return document.readyState === 'complete' ? 'loaded' : null;
+        """, DOWNLOAD_READY_SELECTORS, str(file_id) if file_id is not None else None)
+    except Exception as e:
+        # Trang đang chuyển hướng hoặc chưa có document
+        logger.debug(f"Chưa kiểm tra được trạng thái trang: {e}")
         return None
 
-    print(f"🔍 Đang xử lý ID: {file_id}")
-    logger.info(f"Đang xử lý ID: {file_id} từ URL: {url}")
+# Trạng thái trang đủ để bắt đầu lấy link (hoặc biết chắc là không lấy được)
+DOWNLOAD_PAGE_READY_SIGNALS = ('button', 'ajax', 'captcha', 'hash', 'login')
+
+@profile_phase('page_ready')
+def wait_for_download_page_ready(driver, timeout=None, poll_interval=0.25, file_id=None):
+    """Đợi đến khi trang download (của file_id nếu có) có nút tải, hash, Ajax download đã chạy hoặc xuất hiện captcha"""
+    if timeout is None:
+        timeout = float(os.getenv('PAGE_READY_TIMEOUT', '15'))
+    clock = get_clock()
+    end_time = clock.time() + bounded_timeout(timeout)
+    signal = None
+    while clock.time() < end_time:
+        signal = check_download_page_ready(driver, file_id)
+        if signal in DOWNLOAD_PAGE_READY_SIGNALS:
+            break
+        clock.sleep(poll_interval)
+    logger.info(f"Trạng thái trang download: {signal or 'hết thời gian chờ'}")
+    return signal
+
+def wait_for_click_result(driver, timeout=5, poll_interval=0.25):
+    """Đợi sau khi click cho đến khi bắt được link tải hoặc request AjaxDownload"""
+    clock = get_clock()
+    end_time = clock.time() + bounded_timeout(timeout)
+    while clock.time() < end_time:
+        try:
+            fired = driver.execute_script("""
+                if (window.downloadLinks && window.downloadLinks.length) return true;
+                var reqs = window.ajaxRequests || [];
+                for (var i = 0; i < reqs.length; i++) {
+                    if (reqs[i].url && reqs[i].url.indexOf('AjaxDownload') !== -1) return true;
+                }
+                return !!document.querySelector("iframe[src*='captcha'], iframe[title*='captcha']");
+            """)
+            if fired:
+                return True
+        except Exception as e:
+            logger.debug(f"Lỗi khi kiểm tra kết quả click: {e}")
+        clock.sleep(poll_interval)
+    return False
+
+# Các mẫu dùng khi quét trang download. Mỗi mẫu bắt đầu bằng một chuỗi cố định nên re tìm kiếm nhanh
+# trong C; một mẫu gộp dạng A|B|C lại bị thử tại từng vị trí của trang nên chậm hơn nhiều lần.
+PAGE_HASH_PATTERN = re.compile(r'__hash__=([a-f0-9_]+)')
+PAGE_URL_PATTERN = re.compile(r'https?://[^"\'\s<>()\\]+')
+# Chỉ khớp thẻ <a>/<button> có "download" trong thuộc tính hoặc chữ "Click here", các thẻ khác bị bỏ qua ngay trong re
+PAGE_BUTTON_PATTERN = re.compile(r'<(a|button)\b(?=[^>]*download|[^>]*>\s*[Cc]lick here)([^>]*)>([^<]{0,200})')
+HTML_ATTRIBUTE_PATTERN = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+# Thuộc tính chứa ảnh xem trước, URL trong đó không phải link tải
+PREVIEW_URL_ATTRIBUTES = ('src="', "src='", 'content="', "content='")
+
+@profile_phase('page_scan')
+def scan_download_page(html):
+    """Quét trang download (HTML đang mở hoặc file page_source_*.html) một lần để lấy mọi thông tin cần thiết
+    
+    Trả về dict gồm 'hash' (hash đầu tiên hoặc None), 'urls' (URL file tải đã lọc offline, không trùng,
+    theo thứ tự xuất hiện) và 'buttons' (các nút tải: tag, text, href, onclick).
+    """
+    hash_match = PAGE_HASH_PATTERN.search(html)
+    result = {'hash': hash_match.group(1) if hash_match else None, 'urls': [], 'buttons': []}
+    
+    seen_urls = set()
+    for match in PAGE_URL_PATTERN.finditer(html):
+        # Bỏ qua ảnh xem trước (<img src>, og:image) và URL không phải file tải
+        if html.endswith(PREVIEW_URL_ATTRIBUTES, max(0, match.start() - 9), match.start()):
+            continue
+        url = match.group(0)
+        if url in seen_urls:
+            continue
+        seen_urls.add(url)
+        if download_url_rejection(url) is None:
+            result['urls'].append(url)
+    
+    for match in PAGE_BUTTON_PATTERN.finditer(html):
+        attrs = match.group(2)
+        text = match.group(3).strip()
+        values = {name.lower(): double if double is not None else single
+                  for name, double, single in HTML_ATTRIBUTE_PATTERN.findall(attrs)}
+        result['buttons'].append({
+            'tag': match.group(1).lower(),
+            'text': text,
+            'href': values.get('href'),
+            'onclick': values.get('onclick'),
+        })
+    return result
+
+def resolve_download_link_via_http(file_id, timeout=10):
+    """Lấy link tải chỉ bằng HTTP (không dùng trình duyệt): tải trang download, quét hash rồi gọi Ajax download
+    
+    Chỉ nhận link do Ajax download trả về; URL file quét được trong HTML (thường là ảnh xem trước lớn)
+    không đủ tin cậy để dùng làm link cuối, việc đó để lại cho bước trình duyệt.
+    """
+    download_api_url = f"https://pikbest.com/?m=download&id={file_id}&flag=1"
+    try:
+        response = get_http_session().get(download_api_url, headers=get_http_headers(), timeout=http_timeout(timeout))
+    except (requests.RequestException, DeadlineExceeded) as e:
+        logger.debug(f"Không tải được trang download qua HTTP: {e}")
+        return None
+    if response.status_code != 200:
+        logger.info(f"Trang download qua HTTP trả về mã {response.status_code}, chuyển sang trình duyệt")
+        return None
+    
+    return link_from_download_page_scan(file_id, scan_download_page(response.text))
 
-    # Hiển thị tiến trình
-    print("⏳ Đang truy cập trang download...")
-    real_url = get_real_download_link_with_driver(file_id, driver)
+def link_from_download_page_scan(file_id, scan):
+    """Lấy link tải từ kết quả quét trang download tải qua HTTP: chỉ gọi Ajax với hash
     
-    if not real_url:
-        print("❌ Không tìm thấy link tải.")
+    href của nút và URL file trong HTML chưa được kiểm chứng (và mỗi URL tốn một HEAD) nên để lại cho bước trình duyệt.
+    """
+    if not scan['hash']:
         return None
+    return get_download_link_from_hash(file_id, '', scan=scan)
+
+class DownloadPagePrefetcher:
+    """Tải trước trang download của vài URL kế tiếp bằng HTTP trong lúc trình duyệt đang xử lý URL hiện tại
+    
+    Trang được quét ngay trong luồng nền (hash, URL file, nút tải), khi đến lượt URL đó
+    get_real_download_link_with_driver dùng luôn hash đã quét để gọi Ajax download,
+    không phải đợi tải trang nữa.
+    """
+    
+    def __init__(self, lookahead=None, max_age=None):
+        if lookahead is None:
+            lookahead = int(os.getenv('PREFETCH_LOOKAHEAD', '3'))
+        if max_age is None:
+            max_age = float(os.getenv('PREFETCH_MAX_AGE', '120'))
+        self.lookahead = max(0, lookahead)
+        # Hash trên trang có thể hết hạn nên trang tải trước quá lâu sẽ bị bỏ
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()  # file_id -> (future, thời điểm bắt đầu tải)
+        self._lock = threading.Lock()
+        self._executor = None
+    
+    def prefetch(self, urls):
+        """Bắt đầu tải trước trang download của tối đa lookahead URL kế tiếp (bỏ qua URL đã tải hoặc đang tải)"""
+        from concurrent.futures import ThreadPoolExecutor
         
-    print("⏳ Đang xác minh link tải...")
-    # Xác minh link tải
-    verified_url = verify_download_link(real_url)
+        if not self.lookahead:
+            return
+        resolver = current_resolver()
+        with self._lock:
+            for url in itertools.islice(urls, self.lookahead):
+                file_id = extract_file_id(url)
+                if not file_id or file_id in self._pages or get_failure_cache().get(file_id):
+                    continue
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.lookahead, thread_name_prefix="PagePrefetch")
+                self._pages[file_id] = (self._executor.submit(self._fetch, file_id, resolver), time.time())
+            # Giữ số trang trong bộ nhớ có giới hạn nếu URL bị bỏ qua mà không được lấy ra
+            while len(self._pages) > self.lookahead * 4:
+                _, (future, _) = self._pages.popitem(last=False)
+                future.cancel()
     
-    if verified_url:
-        print(f"\n🎯 Link tải thật: {verified_url}")
+    @staticmethod
+    def _fetch(file_id, resolver):
+        # Luồng nền dùng session, cookies của resolver đã lên lịch tải trước (nếu có)
+        with resolver.activate() if resolver is not None else contextlib.nullcontext():
+            download_api_url = f"https://pikbest.com/?m=download&id={file_id}&flag=1"
+            response = get_http_session().get(download_api_url, headers=get_http_headers(), timeout=10)
+        if response.status_code != 200:
+            logger.debug(f"Tải trước trang download ID {file_id} trả về mã {response.status_code}")
+            return None
+        return scan_download_page(response.text)
+    
+    def take(self, file_id, timeout=5):
+        """Lấy kết quả quét đã tải trước của ID (đợi tối đa timeout giây nếu đang tải), None nếu không có"""
+        with self._lock:
+            entry = self._pages.pop(file_id, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        future, started = entry
+        if time.time() - started > self.max_age:
+            future.cancel()
+            self.misses += 1
+            return None
+        try:
+            scan = future.result(timeout=bounded_timeout(timeout))
+        except Exception as e:
+            logger.debug(f"Không dùng được trang tải trước của ID {file_id}: {e}")
+            scan = None
+        if scan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return scan
+    
+    def close(self):
+        """Hủy các trang đang chờ tải và dừng luồng nền"""
+        with self._lock:
+            for future, _ in self._pages.values():
+                future.cancel()
+            self._pages.clear()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+page_prefetcher = DownloadPagePrefetcher()
+
+def get_page_prefetcher():
+    """Bộ tải trước trang download của resolver đang hoạt động, hoặc bộ chung của module
+    
+    Mỗi resolver có bộ riêng vì trang được tải bằng session (cookies) của resolver và hash trên trang gắn với phiên đó.
+    """
+    resolver = current_resolver()
+    return resolver.page_prefetcher if resolver is not None else page_prefetcher
+
+def benchmark_page_scan(paths, repeat=5):
+    """So sánh thời gian quét một lần (scan_download_page) với cách cũ (nhiều regex quét lại cùng một trang)"""
+    legacy_url_pattern = r'(https?://[^"\'\s]+\.(?:zip|psd|ai|jpg|png|pdf|eps|rar)[^"\'\s]*)'
+    
+    def legacy_scan(html):
+        hash_match = re.search(r'__hash__=([a-f0-9_]+)', html)
+        scripts = re.findall(r'<script[^>]*>(.*?)</script>', html, re.S)
+        urls = []
+        for script_content in scripts:
+            for url in re.findall(legacy_url_pattern, script_content):
+                if download_url_rejection(url) is None:
+                    urls.append(url)
+        return hash_match, urls
+    
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                html = f.read()
+        except Exception as e:
+            print(f"❌ Không thể đọc {path}: {e}")
+            continue
+        size_mb = len(html.encode('utf-8')) / (1024 * 1024)
+        timings = {}
+        for name, func in (('scan_download_page', scan_download_page), ('hash + URL trong script (cách cũ, không tìm nút)', legacy_scan)):
+            best = float('inf')
+            for _ in range(max(1, repeat)):
+                start_time = time.perf_counter()
+                func(html)
+                best = min(best, time.perf_counter() - start_time)
+            timings[name] = best
+        scan = scan_download_page(html)
+        print(f"\n📄 {path} ({size_mb:.2f} MB)")
+        print(f"  • Hash: {scan['hash'] or 'không có'}")
+        print(f"  • URL file: {len(scan['urls'])}" + (f" (đầu tiên: {scan['urls'][0]})" if scan['urls'] else ""))
+        print(f"  • Nút tải: {len(scan['buttons'])}")
+        for name, seconds in timings.items():
+            speed = size_mb / seconds if seconds else float('inf')
+            print(f"  • {name}: {seconds * 1000:.2f} ms ({speed:.0f} MB/s)")
+
+def get_download_link_from_hash(file_id, page_source, scan=None):
+    """Trích xuất __hash__ từ HTML và gọi trực tiếp Ajax download để lấy link tải
+    
+    scan: kết quả scan_download_page của page_source nếu đã quét, để không phải quét lại
+    """
+    try:
+        logger.info("Đang tìm hash trong HTML...")
+        print("⏳ Đang tìm hash trong HTML...")
         
-        print("⏳ Đang lấy thông tin file...")
-        # Lấy thông tin file
-        file_info = get_file_info(verified_url)
+        # Tìm hash trong HTML
+        if scan is None:
+            scan = scan_download_page(page_source)
+        if not scan['hash']:
+            return None
+        hash_value = scan['hash']
+        logger.info(f"Tìm thấy hash: {hash_value}")
+        print(f"✅ Tìm thấy hash")
         
-        # Hiển thị thông tin file
-        print("\n📁 Thông tin file:")
-        print(f"  • Tên file: {file_info['filename']}")
-        print(f"  • Kích thước: {file_info['size']}")
-        print(f"  • Định dạng: {file_info['format']}")
-        print(f"  • Hết hạn: {file_info['expiry']}")
+        # Tạo Ajax URL
+        ajax_url = f"https://pikbest.com/?m=AjaxDownload&a=open&id={file_id}&__hash__={hash_value}&flag=1"
+        logger.info(f"Đang gọi Ajax URL: {ajax_url}")
+        print("⏳ Đang gọi Ajax URL...")
         
-        # Hiển thị cảnh báo nếu link sắp hết hạn
-        if file_info['expiry'] != "Không xác định":
+        # Gọi Ajax URL
+        ajax_response = get_http_session().get(ajax_url, headers=get_http_headers(), timeout=http_timeout(15))
+        if ajax_response.status_code == 200:
             try:
-                expiry_match = re.search(r'[?&]e=(\d+)', verified_url)
-                if expiry_match:
-                    expiry_timestamp = int(expiry_match.group(1))
-                    current_time = time.time()
-                    hours_left = (expiry_timestamp - current_time) / 3600
-                    
-                    if hours_left < 24:
-                        print(f"\n⚠️ Cảnh báo: Link sẽ hết hạn trong {hours_left:.1f} giờ!")
-                    elif hours_left < 72:
-                        print(f"\n⚠️ Cảnh báo: Link sẽ hết hạn trong {hours_left/24:.1f} ngày!")
-            except:
-                pass
+                return link_from_ajax_response(ajax_response.json())
+            except Exception as e:
+                logger.error(f"Lỗi khi parse Ajax response: {e}")
+    except Exception as e:
+        logger.error(f"Lỗi khi tìm hash và gọi Ajax: {e}")
+    return None
+
+@profile_phase('ajax_response')
+def link_from_ajax_response(ajax_data):
+    """Lấy link tải từ JSON trả về của Ajax download (trường url hoặc data), None nếu không có"""
+    logger.info(f"Ajax response: {ajax_data}")
+    
+    if 'url' in ajax_data and ajax_data['url']:
+        logger.info(f"Tìm thấy URL từ Ajax: {ajax_data['url']}")
+        print("✅ Tìm thấy URL từ Ajax")
+        return ajax_data['url']
         
-        return verified_url
-    else:
-        if real_url:
-            logger.error(f"Tìm thấy link nhưng không hợp lệ: {real_url}")
-            print(f"⚠️ Tìm thấy link nhưng không hợp lệ: {real_url}")
-            print("💡 Mẹo: Link này có thể là hình ảnh hoặc tài nguyên khác, không phải file tải thật.")
+    if 'data' in ajax_data and ajax_data['data']:
+        if isinstance(ajax_data['data'], str) and 'http' in ajax_data['data']:
+            logger.info(f"Tìm thấy URL từ Ajax data: {ajax_data['data']}")
+            print("✅ Tìm thấy URL từ Ajax data")
+            return ajax_data['data']
+    return None
+
+# Các loại lỗi khi lấy link tải
+FAILURE_NOT_FOUND = 'not_found'          # File không tồn tại hoặc đã bị gỡ
+FAILURE_PREMIUM = 'premium'              # File chỉ dành cho tài khoản premium
+FAILURE_CAPTCHA = 'captcha'              # Không giải được captcha
+FAILURE_TIMEOUT = 'timeout'              # Trang không tải xong hoặc trình duyệt không phản hồi
+FAILURE_LOGIN_EXPIRED = 'login_expired'  # Phiên đăng nhập đã hết hạn
+FAILURE_UNKNOWN = 'unknown'
+
+# Dấu hiệu trên trang (tiêu đề + nội dung khung tải) để nhận biết loại lỗi, theo thứ tự ưu tiên
+FAILURE_PAGE_MARKERS = [
+    (FAILURE_LOGIN_EXPIRED, re.compile(r"please (?:log ?in|sign ?in)|(?:log ?in|sign ?in) to download|vui lòng đăng nhập", re.I)),
+    (FAILURE_NOT_FOUND, re.compile(r"error 404|404 not found|page not found|does not exist|no longer available|"
+                                   r"has been (?:removed|deleted)|không tồn tại", re.I)),
+    (FAILURE_PREMIUM, re.compile(r"(?:only|exclusive) (?:for|to) premium|premium (?:members?|users?) only|"
+                                 r"upgrade to (?:premium|vip)|become (?:a )?(?:premium|vip)", re.I)),
+]
+
+# Khung chứa nút tải trên trang download (cùng khối với selector "Click here" đầu tiên)
+DOWNLOAD_PANEL_XPATH = "/html/body/div[3]/div/div[1]/div/div[2]"
+
+# Phần khung chung của trang (menu, banner "Upgrade to Premium/VIP"...) bị loại khỏi nội dung khi không có khung tải
+PAGE_CHROME_SELECTOR = "header, nav, footer, [class*='header'], [id*='header'], [class*='banner'], [class*='footer']"
+
+def read_failure_page_state(driver):
+    """Đọc trạng thái trang download để phân loại lỗi (một lần gọi script)
+    
+    Nội dung chỉ lấy trong khung tải, hoặc toàn trang trừ menu/banner/footer khi không có khung tải,
+    để banner quảng cáo premium ở đầu trang không bị nhận nhầm là file premium.
+    """
+    return driver.execute_script("""
+        var text = '';
+        var panel = document.evaluate(arguments[0], document, null,
+                                      XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        if (panel) {
+            text = panel.innerText || '';
+        } else if (document.body) {
+            var body = document.body.cloneNode(true);
+            body.querySelectorAll(arguments[1]).forEach(function(el) { el.remove(); });
+            text = body.textContent || '';
+        }
+        return {
+            url: location.href,
+            title: document.title || '',
+            text: text.replace(/\\s+/g, ' ').slice(0, 5000),
+            captcha: !!document.querySelector("iframe[src*='captcha'], iframe[title*='captcha']"),
+            ready: document.readyState
+        };
+    """, DOWNLOAD_PANEL_XPATH, PAGE_CHROME_SELECTOR)
+
+def get_failure_ttls():
+    """Thời gian lưu cache (giây) cho từng loại lỗi; chỉ lỗi xác định (lặp lại được) mới được lưu"""
+    return {
+        FAILURE_NOT_FOUND: float(os.getenv('FAILURE_TTL_NOT_FOUND_MINUTES', '360')) * 60,
+        FAILURE_PREMIUM: float(os.getenv('FAILURE_TTL_PREMIUM_MINUTES', '60')) * 60,
+    }
+
+def classify_download_failure(driver, snapshot=None):
+    """Phân loại nguyên nhân không lấy được link dựa trên trạng thái trang download đang mở
+    
+    snapshot: trạng thái trang (read_failure_page_state) đọc trước khi các phương pháp lấy link click hoặc
+    chuyển trang; khi có thì dấu hiệu nội dung (404, premium) được tìm trên snapshot thay vì trang hiện tại.
+    """
+    if deadline_expired():
+        return FAILURE_TIMEOUT
+    try:
+        page = read_failure_page_state(driver)
+    except Exception as e:
+        logger.debug(f"Không đọc được trạng thái trang để phân loại lỗi: {e}")
+        return FAILURE_TIMEOUT
+    
+    if 'login' in page['url'].lower():
+        return FAILURE_LOGIN_EXPIRED
+    if page['captcha']:
+        return FAILURE_CAPTCHA
+    if page['ready'] != 'complete':
+        return FAILURE_TIMEOUT
+    
+    source = snapshot or page
+    text = f"{source['title']}\n{source['text']}"
+    for failure, pattern in FAILURE_PAGE_MARKERS:
+        if pattern.search(text):
+            return failure
+    return FAILURE_UNKNOWN
+
+def _failure_snapshot(driver):
+    """Trạng thái trang để phân loại lỗi sau này, None nếu không đọc được"""
+    try:
+        return read_failure_page_state(driver)
+    except Exception as e:
+        logger.debug(f"Không đọc được trạng thái trang trước khi lấy link: {e}")
+        return None
+
+class FailureCache:
+    """Cache kết quả thất bại theo file ID, để các ID chắc chắn lỗi lại bị từ chối ngay mà không mở trình duyệt
+    
+    Lỗi xác định (không tồn tại, premium) được lưu với TTL ngắn và ghi ra file JSON để dùng cho lần chạy sau;
+    lỗi tạm thời (captcha, hết thời gian, hết phiên đăng nhập) chỉ được ghi nhớ là lỗi gần nhất của ID.
+    """
+    
+    def __init__(self, path=None, ttls=None, max_entries=10000):
+        self.path = path
+        self.ttls = ttls if ttls is not None else get_failure_ttls()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # file_id -> {'failure': loại lỗi, 'expires_at': thời điểm hết hạn}
+        self.recent = OrderedDict()   # file_id -> loại lỗi gần nhất (kể cả lỗi tạm thời)
+        self.lock = threading.Lock()
+        self.loaded = False
+    
+    def _load(self):
+        """Đọc cache từ file (chỉ một lần, khi dùng lần đầu)"""
+        self.loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Không thể đọc cache lỗi {self.path}: {e}")
+            return
+        now = time.time()
+        for file_id, entry in data.items():
+            if entry.get('expires_at', 0) > now:
+                self.entries[file_id] = entry
+        logger.info(f"Đã tải {len(self.entries)} ID lỗi từ cache: {self.path}")
+    
+    def _save(self):
+        """Ghi cache ra file (ghi vào file tạm rồi đổi tên để không hỏng file khi bị ngắt giữa chừng)"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Không thể lưu cache lỗi {self.path}: {e}")
+    
+    def get(self, file_id):
+        """Trả về loại lỗi nếu file ID đang bị cache là lỗi, ngược lại trả về None"""
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            entry = self.entries.get(file_id)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                del self.entries[file_id]
+                return None
+            return entry['failure']
+    
+    def record(self, file_id, failure):
+        """Ghi nhận một lần thất bại; lỗi xác định được cache theo TTL của loại lỗi đó"""
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            self.recent[file_id] = failure
+            self.recent.move_to_end(file_id)
+            while len(self.recent) > self.max_entries:
+                self.recent.popitem(last=False)
+            
+            ttl = self.ttls.get(failure, 0)
+            if ttl <= 0:
+                return
+            self.entries[file_id] = {'failure': failure, 'expires_at': time.time() + ttl}
+            self.entries.move_to_end(file_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._save()
+        logger.info(f"Đã cache lỗi '{failure}' cho ID {file_id} trong {ttl / 60:.0f} phút")
+    
+    def last_failure(self, file_id):
+        """Loại lỗi gần nhất đã ghi nhận cho file ID (None nếu chưa từng lỗi)"""
+        with self.lock:
+            return self.recent.get(file_id)
+    
+    def forget(self, file_id):
+        """Xóa lỗi gần nhất của file ID sau khi đã lấy được link"""
+        with self.lock:
+            self.recent.pop(file_id, None)
+
+failure_cache = FailureCache(os.getenv('FAILURE_CACHE_PATH', 'failure_cache.json'))
+
+def get_retry_policies():
+    """Chính sách thử lại cho từng loại lỗi
+    
+    retries: số lần thử lại tối đa; delay: số giây đợi trước lần thử lại đầu tiên (None = đợi đến cuối batch);
+    backoff: hệ số nhân thời gian đợi cho mỗi lần thử tiếp theo; other_worker: ưu tiên giao cho worker khác;
+    relogin: đăng nhập lại trước khi thử lại. Lỗi không có trong danh sách (not_found, premium) không được thử lại.
+    """
+    return {
+        FAILURE_TIMEOUT: {'retries': int(os.getenv('RETRY_TIMEOUT_MAX', '2')),
+                          'delay': float(os.getenv('RETRY_TIMEOUT_DELAY', '5')),
+                          'backoff': 1, 'other_worker': True, 'relogin': False},
+        FAILURE_CAPTCHA: {'retries': int(os.getenv('RETRY_CAPTCHA_MAX', '2')),
+                          'delay': float(os.getenv('RETRY_CAPTCHA_DELAY', '60')),
+                          'backoff': 2, 'other_worker': False, 'relogin': False},
+        FAILURE_LOGIN_EXPIRED: {'retries': int(os.getenv('RETRY_LOGIN_MAX', '1')),
+                                'delay': 0, 'backoff': 1, 'other_worker': False, 'relogin': True},
+        FAILURE_UNKNOWN: {'retries': int(os.getenv('RETRY_UNKNOWN_MAX', '1')),
+                          'delay': None, 'backoff': 1, 'other_worker': False, 'relogin': False},
+    }
+
+class RetryScheduler:
+    """Hàng đợi thử lại các URL lỗi, sắp xếp theo thời điểm được thử lại (heap)
+    
+    Mỗi loại lỗi có chính sách riêng (số lần, thời gian đợi, backoff). URL đang đợi không chặn
+    phần còn lại của batch: bên xử lý chỉ lấy ra các URL đã đến lượt, URL đợi cuối batch
+    chỉ được lấy khi không còn việc mới.
+    """
+    
+    def __init__(self, policies=None):
+        self.policies = policies if policies is not None else get_retry_policies()
+        self.heap = []  # (thời điểm thử lại, thứ tự, key, worker nên tránh, item)
+        self.attempts = {}  # key -> số lần đã lên lịch thử lại
+        self.counter = itertools.count()
+    
+    def __len__(self):
+        return len(self.heap)
+    
+    def policy(self, failure):
+        """Chính sách thử lại của loại lỗi (None nếu không thử lại)"""
+        return self.policies.get(failure)
+    
+    def schedule(self, key, item, failure, worker=None):
+        """Lên lịch thử lại item; trả về số giây đợi (inf = cuối batch) hoặc None nếu không thử lại nữa"""
+        policy = self.policy(failure)
+        if not policy:
+            return None
+        attempt = self.attempts.get(key, 0)
+        if attempt >= policy['retries']:
+            return None
+        self.attempts[key] = attempt + 1
+        
+        if policy['delay'] is None:
+            delay = float('inf')
         else:
-            logger.error("Không tìm thấy link tải thật")
-            print("⚠️ Không tìm thấy link tải thật. Vui lòng kiểm tra lại URL hoặc đăng nhập.")
+            delay = policy['delay'] * policy['backoff'] ** attempt
+        avoid = worker if policy['other_worker'] else None
+        heapq.heappush(self.heap, (time.time() + delay, next(self.counter), key, avoid, item))
+        logger.info(f"Đã lên lịch thử lại {key} (lỗi '{failure}', lần {attempt + 1}/{policy['retries']})")
+        return delay
+    
+    def pop_ready(self, worker=None, drained=False):
+        """Lấy item đã đến lượt thử lại (None nếu chưa có)
         
-        return None
+        drained=True khi không còn việc mới, lúc đó các item đợi cuối batch cũng được lấy.
+        worker: bỏ qua item cần tránh worker này, trừ khi không còn lựa chọn nào khác.
+        """
+        now = time.time()
+        skipped = []
+        found = None
+        while self.heap:
+            entry = self.heap[0]
+            ready_at, _, _, avoid, _ = entry
+            if ready_at > now and not (drained and ready_at == float('inf')):
+                break
+            heapq.heappop(self.heap)
+            if worker is not None and avoid == worker:
+                skipped.append(entry)
+                continue
+            found = entry
+            break
+        if found is None and skipped and drained:
+            # Chỉ còn worker này, không cần tránh nữa
+            found = skipped.pop(0)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return found[4] if found else None
+    
+    def discard(self, key):
+        """Bỏ các lần thử lại đang chờ của key (ví dụ khi kết quả đã đến từ nơi khác)"""
+        entries = [entry for entry in self.heap if entry[2] != key]
+        if len(entries) != len(self.heap):
+            self.heap = entries
+            heapq.heapify(self.heap)
+    
+    def wait_time(self, drained=False):
+        """Số giây đến khi có item được thử lại (None nếu hàng đợi rỗng)"""
+        if not self.heap:
+            return None
+        ready_at = self.heap[0][0]
+        if ready_at == float('inf'):
+            return 0 if drained else None
+        return max(0, ready_at - time.time())
 
-def get_real_download_link_with_driver(file_id, driver):
-    """Lấy link tải thật với driver đã khởi tạo mà không tải file về"""
+@profile_phase('open_page')
+def open_download_page(file_id, driver, wait=True):
+    """Mở trang download của file ID trên tab hiện tại
+    
+    wait=False chỉ bắt đầu điều hướng rồi trả về ngay, để nhiều tab có thể tải trang cùng lúc.
+    """
     download_api_url = f"https://pikbest.com/?m=download&id={file_id}&flag=1"
-    logger.info(f"Đang truy cập URL download: {download_api_url}")
+    
+    # Vô hiệu hóa tải xuống tự động
+    # Thiết lập preferences để ngăn tải xuống tự động
+    driver.execute_cdp_cmd('Page.setDownloadBehavior', {
+        'behavior': 'deny',
+        'downloadPath': '/dev/null'  # Đường dẫn không quan trọng vì chúng ta đang từ chối tải xuống
+    })
+    
+    # Truy cập trang download
+    logger.info(f"Đang truy cập trang download: {download_api_url}")
+    if wait:
+        remaining = deadline_remaining()
+        if remaining is None:
+            driver.get(download_api_url)
+        else:
+            # Trang tải quá hạn chót thì driver.get dừng lại, sau đó trả lại timeout đã cấu hình cho driver
+            try:
+                previous_timeout = driver.timeouts.page_load
+            except Exception:
+                previous_timeout = 300
+            driver.set_page_load_timeout(max(1, remaining))
+            try:
+                driver.get(download_api_url)
+            finally:
+                driver.set_page_load_timeout(previous_timeout)
+    else:
+        driver.execute_script("window.location.href = arguments[0];", download_api_url)
 
-    try:
-        # Vô hiệu hóa tải xuống tự động
-        # Thiết lập preferences để ngăn tải xuống tự động
-        driver.execute_cdp_cmd('Page.setDownloadBehavior', {
-            'behavior': 'deny',
-            'downloadPath': '/dev/null'  # Đường dẫn không quan trọng vì chúng ta đang từ chối tải xuống
-        })
+@profile_phase('resolve')
+def get_real_download_link_with_driver(file_id, driver, http_fast_path=None):
+    """Lấy link tải thật với driver đã khởi tạo mà không tải file về
+    
+    Toàn bộ các bước (HTTP, tải trang, captcha, click) nằm trong hạn chót URL_DEADLINE của URL.
+    http_fast_path: thử lấy link chỉ bằng HTTP trước (mặc định theo HTTP_FAST_PATH); False khi bên gọi đã thử rồi.
+    """
+    with url_deadline():
+        # ID vừa lỗi xác định (không tồn tại, premium) thì bỏ qua ngay, không tốn thời gian mở trình duyệt
+        failure = get_failure_cache().get(file_id)
+        if failure:
+            logger.info(f"Bỏ qua ID {file_id}: đã lỗi gần đây ({failure})")
+            print(f"⏭️ Bỏ qua ID {file_id}: đã lỗi gần đây ({failure})")
+            return None
         
-        # Truy cập trang download
-        logger.info(f"Đang truy cập trang download: {download_api_url}")
-        driver.get(download_api_url)
+        # Thử lấy link chỉ bằng HTTP trước, trang có hash thì không cần mở trình duyệt
+        if http_fast_path is None:
+            http_fast_path = os.getenv('HTTP_FAST_PATH', 'true').lower() == 'true'
+        if http_fast_path:
+            # Trang đã được tải trước trong lúc xử lý URL trước đó thì gọi thẳng Ajax download với hash đã quét
+            scan = get_page_prefetcher().take(file_id)
+            link = link_from_download_page_scan(file_id, scan) if scan else resolve_download_link_via_http(file_id)
+            if link:
+                logger.info(f"Đã lấy link qua HTTP, không cần trình duyệt: {link}")
+                print("⚡ Đã lấy link qua HTTP, không cần trình duyệt")
+                get_failure_cache().forget(file_id)
+                return link
         
-        # Đợi lâu hơn để trang load hoàn toàn và hiện nút "Click here"
-        print("⏳ Đang đợi trang tải hoàn tất...")
-        time.sleep(7)  # Đợi ít nhất 5 giây + thêm 2 giây để chắc chắn
+        download_api_url = f"https://pikbest.com/?m=download&id={file_id}&flag=1"
+        logger.info(f"Đang truy cập URL download: {download_api_url}")
+
+        try:
+            open_download_page(file_id, driver)
+            
+            # Đợi đến khi nút "Click here", Ajax download hoặc captcha xuất hiện
+            print("⏳ Đang đợi trang download sẵn sàng...")
+            wait_for_download_page_ready(driver, file_id=file_id)
+            
+            # Bị chuyển hướng sang trang đăng nhập: phiên đã hết hạn, không cần thử các phương pháp khác
+            if 'login' in driver.current_url.lower():
+                logger.warning(f"Bị chuyển hướng đến trang đăng nhập khi xử lý ID {file_id}")
+                print("⚠️ Phiên đăng nhập đã hết hạn (bị chuyển đến trang đăng nhập)")
+                get_failure_cache().record(file_id, FAILURE_LOGIN_EXPIRED)
+                return None
+        except Exception as e:
+            logger.error(f"Lỗi chung khi tìm link tải: {e}")
+            print(f"❌ Lỗi khi tìm link tải: {e}")
+            get_failure_cache().record(file_id, classify_download_failure(driver))
+            return None
         
+        # Ghi lại nội dung trang trước khi các phương pháp lấy link click hoặc chuyển trang
+        snapshot = _failure_snapshot(driver)
+        link = extract_download_link_from_page(file_id, driver)
+        if not link:
+            failure = classify_download_failure(driver, snapshot)
+            get_failure_cache().record(file_id, failure)
+            if deadline_expired():
+                logger.warning(f"Hết thời gian xử lý ID {file_id}")
+                print("⏱️ Hết thời gian xử lý URL (URL_DEADLINE)")
+            print(f"⚠️ Nguyên nhân lỗi: {failure}")
+        else:
+            get_failure_cache().forget(file_id)
+        return link
+
+@profile_phase('extract_link')
+def extract_download_link_from_page(file_id, driver):
+    """Lấy link tải thật từ trang download đang mở trên tab hiện tại của driver"""
+    try:
         # Xử lý captcha nếu xuất hiện
         captcha_frames = driver.find_elements(By.XPATH, "//iframe[contains(@src, 'captcha') or contains(@title, 'captcha')]")
         if captcha_frames:
@@ -1382,19 +3181,23 @@ def get_real_download_link_with_driver(file_id, driver):
             logger.error("Không thể xử lý captcha, đang hủy tải xuống")
             print("❌ Không thể xử lý captcha, đang hủy tải xuống")
             return None
+        if deadline_expired():
+            return None
         
-        # Lưu screenshot để debug
-        screenshot_path = f"debug_screenshot_{file_id}.png"
-        driver.save_screenshot(screenshot_path)
-        logger.info(f"Đã lưu screenshot tại: {screenshot_path}")
-        
-        # Lưu source HTML để debug
-        with open(f"page_source_{file_id}.html", "w", encoding="utf-8") as f:
-            f.write(driver.page_source)
-        logger.info(f"Đã lưu source HTML tại: page_source_{file_id}.html")
+        # Lưu screenshot và source HTML để debug
+        if debug_dumps_enabled():
+            screenshot_path = f"debug_screenshot_{file_id}.png"
+            driver.save_screenshot(screenshot_path)
+            logger.info(f"Đã lưu screenshot tại: {screenshot_path}")
+            with open(f"page_source_{file_id}.html", "w", encoding="utf-8") as f:
+                f.write(driver.page_source)
+            logger.info(f"Đã lưu source HTML tại: page_source_{file_id}.html")
         
         # Thêm script để bắt Ajax requests và chặn tải xuống
         print("⏳ Đang chuẩn bị bắt Ajax requests và chặn tải xuống...")
+        install_network_capture(driver)
+        capture_cursor = {'seq': 0}
+        
         driver.execute_script("""
             // Chặn tải xuống tự động
             window.originalCreateElement = document.createElement;
@@ -1473,68 +3276,6 @@ def get_real_download_link_with_driver(file_id, driver):
                 }
             }, true);
             
-            window.ajaxRequests = [];
-            window.downloadLinks = [];
-            
-            // Bắt XHR requests
-            var originalXHROpen = XMLHttpRequest.prototype.open;
-            var originalXHRSend = XMLHttpRequest.prototype.send;
-            
-            XMLHttpRequest.prototype.open = function(method, url) {
-                this._url = url;
-                this._method = method;
-                originalXHROpen.apply(this, arguments);
-            };
-            
-            XMLHttpRequest.prototype.send = function() {
-                var xhr = this;
-                this.addEventListener('load', function() {
-                    try {
-                        var url = xhr._url || xhr.responseURL;
-                        if (url) {
-                            window.ajaxRequests.push({
-                                url: url,
-                                method: xhr._method,
-                                status: xhr.status,
-                                response: xhr.responseText
-                            });
-                            
-                            // Kiểm tra nếu là Ajax download request
-                            if (url.includes('AjaxDownload') && url.includes('a=open')) {
-                                console.log('Detected AjaxDownload request:', url);
-                                console.log('Response:', xhr.responseText);
-                                
-                                // Thử parse JSON response
-                                try {
-                                    var jsonResponse = JSON.parse(xhr.responseText);
-                                    if (jsonResponse && jsonResponse.url) {
-                                        window.downloadLinks.push(jsonResponse.url);
-                                        console.log('Added to downloadLinks from Ajax:', jsonResponse.url);
-                                    }
-                                } catch (e) {
-                                    console.error('Error parsing JSON:', e);
-                                }
-                            }
-                            
-                            // Kiểm tra các URL tải
-                            if (url && (url.includes('.zip') || url.includes('.psd') || 
-                                       url.includes('.ai') || url.includes('.jpg') || 
-                                       url.includes('.png') || url.includes('.pdf') || 
-                                       url.includes('.eps') || url.includes('.rar'))) {
-                                if (!url.includes('logo') && !url.includes('icon') && 
-                                    !url.includes('favicon') && !url.includes('avatar')) {
-                                    window.downloadLinks.push(url);
-                                    console.log('Added to downloadLinks from XHR:', url);
-                                }
-                            }
-                        }
-                    } catch (e) {
-                        console.error('Error in XHR tracking:', e);
-                    }
-                });
-                originalXHRSend.apply(this, arguments);
-            };
-            
             // Ghi đè phương thức location.href để bắt chuyển hướng
             var originalLocationDescriptor = Object.getOwnPropertyDescriptor(window, 'location');
             var newLocationProxy = new Proxy(window.location, {
@@ -1579,18 +3320,8 @@ def get_real_download_link_with_driver(file_id, driver):
         logger.info("Đang tìm nút 'Click here'...")
         try:
             # Tìm theo nhiều cách khác nhau
-            click_here_selectors = [
-                "/html/body/div[3]/div/div[1]/div/div[2]/div/p[1]/a",
-                "//a[contains(text(), 'Click here')]",
-                "//a[@onclick='if (!window.__cfRLUnblockHandlers) return false; downloadImage()']",
-                "//a[contains(@onclick, 'downloadImage')]",
-                "//a[contains(@class, 'download')]",
-                "//button[contains(@class, 'download')]",
-                "//a[contains(@href, 'javascript')]"
-            ]
-            
             click_here_button = None
-            for selector in click_here_selectors:
+            for selector in CLICK_HERE_SELECTORS:
                 elements = driver.find_elements(By.XPATH, selector)
                 if elements and elements[0].is_displayed():
                     click_here_button = elements[0]
@@ -1657,7 +3388,7 @@ def get_real_download_link_with_driver(file_id, driver):
                 """, click_here_button)
                 
                 print("⏳ Đang đợi sau khi click...")
-                time.sleep(5)  # Đợi lâu hơn sau khi click
+                wait_for_click_result(driver)
                 
                 # Xử lý captcha nếu xuất hiện sau khi click
                 captcha_frames = driver.find_elements(By.XPATH, "//iframe[contains(@src, 'captcha') or contains(@title, 'captcha')]")
@@ -1668,6 +3399,8 @@ def get_real_download_link_with_driver(file_id, driver):
                     logger.error("Không thể xử lý captcha sau khi click, đang hủy tải xuống")
                     print("❌ Không thể xử lý captcha sau khi click, đang hủy tải xuống")
                     return None
+                if deadline_expired():
+                    return None
                 
                 # Kiểm tra download links đã bắt được
                 print("⏳ Đang kiểm tra download links...")
@@ -1682,7 +3415,7 @@ def get_real_download_link_with_driver(file_id, driver):
                 
                 # Kiểm tra Ajax requests
                 print("⏳ Đang kiểm tra Ajax requests...")
-                ajax_requests = driver.execute_script("return window.ajaxRequests;")
+                ajax_requests = read_captured_requests(driver, capture_cursor)
                 if ajax_requests:
                     logger.info(f"Tìm thấy {len(ajax_requests)} Ajax requests")
                     print(f"✅ Tìm thấy {len(ajax_requests)} Ajax requests")
@@ -1720,7 +3453,7 @@ def get_real_download_link_with_driver(file_id, driver):
                                 try:
                                     logger.info(f"Đang gọi trực tiếp Ajax request: {url}")
                                     print("⏳ Đang gọi trực tiếp Ajax request...")
-                                    ajax_response = session.get(url, headers=headers)
+                                    ajax_response = get_http_session().get(url, headers=get_http_headers(), timeout=http_timeout(15))
                                     if ajax_response.status_code == 200:
                                         try:
                                             ajax_data = ajax_response.json()
@@ -1742,46 +3475,16 @@ def get_real_download_link_with_driver(file_id, driver):
                                     logger.error(f"Lỗi khi gọi trực tiếp Ajax request: {e}")
                 
                 # Phương pháp mới: Trích xuất hash từ HTML và tạo Ajax URL
-                try:
-                    logger.info("Đang tìm hash trong HTML...")
-                    print("⏳ Đang tìm hash trong HTML...")
-                    page_source = driver.page_source
-                    
-                    # Tìm hash trong HTML
-                    hash_match = re.search(r'__hash__=([a-f0-9_]+)', page_source)
-                    if hash_match:
-                        hash_value = hash_match.group(1)
-                        logger.info(f"Tìm thấy hash: {hash_value}")
-                        print(f"✅ Tìm thấy hash")
-                        
-                        # Tạo Ajax URL
-                        ajax_url = f"https://pikbest.com/?m=AjaxDownload&a=open&id={file_id}&__hash__={hash_value}&flag=1"
-                        logger.info(f"Đang gọi Ajax URL: {ajax_url}")
-                        print("⏳ Đang gọi Ajax URL...")
-                        
-                        # Gọi Ajax URL
-                        ajax_response = session.get(ajax_url, headers=headers)
-                        if ajax_response.status_code == 200:
-                            try:
-                                ajax_data = ajax_response.json()
-                                logger.info(f"Ajax response: {ajax_data}")
-                                
-                                if 'url' in ajax_data and ajax_data['url']:
-                                    logger.info(f"Tìm thấy URL từ Ajax: {ajax_data['url']}")
-                                    print("✅ Tìm thấy URL từ Ajax")
-                                    return ajax_data['url']
-                                    
-                                if 'data' in ajax_data and ajax_data['data']:
-                                    if isinstance(ajax_data['data'], str) and 'http' in ajax_data['data']:
-                                        logger.info(f"Tìm thấy URL từ Ajax data: {ajax_data['data']}")
-                                        print("✅ Tìm thấy URL từ Ajax data")
-                                        return ajax_data['data']
-                            except Exception as e:
-                                logger.error(f"Lỗi khi parse Ajax response: {e}")
-                except Exception as e:
-                    logger.error(f"Lỗi khi tìm hash và gọi Ajax: {e}")
+                hash_link = get_download_link_from_hash(file_id, driver.page_source)
+                if hash_link:
+                    return hash_link
             else:
                 print("⚠️ Không tìm thấy nút 'Click here'")
+                
+                # Trang đã có hash thì không cần nút, gọi thẳng Ajax download
+                hash_link = get_download_link_from_hash(file_id, driver.page_source)
+                if hash_link:
+                    return hash_link
         except Exception as e:
             logger.error(f"Lỗi khi tìm và click nút 'Click here': {e}")
         
@@ -1794,5 +3497,2718 @@ def get_real_download_link_with_driver(file_id, driver):
     print("❌ Không tìm thấy link tải sau khi thử tất cả các phương pháp")
     return None
 
+def create_logged_in_driver(profile_path=None):
+    """Khởi tạo driver mới và đăng nhập vào Pikbest
+    
+    Nếu có golden profile (CHROME_GOLDEN_PROFILE), driver chạy trên một bản sao riêng của nó
+    thay vì profile_path, nên không cần cấu hình lại extension và không tranh chấp khóa profile.
+    """
+    golden_profile = get_golden_profile_path()
+    clone_path = None
+    if golden_profile:
+        clone_path = clone_profile(golden_profile)
+        profile_path = clone_path
+    
+    try:
+        driver = setup_chrome_with_extension(profile_path=profile_path, configure_extension=not clone_path)
+    except Exception:
+        remove_profile_clone(clone_path)
+        raise
+    # Ghi nhớ bản sao profile để xóa khi đóng driver
+    driver.profile_clone_path = clone_path
+    try:
+        login_to_pikbest(driver)
+    except Exception:
+        quit_driver(driver)
+        raise
+    return driver
+
+def quit_driver(driver):
+    """Đóng driver và xóa bản sao profile (nếu có) của nó"""
+    try:
+        driver.quit()
+    finally:
+        remove_profile_clone(getattr(driver, 'profile_clone_path', None))
+
+# Các thư mục/file không sao chép từ golden profile: file khóa của Chrome và bộ nhớ đệm tái tạo được
+PROFILE_CLONE_SKIP = {
+    'SingletonLock', 'SingletonSocket', 'SingletonCookie', 'lockfile', 'LOCK',
+    'Cache', 'Code Cache', 'GPUCache', 'GrShaderCache', 'ShaderCache', 'DawnCache', 'Crashpad',
+}
+
+# Các thư mục chỉ đọc (Chrome không ghi đè file bên trong) nên có thể dùng hardlink an toàn
+PROFILE_CLONE_HARDLINK_DIRS = {'Extensions'}
+
+def get_golden_profile_path():
+    """Đường dẫn golden profile nếu đã được tạo, ngược lại trả về None"""
+    golden_profile = os.getenv('CHROME_GOLDEN_PROFILE', '')
+    if golden_profile and os.path.isdir(golden_profile):
+        return os.path.abspath(golden_profile)
+    return None
+
+def clone_profile(source, dest=None):
+    """Tạo bản sao nhanh của profile Chrome
+    
+    Dùng reflink (copy-on-write) nếu hệ thống file hỗ trợ; nếu không, sao chép từng file,
+    dùng hardlink cho thư mục extension chỉ đọc và bỏ qua file khóa, bộ nhớ đệm.
+    """
+    import shutil
+    import subprocess
+    import tempfile
+    
+    if dest is None:
+        dest = tempfile.mkdtemp(prefix="pikbest_profile_")
+    start_time = time.time()
+    
+    # Cách 1: reflink qua cp (Linux với btrfs, xfs...), mọi file được chia sẻ cho đến khi bị ghi
+    if shutil.which('cp') and os.name == 'posix':
+        try:
+            result = subprocess.run(['cp', '-a', '--reflink=always', f"{source}/.", dest],
+                                    capture_output=True, timeout=120)
+            if result.returncode == 0:
+                for name in ('SingletonLock', 'SingletonSocket', 'SingletonCookie'):
+                    path = os.path.join(dest, name)
+                    if os.path.lexists(path):
+                        os.remove(path)
+                logger.info(f"Đã sao chép profile bằng reflink trong {time.time() - start_time:.2f} giây: {dest}")
+                return dest
+            # Hệ thống file không hỗ trợ reflink, dọn bản sao dở dang rồi dùng cách khác
+            shutil.rmtree(dest, ignore_errors=True)
+            os.makedirs(dest, exist_ok=True)
+        except Exception as e:
+            logger.debug(f"Không thể sao chép profile bằng reflink: {e}")
+    
+    # Cách 2: sao chép từng file, hardlink cho thư mục chỉ đọc
+    for root, dirs, files in os.walk(source):
+        dirs[:] = [d for d in dirs if d not in PROFILE_CLONE_SKIP]
+        rel_root = os.path.relpath(root, source)
+        target_root = os.path.join(dest, rel_root) if rel_root != '.' else dest
+        os.makedirs(target_root, exist_ok=True)
+        use_hardlink = any(part in PROFILE_CLONE_HARDLINK_DIRS for part in rel_root.split(os.sep))
+        for name in files:
+            if name in PROFILE_CLONE_SKIP:
+                continue
+            src_file = os.path.join(root, name)
+            dst_file = os.path.join(target_root, name)
+            try:
+                if os.path.islink(src_file):
+                    os.symlink(os.readlink(src_file), dst_file)
+                    continue
+                if use_hardlink:
+                    try:
+                        os.link(src_file, dst_file)
+                        continue
+                    except OSError:
+                        pass
+                shutil.copy2(src_file, dst_file)
+            except OSError as e:
+                logger.warning(f"Không thể sao chép {src_file}: {e}")
+    
+    logger.info(f"Đã sao chép profile trong {time.time() - start_time:.2f} giây: {dest}")
+    return dest
+
+def remove_profile_clone(path):
+    """Xóa bản sao profile tạm thời"""
+    if path:
+        import shutil
+        shutil.rmtree(path, ignore_errors=True)
+        logger.debug(f"Đã xóa bản sao profile: {path}")
+
+def build_golden_profile(path=None):
+    """Tạo golden profile: cài extension, cấu hình API key, đăng nhập và làm ấm cookie/Cloudflare
+    
+    Các trình duyệt khởi tạo sau đó sẽ bắt đầu từ một bản sao của profile này.
+    """
+    path = path or os.getenv('CHROME_GOLDEN_PROFILE', '')
+    if not path:
+        logger.error("Chưa cấu hình CHROME_GOLDEN_PROFILE")
+        print("❌ Vui lòng đặt CHROME_GOLDEN_PROFILE trong file .env")
+        return None
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    
+    print(f"🛠️ Đang tạo golden profile tại: {path}")
+    driver = setup_chrome_with_extension(profile_path=path)
+    try:
+        check_extension_loaded(driver)
+        login_to_pikbest(driver)
+        
+        # Mở một trang download để lấy cookie Cloudflare (cf_clearance) và cache các script dùng chung
+        driver.get("https://pikbest.com/?m=download&id=0&flag=1")
+        wait_for_download_page_ready(driver, file_id=0)
+        handle_captcha(driver)
+        driver.get("https://pikbest.com")
+        time.sleep(2)
+    finally:
+        driver.quit()
+    
+    print("✅ Đã tạo golden profile")
+    logger.info(f"Đã tạo golden profile tại: {path}")
+    return path
+
+def get_process_tree_rss_mb(pid):
+    """Tổng RSS (MB) của tiến trình và toàn bộ tiến trình con, đọc từ /proc (chỉ hỗ trợ Linux)"""
+    if not pid or not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                stat = f.read()
+            # Tên tiến trình nằm trong ngoặc và có thể chứa khoảng trắng
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    
+    total_kb = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+                        break
+        except (OSError, ValueError):
+            continue
+    return total_kb / 1024
+
+class DriverManager:
+    """Quản lý vòng đời driver: theo dõi RSS và tỉ lệ lỗi, tái tạo driver định kỳ và khi trình duyệt bị chết
+    
+    Driver thay thế được khởi động sẵn trong nền (trên thư mục profile riêng) khi driver hiện tại
+    sắp đến ngưỡng tái tạo, nên việc chuyển đổi gần như không mất thời gian.
+    """
+
+    def __init__(self, driver=None, driver_factory=None, profile_path=None,
+                 max_pages=None, max_rss_mb=None, max_error_rate=None, max_attempts=2):
+        self.driver = driver
+        self.driver_factory = driver_factory or create_logged_in_driver
+        if profile_path is None:
+            profile_path = os.getenv('CHROME_PROFILE_PATH', '')
+        # Hai thư mục profile luân phiên cho driver hiện tại và driver dự phòng
+        if profile_path:
+            base = profile_path.rstrip(os.sep)
+            self._profile_slots = [base, f"{base}_spare"]
+        else:
+            self._profile_slots = ['', '']
+        self._slot = 0
+        
+        self.max_pages = max_pages if max_pages is not None else int(os.getenv('DRIVER_MAX_PAGES', '100'))
+        self.max_rss_mb = max_rss_mb if max_rss_mb is not None else float(os.getenv('DRIVER_MAX_RSS_MB', '1500'))
+        if max_error_rate is None:
+            max_error_rate = float(os.getenv('DRIVER_MAX_ERROR_RATE', '0.8'))
+        self.max_error_rate = max_error_rate
+        self.max_attempts = max_attempts
+        # Số trang tối thiểu trước khi xét tỉ lệ lỗi
+        self.min_pages_for_error_rate = 10
+        
+        self.pages = 0
+        self.errors = 0
+        self.recycles = 0
+        # Lượt đăng nhập (SessionWatchdog.generation) mà driver hiện tại đang dùng
+        self.login_generation = 0
+        self._spare = None
+        self._spare_thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Khởi tạo driver đầu tiên nếu chưa có"""
+        if self.driver is None:
+            self.login_generation = session_watchdog.generation
+            self.driver = self.driver_factory(self._profile_slots[self._slot])
+        return self.driver
+
+    def browser_rss_mb(self):
+        """RSS hiện tại của chromedriver và các tiến trình Chrome con"""
+        try:
+            pid = self.driver.service.process.pid
+        except Exception:
+            return None
+        return get_process_tree_rss_mb(pid)
+
+    def is_alive(self):
+        """Kiểm tra trình duyệt còn phản hồi không"""
+        if self.driver is None:
+            return False
+        try:
+            self.driver.current_window_handle
+            return True
+        except WebDriverException:
+            return False
+        except Exception:
+            return False
+
+    def _recycle_reason(self):
+        """Lý do cần tái tạo driver (None nếu driver vẫn ổn)"""
+        if self.max_pages and self.pages >= self.max_pages:
+            return f"đã xử lý {self.pages} trang"
+        rss = self.browser_rss_mb()
+        if rss is not None and self.max_rss_mb and rss >= self.max_rss_mb:
+            return f"bộ nhớ {rss:.0f} MB vượt ngưỡng {self.max_rss_mb:.0f} MB"
+        if self.pages >= self.min_pages_for_error_rate and self.errors / self.pages >= self.max_error_rate:
+            return f"tỉ lệ lỗi {self.errors}/{self.pages}"
+        return None
+
+    def _near_limit(self):
+        """Driver sắp đến ngưỡng tái tạo, nên khởi động sẵn driver thay thế"""
+        if self.max_pages and self.pages >= self.max_pages * 0.9:
+            return True
+        rss = self.browser_rss_mb()
+        return rss is not None and self.max_rss_mb and rss >= self.max_rss_mb * 0.8
+
+    def prewarm(self):
+        """Khởi động driver thay thế trong luồng nền"""
+        with self._lock:
+            if self._spare_thread is not None:
+                return
+            spare_profile = self._profile_slots[1 - self._slot]
+            
+            def build():
+                try:
+                    self._spare = self.driver_factory(spare_profile)
+                    logger.info("Đã khởi động sẵn trình duyệt thay thế")
+                except Exception as e:
+                    logger.error(f"Lỗi khi khởi động sẵn trình duyệt thay thế: {e}")
+                    self._spare = None
+            
+            self._spare_thread = threading.Thread(target=build, name="DriverPrewarm", daemon=True)
+            self._spare_thread.start()
+
+    def _take_spare(self):
+        """Lấy driver dự phòng (đợi nếu đang khởi động), trả về None nếu không có"""
+        with self._lock:
+            thread = self._spare_thread
+        if thread is None:
+            return None
+        thread.join()
+        with self._lock:
+            spare, self._spare, self._spare_thread = self._spare, None, None
+        return spare
+
+    def recycle(self, reason=""):
+        """Thay driver hiện tại bằng driver mới (dùng driver đã khởi động sẵn nếu có)"""
+        logger.info(f"Đang tái tạo trình duyệt{f' ({reason})' if reason else ''}...")
+        old_driver = self.driver
+        self.driver = None
+        
+        # Đóng driver cũ trong nền để không chặn việc xử lý
+        if old_driver is not None:
+            threading.Thread(target=self._quit, args=(old_driver,), daemon=True).start()
+        
+        login_generation = session_watchdog.generation
+        new_driver = self._take_spare()
+        self._slot = 1 - self._slot
+        if new_driver is None:
+            if old_driver is not None:
+                # Đợi ngắn để profile của driver cũ được giải phóng trước khi dùng lại
+                time.sleep(1)
+            new_driver = self.driver_factory(self._profile_slots[self._slot])
+        
+        self.driver = new_driver
+        self.login_generation = login_generation
+        self.pages = 0
+        self.errors = 0
+        self.recycles += 1
+        logger.info(f"Đã tái tạo trình duyệt (lần thứ {self.recycles})")
+        return new_driver
+
+    def run(self, func, *args):
+        """Chạy func(driver, *args) với driver hiện tại, theo dõi lỗi và tái tạo driver khi cần
+        
+        Trả về (kết quả, crashed); crashed=True nghĩa là trình duyệt bị chết khi xử lý
+        và công việc nên được đưa lại vào hàng đợi.
+        """
+        if self.driver is None:
+            self.start()
+        try:
+            result = func(self.driver, *args)
+        except Exception as e:
+            logger.error(f"Lỗi khi xử lý {args}: {e}", exc_info=True)
+            result = None
+        
+        crashed = False
+        if not result and not self.is_alive():
+            logger.error("Trình duyệt không còn phản hồi, đang khởi tạo trình duyệt mới")
+            crashed = True
+            self.recycle("trình duyệt bị chết")
+            return result, crashed
+        
+        self.pages += 1
+        if not result:
+            self.errors += 1
+        
+        reason = self._recycle_reason()
+        if reason:
+            self.recycle(reason)
+        elif self._near_limit():
+            self.prewarm()
+        return result, crashed
+
+    def relogin(self):
+        """Đăng nhập lại trên driver hiện tại (khi phiên đăng nhập hết hạn), tái tạo driver nếu không được"""
+        if self.driver is None:
+            return self.start()
+        logger.info("Phiên đăng nhập đã hết hạn, đang đăng nhập lại...")
+        if not login_to_pikbest(self.driver):
+            self.recycle("đăng nhập lại thất bại")
+        return self.driver
+
+    def process_url(self, url):
+        """Xử lý một URL bằng driver hiện tại trong hạn chót URL_DEADLINE, trả về (link tải, crashed)"""
+        with url_deadline():
+            return self.run(lambda driver, url: process_pikbest_url_with_driver(url, driver), url)
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            quit_driver(driver)
+        except Exception as e:
+            logger.debug(f"Lỗi khi đóng trình duyệt cũ: {e}")
+
+    def close(self):
+        """Đóng driver hiện tại và driver dự phòng"""
+        spare = self._take_spare()
+        for driver in (self.driver, spare):
+            if driver is not None:
+                self._quit(driver)
+        if self.driver is not None:
+            logger.info("Đã đóng trình duyệt")
+        self.driver = None
+
+def reload_pikbest_cookies():
+    """Đọc lại cookies từ file .env (cho phép thay cookies mới khi đang chạy batch)"""
+    global PIKBEST_COOKIES
+    load_dotenv(override=True)
+    cookies = load_cookies_from_env()
+    if cookies:
+        PIKBEST_COOKIES = cookies
+        session.cookies.update(cookies)
+        resolver = current_resolver()
+        if resolver is not None:
+            resolver.cookies.update(cookies)
+            resolver.session.cookies.update(cookies)
+    return cookies
+
+class SessionWatchdog:
+    """Theo dõi phiên đăng nhập trong khi chạy batch và đăng nhập lại một lần khi phiên hết hạn
+    
+    Phát hiện hết phiên qua chuyển hướng đến trang đăng nhập (do worker báo về) hoặc qua request HTTP
+    kiểm tra định kỳ. Khi đăng nhập lại, các worker bị tạm dừng ở before_task(); sau đó mỗi driver
+    nhận lại cookies mới trước URL tiếp theo.
+    """
+    
+    def __init__(self, probe_interval=None):
+        if probe_interval is None:
+            probe_interval = float(os.getenv('SESSION_PROBE_INTERVAL', '300'))
+        self.probe_interval = probe_interval
+        self.generation = 0  # Tăng sau mỗi lần đăng nhập lại
+        self.resume = threading.Event()
+        self.resume.set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def probe(self):
+        """Kiểm tra phiên đăng nhập bằng HTTP: True nếu còn đăng nhập, False nếu hết, None nếu không xác định"""
+        try:
+            response = get_http_session().get("https://pikbest.com/?m=home&a=userInfo", headers=get_http_headers(), timeout=10)
+        except requests.RequestException as e:
+            logger.debug(f"Không kiểm tra được phiên đăng nhập: {e}")
+            return None
+        if 'login' in response.url.lower():
+            return False
+        return True if response.status_code == 200 else None
+    
+    def report_expired(self, generation=None):
+        """Báo phiên đã hết hạn; chỉ đăng nhập lại nếu chưa có worker nào làm việc này sau lượt generation"""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                # Worker khác đã đăng nhập lại sau khi URL này bắt đầu
+                return
+            self.resume.clear()
+            try:
+                logger.warning("Phiên đăng nhập đã hết hạn, tạm dừng các worker để đăng nhập lại")
+                print("\n⏸️ Phiên đăng nhập đã hết hạn, đang tạm dừng để đăng nhập lại...")
+                reload_pikbest_cookies()
+                if self.probe() is False:
+                    logger.error("Cookies trong .env vẫn chưa đăng nhập được, hãy cập nhật PIKBEST_COOKIES")
+                    print("⚠️ Cookies trong .env vẫn chưa đăng nhập được, hãy cập nhật PIKBEST_COOKIES")
+                self.generation += 1
+            finally:
+                self.resume.set()
+            print("▶️ Tiếp tục xử lý")
+    
+    def before_task(self, manager):
+        """Gọi trước mỗi URL: đợi nếu đang đăng nhập lại, áp dụng cookies mới cho driver nếu cần
+        
+        Trả về lượt đăng nhập hiện tại để worker báo lại khi gặp lỗi hết phiên.
+        """
+        self.resume.wait()
+        generation = self.generation
+        if manager.driver is not None and manager.login_generation != generation:
+            manager.relogin()
+            manager.login_generation = generation
+        return generation
+    
+    def _run(self):
+        while not self.stop_event.wait(self.probe_interval):
+            if self.probe() is False:
+                self.report_expired(self.generation)
+    
+    def start(self):
+        """Bắt đầu kiểm tra phiên định kỳ trong luồng nền (0 = tắt)"""
+        if self.probe_interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="SessionWatchdog", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+# Dùng chung cho cả tiến trình: theo dõi phiên đăng nhập của các chế độ batch dòng lệnh (cookies đọc từ .env),
+# PikbestResolver không dùng watchdog này
+session_watchdog = SessionWatchdog()
+
+class PikbestResolver:
+    """Bộ lấy link tải dùng lại được, có session HTTP, cookies, driver và cấu hình riêng
+    
+    Các hàm xử lý bên trong đọc cấu hình qua get_http_session(), get_pikbest_cookies()... nên khi
+    resolver được kích hoạt (activate) trên một luồng, mọi bước đều dùng trạng thái của resolver đó.
+    Nhờ vậy có thể chạy nhiều resolver song song trong cùng một tiến trình. Trình duyệt dùng User-Agent
+    trong headers của resolver và mỗi resolver có bộ tải trước trang riêng; cache thông tin file
+    (_recent_file_info) và session_watchdog của các chế độ dòng lệnh thì dùng chung cho cả tiến trình.
+    
+    Ví dụ:
+        with PikbestResolver(cookies=cookies) as resolver:
+            link = resolver.resolve("https://pikbest.com/templates/...-123456.html")
+    """
+    
+    def __init__(self, cookies=None, captcha_api_key=None, headers=None, profile_path=None,
+                 driver=None, driver_factory=None, url_deadline=None, session=None,
+                 failure_cache=None, clock=None, debug_dumps=True):
+        self.cookies = dict(cookies) if cookies is not None else load_cookies_from_env()
+        self.captcha_api_key = captcha_api_key if captcha_api_key is not None else os.getenv('CAPTCHA_API_KEY', '')
+        self.headers = dict(headers) if headers is not None else dict(globals()['headers'])
+        self.profile_path = profile_path if profile_path is not None else os.getenv('CHROME_PROFILE_PATH', '')
+        self.url_deadline = url_deadline
+        self.driver_factory = driver_factory
+        
+        # session/failure_cache/clock cho trước thay cho bản thật, ví dụ khi phát lại bản ghi (ReplaySession, ReplayClock)
+        if session is None:
+            session = requests.Session()
+            session.cookies.update(self.cookies)
+        self.session = session
+        self.failure_cache = failure_cache
+        self.clock = clock
+        self.debug_dumps = debug_dumps
+        self.page_prefetcher = DownloadPagePrefetcher()
+        self.manager = DriverManager(driver=driver, driver_factory=driver_factory or self._create_driver,
+                                     profile_path=self.profile_path)
+        # Một driver chỉ xử lý một URL tại một thời điểm
+        self._lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def activate(self):
+        """Dùng trạng thái của resolver này cho các hàm xử lý chạy trên luồng hiện tại"""
+        previous = current_resolver()
+        _resolver_state.resolver = self
+        try:
+            yield self
+        finally:
+            _resolver_state.resolver = previous
+    
+    def _create_driver(self, profile_path):
+        # Driver có thể được khởi tạo trong luồng nền (prewarm) nên phải kích hoạt lại resolver ở đó
+        with self.activate():
+            return create_logged_in_driver(profile_path)
+    
+    def resolve_with_driver(self, url, driver):
+        """Xử lý URL Pikbest với driver cho trước, trả về link tải đã xác minh hoặc None"""
+        with url_deadline(self.url_deadline):
+            file_id = extract_file_id(url)
+            if not file_id:
+                logger.error(f"Không tìm thấy ID trong URL: {url}")
+                print("❌ Không tìm thấy ID trong URL.")
+                return None
+
+            print(f"🔍 Đang xử lý ID: {file_id}")
+            logger.info(f"Đang xử lý ID: {file_id} từ URL: {url}")
+
+            # Hiển thị tiến trình
+            print("⏳ Đang truy cập trang download...")
+            real_url = get_real_download_link_with_driver(file_id, driver)
+            
+            if not real_url:
+                print("❌ Không tìm thấy link tải.")
+                return None
+            
+            if deadline_expired():
+                logger.warning(f"Hết thời gian xử lý trước khi xác minh link: {real_url}")
+                print("⏱️ Hết thời gian xử lý URL trước khi xác minh link.")
+                return None
+                
+            print("⏳ Đang xác minh link tải...")
+            # Xác minh link tải
+            verified_url = verify_download_link(real_url)
+            
+            if verified_url:
+                print(f"\n🎯 Link tải thật: {verified_url}")
+                
+                print("⏳ Đang lấy thông tin file...")
+                # Lấy thông tin file
+                file_info = get_file_info(verified_url)
+                remember_file_info(verified_url, file_info)
+                
+                # Hiển thị thông tin file
+                print("\n📁 Thông tin file:")
+                print(f"  • Tên file: {file_info['filename']}")
+                print(f"  • Kích thước: {file_info['size']}")
+                print(f"  • Định dạng: {file_info['format']}")
+                print(f"  • Hết hạn: {file_info['expiry']}")
+                
+                # Hiển thị cảnh báo nếu link sắp hết hạn
+                if file_info['expiry'] != "Không xác định":
+                    try:
+                        expiry_match = re.search(r'[?&]e=(\d+)', verified_url)
+                        if expiry_match:
+                            expiry_timestamp = int(expiry_match.group(1))
+                            current_time = time.time()
+                            hours_left = (expiry_timestamp - current_time) / 3600
+                            
+                            if hours_left < 24:
+                                print(f"\n⚠️ Cảnh báo: Link sẽ hết hạn trong {hours_left:.1f} giờ!")
+                            elif hours_left < 72:
+                                print(f"\n⚠️ Cảnh báo: Link sẽ hết hạn trong {hours_left/24:.1f} ngày!")
+                    except:
+                        pass
+                
+                return verified_url
+            else:
+                if real_url:
+                    logger.error(f"Tìm thấy link nhưng không hợp lệ: {real_url}")
+                    print(f"⚠️ Tìm thấy link nhưng không hợp lệ: {real_url}")
+                    print("💡 Mẹo: Link này có thể là hình ảnh hoặc tài nguyên khác, không phải file tải thật.")
+                else:
+                    logger.error("Không tìm thấy link tải thật")
+                    print("⚠️ Không tìm thấy link tải thật. Vui lòng kiểm tra lại URL hoặc đăng nhập.")
+                
+                return None
+    
+    def resolve(self, url):
+        """Lấy link tải thật (đã xác minh) cho một URL bằng driver của resolver, trả về link hoặc None"""
+        with self._lock, self.activate():
+            result = None
+            for _ in range(self.manager.max_attempts):
+                result, crashed = self.manager.process_url(url)
+                if not crashed:
+                    break
+            return result
+    
+    def find_link(self, file_id, deadline=None):
+        """Chỉ chạy bước trình duyệt cho một ID (không thử HTTP, không xác minh), trả về link hoặc None
+        
+        Dùng cho AsyncPikbestResolver: các bước HTTP đã được thực hiện bất đồng bộ ở bên ngoài.
+        deadline: số giây còn lại cho URL (mặc định theo url_deadline của resolver).
+        """
+        with self._lock, self.activate(), url_deadline(deadline if deadline is not None else self.url_deadline):
+            result = None
+            for _ in range(self.manager.max_attempts):
+                result, crashed = self.manager.run(
+                    lambda driver, file_id: get_real_download_link_with_driver(file_id, driver, False), file_id)
+                if not crashed:
+                    break
+            return result
+    
+    def spawn(self, index):
+        """Tạo resolver con cùng cấu hình nhưng có session, driver và thư mục profile riêng"""
+        profile_path = f"{self.profile_path.rstrip(os.sep)}_resolver{index}" if self.profile_path else ''
+        return PikbestResolver(cookies=self.cookies, captcha_api_key=self.captcha_api_key, headers=self.headers,
+                               profile_path=profile_path, driver_factory=self.driver_factory,
+                               url_deadline=self.url_deadline)
+    
+    def resolve_many(self, urls, concurrency=1):
+        """Lấy link cho nhiều URL, trả về danh sách link (hoặc None) theo đúng thứ tự đầu vào
+        
+        concurrency > 1 chạy thêm các resolver con trên các luồng riêng, mỗi resolver một trình duyệt.
+        """
+        urls = list(urls)
+        results = [None] * len(urls)
+        tasks = queue.Queue()
+        for index, url in enumerate(urls):
+            tasks.put((index, url))
+        
+        resolvers = [self] + [self.spawn(i) for i in range(1, min(max(1, concurrency), len(urls)))]
+        
+        def work(resolver):
+            while True:
+                try:
+                    index, url = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[index] = resolver.resolve(url)
+                except Exception as e:
+                    logger.error(f"Lỗi khi xử lý {url}: {e}", exc_info=True)
+        
+        threads = [threading.Thread(target=work, args=(resolver,), name=f"PikbestResolver-{i}", daemon=True)
+                   for i, resolver in enumerate(resolvers)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for resolver in resolvers[1:]:
+                resolver.close()
+        return results
+    
+    def close(self):
+        """Đóng trình duyệt của resolver"""
+        self.page_prefetcher.close()
+        self.manager.close()
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+def get_default_resolver():
+    """Resolver dùng cho các hàm cấp module khi không có resolver nào được kích hoạt
+    
+    Resolver này không bao giờ được kích hoạt, nên các bước xử lý dùng session, cookies chung của module.
+    """
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = PikbestResolver(cookies=PIKBEST_COOKIES, captcha_api_key=CAPTCHA_API_KEY)
+        return _default_resolver
+
+class AsyncPikbestResolver:
+    """Giao diện asyncio của PikbestResolver, không chặn event loop
+    
+    Các bước HTTP (trang download, Ajax download, HEAD kiểm tra link) chạy bất đồng bộ bằng aiohttp
+    (không có aiohttp thì chạy requests trong thread pool mặc định). Bước trình duyệt chạy trên một
+    executor riêng với tối đa max_drivers luồng, mỗi luồng một trình duyệt: hàng nghìn URL đang chờ
+    chỉ là coroutine chờ trình duyệt rảnh, không chiếm luồng nào.
+    
+    Ví dụ:
+        async with AsyncPikbestResolver(max_drivers=2) as resolver:
+            links = await resolver.resolve_many(urls)
+    """
+    
+    def __init__(self, cookies=None, captcha_api_key=None, headers=None, profile_path=None,
+                 max_drivers=None, driver_factory=None, url_deadline=None):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.resolver = PikbestResolver(cookies=cookies, captcha_api_key=captcha_api_key, headers=headers,
+                                        profile_path=profile_path, driver_factory=driver_factory,
+                                        url_deadline=url_deadline)
+        if max_drivers is None:
+            max_drivers = int(os.getenv('ASYNC_MAX_DRIVERS', '2'))
+        self.max_drivers = max(1, max_drivers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_drivers, thread_name_prefix="PikbestDriver")
+        self._resolvers = []
+        self._idle = None
+        self._http = None
+    
+    def _idle_resolvers(self):
+        # Tạo trong event loop đang chạy; trình duyệt chỉ được khởi tạo khi resolver được dùng lần đầu
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            self._resolvers = [self.resolver] + [self.resolver.spawn(i) for i in range(1, self.max_drivers)]
+            for resolver in self._resolvers:
+                self._idle.put_nowait(resolver)
+        return self._idle
+    
+    @property
+    def url_deadline(self):
+        """Thời gian xử lý tối đa của một URL, lưu trên PikbestResolver bên trong"""
+        return self.resolver.url_deadline
+    
+    def _deadline(self):
+        # Cùng quy tắc với đường đồng bộ: url_deadline của resolver, không có thì URL_DEADLINE
+        with self.resolver.activate():
+            seconds = get_url_deadline_seconds()
+        return time.time() + seconds if seconds and seconds > 0 else float('inf')
+    
+    async def _request(self, method, url, timeout, deadline):
+        """Gửi request GET/HEAD trong hạn chót, trả về (mã trạng thái, header, nội dung) hoặc None nếu lỗi"""
+        timeout = min(timeout, deadline - time.time())
+        if timeout <= 0:
+            return None
+        try:
+            if aiohttp is None:
+                def send():
+                    response = self.resolver.session.request(method, url, headers=self.resolver.headers,
+                                                             timeout=timeout, allow_redirects=method == 'GET')
+                    return response.status_code, response.headers, response.text if method == 'GET' else ''
+                return await asyncio.to_thread(send)
+            
+            if self._http is None:
+                self._http = aiohttp.ClientSession(headers=self.resolver.headers, cookies=self.resolver.cookies)
+            async with self._http.request(method, url, allow_redirects=method == 'GET',
+                                          timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                body = await response.text(errors='replace') if method == 'GET' else ''
+                return response.status, response.headers, body
+        except Exception as e:
+            logger.debug(f"Lỗi khi gửi {method} {url}: {e}")
+            return None
+    
+    async def _find_link_via_http(self, file_id, deadline):
+        """Giống resolve_download_link_via_http nhưng bất đồng bộ"""
+        response = await self._request('GET', f"https://pikbest.com/?m=download&id={file_id}&flag=1", 10, deadline)
+        if not response or response[0] != 200:
+            return None
+        
+        scan = scan_download_page(response[2])
+        if scan['hash']:
+            ajax_url = f"https://pikbest.com/?m=AjaxDownload&a=open&id={file_id}&__hash__={scan['hash']}&flag=1"
+            ajax_response = await self._request('GET', ajax_url, 15, deadline)
+            if ajax_response and ajax_response[0] == 200:
+                try:
+                    return link_from_ajax_response(json.loads(ajax_response[2]))
+                except Exception as e:
+                    logger.error(f"Lỗi khi parse Ajax response: {e}")
+        return None
+    
+    async def _find_link_with_driver(self, file_id, deadline):
+        """Chờ một trình duyệt rảnh rồi chạy bước trình duyệt trên executor riêng"""
+        idle = self._idle_resolvers()
+        resolver = await idle.get()
+        try:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, resolver.find_link, file_id,
+                                              None if remaining == float('inf') else remaining)
+        finally:
+            idle.put_nowait(resolver)
+    
+    async def resolve(self, url):
+        """Lấy link tải thật (đã xác minh) cho một URL, trả về link hoặc None"""
+        file_id = extract_file_id(url)
+        if not file_id:
+            logger.error(f"Không tìm thấy ID trong URL: {url}")
+            return None
+        
+        failure = get_failure_cache().get(file_id)
+        if failure:
+            logger.info(f"Bỏ qua ID {file_id}: đã lỗi gần đây ({failure})")
+            return None
+        
+        deadline = self._deadline()
+        link = None
+        if os.getenv('HTTP_FAST_PATH', 'true').lower() == 'true':
+            link = await self._find_link_via_http(file_id, deadline)
+        if link:
+            logger.info(f"Đã lấy link qua HTTP, không cần trình duyệt: {link}")
+            get_failure_cache().forget(file_id)
+        else:
+            link = await self._find_link_with_driver(file_id, deadline)
+        if not link:
+            return None
+        
+        # Một request HEAD dùng chung cho bước xác minh và lấy thông tin file
+        head = await self._request('HEAD', link, 5, deadline)
+        response_headers = head[1] if head else {}
+        verified_url = verify_download_link(link, response_headers=response_headers)
+        if verified_url:
+            remember_file_info(verified_url, get_file_info(verified_url, response_headers=response_headers))
+            logger.info(f"Link tải thật cho {url}: {verified_url}")
+        return verified_url
+    
+    async def resolve_many(self, urls, concurrency=None):
+        """Lấy link cho nhiều URL đồng thời, trả về danh sách link (hoặc None) theo đúng thứ tự đầu vào
+        
+        Số trình duyệt dùng cùng lúc luôn bị giới hạn bởi max_drivers; concurrency giới hạn thêm số URL
+        được xử lý cùng lúc (kể cả bước HTTP), None = không giới hạn.
+        """
+        limit = asyncio.Semaphore(concurrency) if concurrency else None
+        
+        async def resolve_one(url):
+            try:
+                if limit is None:
+                    return await self.resolve(url)
+                async with limit:
+                    return await self.resolve(url)
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý {url}: {e}", exc_info=True)
+                return None
+        
+        return await asyncio.gather(*(resolve_one(url) for url in urls))
+    
+    async def close(self):
+        """Đóng session HTTP và các trình duyệt"""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        loop = asyncio.get_running_loop()
+        for resolver in self._resolvers or [self.resolver]:
+            await loop.run_in_executor(self._executor, resolver.close)
+        self._executor.shutdown(wait=False)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+class _LineStream(io.TextIOBase):
+    """sys.stdout thay thế: gom từng dòng hoàn chỉnh (riêng cho mỗi luồng) rồi chuyển cho emit, bỏ đi nếu emit là None"""
+    
+    def __init__(self, emit=None):
+        self.emit = emit
+        self._partial = threading.local()
+    
+    def writable(self):
+        return True
+    
+    def write(self, text):
+        *lines, self._partial.text = (getattr(self._partial, 'text', '') + text).split('\n')
+        if self.emit is not None:
+            for line in lines:
+                if line.strip():
+                    self.emit(line)
+        return len(text)
+
+class BatchProgress:
+    """Bảng trạng thái trực tiếp của một batch: số URL xong, lỗi, đang xử lý, tốc độ, độ trễ p50/p95, tỉ lệ captcha, ETA
+    
+    Trên terminal (TTY) dòng trạng thái được vẽ lại tại chỗ vài lần mỗi giây, các dòng kết quả in qua
+    print() của đối tượng này nằm phía trên nó. Khi đầu ra không phải TTY (file, pipe, log của service)
+    thì chỉ in một dòng tổng kết định kỳ để không làm đầy log.
+    
+    Trong lúc dòng trạng thái đang hiển thị, print() của các bước xử lý ("⏳ Đang...") từ mọi luồng bị ẩn,
+    hoặc được in phía trên dòng trạng thái nếu verbose (PROGRESS_VERBOSE=true).
+    """
+    
+    def __init__(self, total=None, stream=None, interval=None, window=300, track_captcha=True, verbose=None):
+        self.total = total
+        self.stream = stream or sys.stdout
+        try:
+            self.live = self.stream.isatty()
+        except Exception:
+            self.live = False
+        if verbose is None:
+            verbose = os.getenv('PROGRESS_VERBOSE', 'false').lower() == 'true'
+        self.verbose = verbose
+        if interval is None:
+            interval = float(os.getenv('PROGRESS_REFRESH', '0.5') if self.live else os.getenv('PROGRESS_SUMMARY_INTERVAL', '30'))
+        self.interval = max(0.1, interval)
+        # Tốc độ tính trên các URL xong trong window giây gần nhất, phản ánh thay đổi khi thêm/bớt worker
+        self.window = window
+        self.track_captcha = track_captcha
+        self.done = 0
+        self.failed = 0
+        self.captchas = 0
+        self.in_flight = {}  # khóa -> thời điểm bắt đầu
+        self.latencies = deque(maxlen=2000)
+        self.finished_at = deque()
+        self.started_at = time.time()
+        self._captcha_keys = set()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log_filter = None
+        self._saved_stdout = None
+    
+    def begin(self, key):
+        """Bắt đầu xử lý một URL (giữ thời điểm bắt đầu của lần thử đầu tiên nếu URL được thử lại)"""
+        with self._lock:
+            self.in_flight.setdefault(key, time.time())
+    
+    def mark_captcha(self, key):
+        """URL này đã gặp captcha (tính một lần dù gặp nhiều lần)"""
+        with self._lock:
+            self._captcha_keys.add(key)
+    
+    def retry(self, key):
+        """URL được đưa vào hàng đợi thử lại: không còn đang xử lý nhưng chưa tính là xong"""
+        with self._lock:
+            self.in_flight.pop(key, None)
+    
+    def finish(self, key, ok):
+        """URL đã xử lý xong (thành công hoặc thất bại hẳn)"""
+        now = time.time()
+        with self._lock:
+            started = self.in_flight.pop(key, None)
+            if started is not None:
+                self.latencies.append(now - started)
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            if key in self._captcha_keys:
+                self._captcha_keys.discard(key)
+                self.captchas += 1
+            self.finished_at.append(now)
+    
+    def snapshot(self):
+        """Các số liệu hiện tại của batch"""
+        now = time.time()
+        with self._lock:
+            while self.finished_at and self.finished_at[0] < now - self.window:
+                self.finished_at.popleft()
+            finished = self.done + self.failed
+            span = min(self.window, now - self.started_at)
+            rate = len(self.finished_at) / span if span > 0 else 0.0
+            latencies = sorted(self.latencies)
+            in_flight = len(self.in_flight)
+            captchas = self.captchas
+        
+        def percentile(fraction):
+            return latencies[int(fraction * (len(latencies) - 1))] if latencies else None
+        
+        remaining = self.total - finished if self.total is not None else None
+        return {
+            'done': self.done,
+            'failed': self.failed,
+            'finished': finished,
+            'in_flight': in_flight,
+            'per_minute': rate * 60,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'captcha_rate': captchas / finished if self.track_captcha and finished else None,
+            'eta': remaining / rate if remaining is not None and rate > 0 else None,
+            'elapsed': now - self.started_at,
+        }
+    
+    @staticmethod
+    def _format_seconds(seconds):
+        seconds = int(seconds)
+        if seconds >= 3600:
+            return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+        if seconds >= 60:
+            return f"{seconds // 60}m{seconds % 60:02d}s"
+        return f"{seconds}s"
+    
+    def format_status(self, snap=None):
+        """Một dòng trạng thái ngắn gọn"""
+        snap = snap or self.snapshot()
+        total = self.total if self.total is not None else "?"
+        parts = [
+            f"📊 {snap['finished']}/{total}",
+            f"✅ {snap['done']} ❌ {snap['failed']} ⏳ {snap['in_flight']}",
+            f"{snap['per_minute']:.1f} URL/phút",
+        ]
+        if snap['p50'] is not None:
+            parts.append(f"p50 {snap['p50']:.1f}s p95 {snap['p95']:.1f}s")
+        if snap['captcha_rate'] is not None:
+            parts.append(f"captcha {snap['captcha_rate']:.0%}")
+        if snap['eta'] is not None:
+            parts.append(f"ETA {self._format_seconds(snap['eta'])}")
+        return " | ".join(parts)
+    
+    def _write(self, text):
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except Exception:
+            pass
+    
+    def _clear_line(self):
+        self._write("\r\x1b[K")
+    
+    def render(self):
+        """Vẽ lại dòng trạng thái tại chỗ (TTY) hoặc in một dòng tổng kết (không phải TTY)"""
+        line = self.format_status()
+        with self._lock:
+            if self.live:
+                self._write(f"\r\x1b[K{line}")
+            else:
+                self._write(f"{line}\n")
+    
+    def print(self, message):
+        """In một dòng kết quả phía trên dòng trạng thái"""
+        with self._lock:
+            if self.live:
+                self._write(f"\r\x1b[K{message}\n{self.format_status()}")
+            else:
+                self._write(f"{message}\n")
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+    
+    def start(self):
+        """Bắt đầu vẽ dòng trạng thái trong luồng nền"""
+        if self._thread is not None:
+            return self
+        if self.live:
+            # Xóa dòng trạng thái trước khi log ra console để hai loại đầu ra không dính vào nhau
+            progress = self
+            
+            class ClearStatusLine(logging.Filter):
+                def filter(self, record):
+                    with progress._lock:
+                        progress._clear_line()
+                    return True
+            
+            self._log_filter = ClearStatusLine()
+            for handler in logging.getLogger().handlers:
+                if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+                    handler.addFilter(self._log_filter)
+            # Các dòng "⏳ Đang..." của từng bước bị ẩn (hoặc in phía trên dòng trạng thái nếu verbose)
+            self._saved_stdout = sys.stdout
+            sys.stdout = _LineStream(self.print if self.verbose else None)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="BatchProgress", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        """Dừng luồng nền và in dòng tổng kết cuối cùng"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._log_filter is not None:
+            for handler in logging.getLogger().handlers:
+                handler.removeFilter(self._log_filter)
+            self._log_filter = None
+        if self._saved_stdout is not None:
+            sys.stdout = self._saved_stdout
+            self._saved_stdout = None
+        snap = self.snapshot()
+        line = self.format_status(snap)
+        with self._lock:
+            if self.live:
+                self._clear_line()
+            self._write(f"{line} | ⏱️ {self._format_seconds(snap['elapsed'])}\n")
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def _worker_profile_path(worker_id):
+    """Thư mục profile riêng cho từng tiến trình (hai Chrome không thể dùng chung một profile)"""
+    chrome_profile = os.getenv('CHROME_PROFILE_PATH', '')
+    if not chrome_profile:
+        return ''
+    return f"{chrome_profile.rstrip(os.sep)}_worker{worker_id}"
+
+def _resolver_worker(worker_id, task_queue, result_queue, quiet=False, verbose=False):
+    """Tiến trình con: tự khởi tạo driver và phiên đăng nhập, xử lý từng URL do tiến trình điều phối gửi tới
+    
+    quiet: tiến trình điều phối đang hiển thị dòng trạng thái, không in trực tiếp ra terminal;
+    verbose thì gửi từng dòng về để tiến trình điều phối in phía trên dòng trạng thái.
+    """
+    if quiet:
+        sys.stdout = _LineStream(
+            (lambda line: result_queue.put(('print', worker_id, None, (line, None, None, False)))) if verbose else None)
+    setup_logging()
+    manager = DriverManager(profile_path=_worker_profile_path(worker_id))
+    try:
+        manager.start()
+        result_queue.put(('ready', worker_id, None, (None, None, None, False)))
+        
+        session_watchdog.start()
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            index, url = task
+            login_generation = session_watchdog.before_task(manager)
+            captchas = captcha_encounters()
+            for _ in range(manager.max_attempts):
+                result, crashed = manager.process_url(url)
+                if not crashed:
+                    break
+            failure = None
+            if not result:
+                # Loại lỗi chỉ có trong tiến trình con, gửi về để tiến trình điều phối quyết định thử lại
+                failure = get_failure_cache().last_failure(extract_file_id(url))
+                if failure == FAILURE_LOGIN_EXPIRED:
+                    session_watchdog.report_expired(login_generation)
+            # Gửi kèm bản ghi đầy đủ vì thông tin file chỉ có trong tiến trình con
+            result_queue.put(('done', worker_id, index, (result, build_result_record(url, result), failure,
+                                                         captcha_encounters() > captchas)))
+    except Exception as e:
+        logger.error(f"[worker {worker_id}] Lỗi khi khởi tạo tiến trình xử lý: {e}", exc_info=True)
+    finally:
+        session_watchdog.stop()
+        manager.close()
+
+def process_urls_multiprocess(urls, workers, max_attempts=2, max_restarts=None, on_result=None):
+    """Xử lý danh sách URL trên nhiều tiến trình, mỗi tiến trình sở hữu một driver và phiên riêng
+    
+    Tiến trình điều phối giao từng URL cho tiến trình rảnh, thu kết quả theo đúng thứ tự đầu vào
+    và khởi động lại các tiến trình bị chết (URL đang xử lý dở được đưa lại vào hàng đợi).
+    URL trang danh sách/tìm kiếm được mở rộng dần thành các URL sản phẩm trong khi xử lý.
+    on_result: hàm nhận bản ghi kết quả ngay khi mỗi URL xử lý xong (theo thứ tự hoàn thành).
+    """
+    has_listing = any(is_listing_url(url) for url in urls)
+    total = "?" if has_listing else len(urls)
+    if not has_listing:
+        workers = min(workers, len(urls))
+    workers = max(1, workers)
+    if max_restarts is None:
+        max_restarts = workers * 3
+    
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    source = iter_input_urls(urls)
+    source_exhausted = False
+    url_list = []  # URL theo thứ tự nhận từ nguồn, index dùng làm khóa kết quả
+    pending = deque()  # index các URL cần xử lý lại
+    results = {}
+    attempts = {}
+    in_flight = {}  # worker_id -> index đang xử lý
+    processes = {}  # worker_id -> (process, task_queue)
+    ready_workers = set()
+    retries = RetryScheduler()
+    restarts = 0
+    progress = BatchProgress(total=None if has_listing else len(urls))
+    
+    def has_work():
+        return bool(pending) or not source_exhausted or bool(retries)
+    
+    def next_index(worker_id):
+        nonlocal source_exhausted
+        # URL lỗi đã đến lượt thử lại được ưu tiên, tránh giao lại cho worker vừa lỗi nếu chính sách yêu cầu
+        index = retries.pop_ready(worker=worker_id)
+        if index is not None:
+            return index
+        if pending:
+            return pending.popleft()
+        if not source_exhausted:
+            url = next(source, None)
+            if url is not None:
+                url_list.append(url)
+                attempts[len(url_list) - 1] = 0
+                return len(url_list) - 1
+            source_exhausted = True
+        return retries.pop_ready(worker=worker_id, drained=True)
+    
+    def start_worker(worker_id):
+        task_queue = ctx.Queue()
+        process = ctx.Process(target=_resolver_worker,
+                              args=(worker_id, task_queue, result_queue, progress.live, progress.verbose),
+                              name=f"PikbestWorker-{worker_id}", daemon=True)
+        process.start()
+        processes[worker_id] = (process, task_queue)
+        logger.info(f"Đã khởi động tiến trình xử lý #{worker_id} (pid {process.pid})")
+    
+    def dispatch(worker_id):
+        if worker_id in processes and worker_id not in in_flight:
+            index = next_index(worker_id)
+            if index is None:
+                return
+            attempts[index] += 1
+            in_flight[worker_id] = index
+            progress.begin(index)
+            processes[worker_id][1].put((index, url_list[index]))
+    
+    print(f"🚀 Đang xử lý {total} URL trên {workers} tiến trình...")
+    for worker_id in range(workers):
+        start_worker(worker_id)
+    progress.start()
+    
+    try:
+        while has_work() or in_flight:
+            try:
+                kind, worker_id, index, (result, record, failure, captcha) = result_queue.get(timeout=1)
+            except queue.Empty:
+                kind = None
+            
+            if kind == 'done':
+                if captcha:
+                    progress.mark_captcha(index)
+                if in_flight.get(worker_id) == index:
+                    in_flight.pop(worker_id)
+                    if results.get(index):
+                        # URL đã có kết quả đến muộn từ tiến trình bị coi là chết, bỏ lần xử lý trùng này
+                        dispatch(worker_id)
+                        continue
+                    delay = retries.schedule(index, index, failure, worker=worker_id) if not result else None
+                    if delay is not None:
+                        # Lỗi tạm thời: đưa vào hàng đợi thử lại, không tính là đã xong
+                        attempts[index] = 0
+                        progress.retry(index)
+                        when = "cuối batch" if delay == float('inf') else f"sau {delay:.0f} giây"
+                        progress.print(f"🔁 Lỗi '{failure}', sẽ thử lại {when}: {url_list[index]}")
+                        dispatch(worker_id)
+                        continue
+                    results[index] = result
+                    progress.finish(index, bool(result))
+                    status = "✅" if result else "❌"
+                    progress.print(f"{status} [{len(results)}/{total}] {url_list[index]}")
+                    if on_result and record:
+                        on_result(record)
+                elif result and not results.get(index):
+                    # Kết quả đến muộn từ tiến trình đã bị coi là chết: dùng luôn và bỏ URL khỏi hàng đợi
+                    # xử lý lại (nếu đang được xử lý lại thì kết quả của lần đó bị bỏ qua)
+                    first = index not in results
+                    results[index] = result
+                    if index in pending:
+                        pending.remove(index)
+                    retries.discard(index)
+                    if first:
+                        progress.finish(index, True)
+                        progress.print(f"✅ [{len(results)}/{total}] {url_list[index]}")
+                    if on_result and record:
+                        on_result(record)
+            if kind == 'print':
+                progress.print(f"[#{worker_id}] {result}")
+            if kind == 'ready':
+                ready_workers.add(worker_id)
+            if kind in ('ready', 'done'):
+                dispatch(worker_id)
+            
+            # Phát hiện tiến trình bị chết và khởi động lại
+            for worker_id, (process, _) in list(processes.items()):
+                if process.is_alive():
+                    continue
+                logger.warning(f"Tiến trình xử lý #{worker_id} đã dừng (exit code {process.exitcode})")
+                del processes[worker_id]
+                ready_workers.discard(worker_id)
+                index = in_flight.pop(worker_id, None)
+                if index is not None:
+                    if attempts[index] < max_attempts:
+                        progress.retry(index)
+                        pending.appendleft(index)
+                    else:
+                        results[index] = None
+                        progress.finish(index, False)
+                        progress.print(f"❌ [{len(results)}/{total}] {url_list[index]} (tiến trình xử lý bị lỗi)")
+                if has_work() and restarts < max_restarts:
+                    restarts += 1
+                    start_worker(worker_id)
+            
+            # Giao việc cho mọi worker đang rảnh: URL đến lượt thử lại, hoặc URL của tiến trình vừa chết
+            # (khi đã hết lượt khởi động lại thì không có tin nhắn 'ready' nào để kích hoạt việc giao)
+            for idle_worker in list(ready_workers):
+                dispatch(idle_worker)
+            
+            if has_work() and not processes:
+                logger.error("Không còn tiến trình xử lý nào hoạt động, dừng xử lý")
+                print("❌ Không còn tiến trình xử lý nào hoạt động.")
+                break
+    finally:
+        progress.stop()
+        source.close()
+        for process, task_queue in processes.values():
+            try:
+                task_queue.put(None)
+            except Exception:
+                pass
+        for process, _ in processes.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+    
+    return [{"url": url_list[i], "download_link": results[i]} for i in sorted(results) if results[i]]
+
+class SqliteWorkQueue:
+    """Hàng đợi công việc dùng chung giữa nhiều máy/tiến trình, lưu trong một file SQLite
+    
+    Mỗi node thuê (lease) file ID với thời hạn hiển thị (visibility timeout): trong thời hạn đó node khác
+    không lấy được ID này. Node đang chạy tự gia hạn định kỳ (heartbeat); node bị chết thì hết hạn thuê
+    và ID tự quay lại hàng đợi cho node khác. File ID là khóa chính nên thêm cùng một URL nhiều lần
+    hay từ nhiều node cũng không bị xử lý trùng. Dùng journal mặc định (không WAL) để file có thể
+    nằm trên thư mục chia sẻ giữa các máy.
+    """
+    
+    def __init__(self, path, node_id=None, lease_seconds=None, max_leases=None):
+        # max_leases: số lần lease của một ID được hết hạn (node giữ nó bị chết) trước khi ID bị coi là lỗi
+        self.path = path
+        self.node_id = node_id or os.getenv('QUEUE_NODE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+        if lease_seconds is None:
+            lease_seconds = float(os.getenv('QUEUE_LEASE_SECONDS', '300'))
+        if max_leases is None:
+            max_leases = int(os.getenv('QUEUE_MAX_LEASES', '3'))
+        self.lease_seconds = lease_seconds
+        # ID làm chết node nhiều lần liên tiếp bị đánh dấu lỗi thay vì làm chết lần lượt mọi node
+        self.max_leases = max(1, max_leases)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat = None
+        with self._transaction():
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    file_id TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    available_at REAL NOT NULL DEFAULT 0,
+                    deferred INTEGER NOT NULL DEFAULT 0,
+                    leases INTEGER NOT NULL DEFAULT 0,
+                    expired_leases INTEGER NOT NULL DEFAULT 0,
+                    retries INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    avoid_node TEXT,
+                    failure TEXT,
+                    download_link TEXT,
+                    record TEXT,
+                    updated_at REAL
+                )
+            """)
+            # File hàng đợi tạo bởi phiên bản trước chưa có cột expired_leases
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if 'expired_leases' not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN expired_leases INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at)")
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE giữ khóa ghi ngay từ đầu, hai node không thể cùng thuê một ID
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+    
+    def add(self, urls, batch_size=500):
+        """Thêm URL vào hàng đợi (URL trang danh sách được mở rộng), bỏ qua ID đã có; trả về số ID mới"""
+        added = 0
+        source = iter_input_urls(urls)
+        try:
+            while True:
+                rows = []
+                for url in itertools.islice(source, batch_size):
+                    file_id = extract_file_id(url)
+                    if not file_id:
+                        logger.error(f"Không tìm thấy ID trong URL: {url}")
+                        continue
+                    rows.append((file_id, url, time.time()))
+                if not rows:
+                    break
+                with self._transaction() as conn:
+                    before = conn.total_changes
+                    conn.executemany("INSERT OR IGNORE INTO jobs (file_id, url, updated_at) VALUES (?, ?, ?)", rows)
+                    added += conn.total_changes - before
+        finally:
+            source.close()
+        return added
+    
+    def lease(self, limit=1):
+        """Thuê tối đa limit ID đã đến lượt, trả về danh sách (file_id, url)
+        
+        Ưu tiên ID chưa bị hoãn đến cuối batch và ID không yêu cầu tránh node này; ID có lease đã hết hạn
+        (node giữ nó đã chết) được thuê lại như ID mới. Chỉ các lần lease hết hạn mới được tính vào max_leases,
+        các lần thuê lại sau khi thử lại bình thường (fail) thì không.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("""
+                UPDATE jobs SET status = 'failed', failure = 'lease_expired', lease_owner = NULL,
+                                expired_leases = expired_leases + 1, updated_at = ?
+                WHERE status = 'leased' AND lease_expires < ? AND expired_leases + 1 >= ?
+            """, (now, now, self.max_leases))
+            rows = conn.execute("""
+                SELECT file_id, url, status, lease_owner FROM jobs
+                WHERE (status = 'pending' AND available_at <= ?) OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY deferred, avoid_node IS ?, available_at
+                LIMIT ?
+            """, (now, now, self.node_id, limit)).fetchall()
+            for file_id, _, status, owner in rows:
+                if status == 'leased':
+                    logger.warning(f"Lease của node {owner} cho ID {file_id} đã hết hạn, thuê lại")
+                conn.execute("""
+                    UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, leases = leases + 1,
+                                    expired_leases = expired_leases + ?, updated_at = ?
+                    WHERE file_id = ?
+                """, (self.node_id, now + self.lease_seconds, int(status == 'leased'), now, file_id))
+        return [(file_id, url) for file_id, url, _, _ in rows]
+    
+    def renew(self):
+        """Gia hạn mọi lease node này đang giữ, trả về số lease được gia hạn"""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("""
+                UPDATE jobs SET lease_expires = ?, updated_at = ?
+                WHERE status = 'leased' AND lease_owner = ?
+            """, (now + self.lease_seconds, now, self.node_id))
+        return cursor.rowcount
+    
+    def complete(self, file_id, record):
+        """Lưu kết quả thành công của ID (kể cả khi lease đã hết hạn, kết quả vẫn dùng được)"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("""
+                UPDATE jobs SET status = 'done', download_link = ?, record = ?, failure = NULL,
+                                lease_owner = NULL, lease_expires = NULL, updated_at = ?
+                WHERE file_id = ? AND status != 'done'
+            """, (record.get('download_link'), json.dumps(record, ensure_ascii=False), now, file_id))
+    
+    def fail(self, file_id, failure, record=None):
+        """Báo ID bị lỗi; thử lại theo chính sách của loại lỗi như RetryScheduler
+        
+        Trả về số giây đợi (inf = cuối batch) hoặc None nếu không thử lại nữa.
+        """
+        now = time.time()
+        policy = get_retry_policies().get(failure)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT retries FROM jobs WHERE file_id = ? AND status = 'leased' AND lease_owner = ?",
+                               (file_id, self.node_id)).fetchone()
+            if row is None:
+                # Lease đã hết hạn và được node khác thuê lại, để node đó quyết định
+                logger.warning(f"Không còn giữ lease của ID {file_id}, bỏ qua kết quả lỗi")
+                return None
+            retries = row[0]
+            if policy and retries < policy['retries']:
+                delay = float('inf') if policy['delay'] is None else policy['delay'] * policy['backoff'] ** retries
+                conn.execute("""
+                    UPDATE jobs SET status = 'pending', available_at = ?, deferred = ?, retries = retries + 1,
+                                    avoid_node = ?, failure = ?, lease_owner = NULL, lease_expires = NULL,
+                                    updated_at = ?
+                    WHERE file_id = ?
+                """, (now if delay == float('inf') else now + delay, int(delay == float('inf')),
+                      self.node_id if policy['other_worker'] else None, failure, now, file_id))
+                return delay
+            conn.execute("""
+                UPDATE jobs SET status = 'failed', failure = ?, record = ?, lease_owner = NULL, lease_expires = NULL,
+                                updated_at = ?
+                WHERE file_id = ?
+            """, (failure, json.dumps(record, ensure_ascii=False) if record else None, now, file_id))
+        return None
+    
+    def release(self):
+        """Trả lại mọi lease node này đang giữ (khi dừng giữa chừng) để node khác xử lý ngay"""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("""
+                UPDATE jobs SET status = 'pending', available_at = ?, leases = MAX(0, leases - 1),
+                                lease_owner = NULL, lease_expires = NULL, updated_at = ?
+                WHERE status = 'leased' AND lease_owner = ?
+            """, (now, now, self.node_id))
+        if cursor.rowcount:
+            logger.info(f"Đã trả lại {cursor.rowcount} lease cho hàng đợi")
+        return cursor.rowcount
+    
+    def counts(self):
+        """Số ID theo trạng thái (pending, leased, done, failed)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+    
+    def has_work(self):
+        """Còn ID chưa xong (đang đợi hoặc đang được node nào đó xử lý) không"""
+        counts = self.counts()
+        return bool(counts.get('pending') or counts.get('leased'))
+    
+    def _run_heartbeat(self):
+        while not self._heartbeat_stop.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning(f"Không gia hạn được lease: {e}")
+    
+    def start_heartbeat(self):
+        """Gia hạn lease trong luồng nền, mỗi 1/3 thời hạn thuê"""
+        if self._heartbeat is None:
+            self._heartbeat_stop.clear()
+            self._heartbeat = threading.Thread(target=self._run_heartbeat, name="QueueHeartbeat", daemon=True)
+            self._heartbeat.start()
+    
+    def close(self):
+        """Dừng heartbeat, trả lại lease còn giữ và đóng kết nối"""
+        self._heartbeat_stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            self.release()
+        finally:
+            self._conn.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def run_queue_node(work_queue, manager, sink=None, poll_interval=None):
+    """Xử lý ID từ hàng đợi dùng chung cho đến khi mọi ID đã xong (kể cả ID do node khác đang giữ)
+    
+    Chạy cùng một file hàng đợi trên nhiều máy để chia việc tự động; thêm node là tăng tốc độ xử lý.
+    """
+    if poll_interval is None:
+        poll_interval = float(os.getenv('QUEUE_POLL_INTERVAL', '5'))
+    progress = BatchProgress()
+    work_queue.start_heartbeat()
+    print(f"🚀 Node {work_queue.node_id} đang xử lý hàng đợi {work_queue.path}: {work_queue.counts()}")
+    progress.start()
+    try:
+        while True:
+            jobs = work_queue.lease()
+            if not jobs:
+                if not work_queue.has_work():
+                    break
+                # Các ID còn lại đang do node khác xử lý hoặc đang đợi thử lại
+                time.sleep(poll_interval)
+                continue
+            
+            file_id, url = jobs[0]
+            progress.begin(file_id)
+            login_generation = session_watchdog.before_task(manager)
+            captchas = captcha_encounters()
+            result = None
+            for _ in range(manager.max_attempts):
+                result, crashed = manager.process_url(url)
+                if not crashed:
+                    break
+            if captcha_encounters() > captchas:
+                progress.mark_captcha(file_id)
+            
+            record = build_result_record(url, result)
+            if result:
+                work_queue.complete(file_id, record)
+            else:
+                failure = get_failure_cache().last_failure(file_id) or FAILURE_UNKNOWN
+                if failure == FAILURE_LOGIN_EXPIRED:
+                    session_watchdog.report_expired(login_generation)
+                delay = work_queue.fail(file_id, failure, record)
+                if delay is not None:
+                    progress.retry(file_id)
+                    when = "cuối batch" if delay == float('inf') else f"sau {delay:.0f} giây"
+                    progress.print(f"🔁 Lỗi '{failure}', sẽ thử lại {when}: {url}")
+                    continue
+            
+            progress.finish(file_id, bool(result))
+            progress.print(f"{'✅' if result else '❌'} {url}" + (f" -> {result}" if result else ""))
+            if sink:
+                sink.write(record)
+        counts = work_queue.counts()
+    finally:
+        progress.stop()
+        work_queue.close()
+    print(f"📋 Hàng đợi đã xử lý xong: {counts}")
+
+def load_links_from_results(path):
+    """Đọc các cặp (URL gốc, link tải) từ file kết quả dạng .txt (save_results_to_file), .jsonl hoặc .csv"""
+    links = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            if path.lower().endswith('.csv'):
+                for record in csv.DictReader(f):
+                    if record.get('download_link'):
+                        links.append({'url': record.get('url'), 'download_link': record['download_link']})
+            elif path.lower().endswith('.jsonl'):
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Bỏ qua dòng JSON không hợp lệ trong {path}")
+                        continue
+                    if record.get('download_link'):
+                        links.append({'url': record.get('url'), 'download_link': record['download_link']})
+            else:
+                original_url = None
+                for line in f:
+                    line = line.strip()
+                    match = re.match(r'(?:\d+\.\s*)?Original URL:\s*(\S+)', line)
+                    if match:
+                        original_url = match.group(1)
+                        continue
+                    match = re.match(r'Download Link:\s*(\S+)', line)
+                    if match:
+                        links.append({'url': original_url, 'download_link': match.group(1)})
+                        original_url = None
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc file kết quả {path}: {e}")
+        print(f"❌ Lỗi khi đọc file kết quả {path}: {e}")
+    return links
+
+def probe_link(url, http=None, soon_hours=24):
+    """Kiểm tra nhanh một link tải bằng HEAD: alive, soon (sắp hết hạn), expired hoặc dead"""
+    http = http or session
+    result = {'download_link': url, 'status': 'dead', 'http_status': None, 'hours_left': None, 'size': None}
+    
+    expiry_timestamp = get_link_expiry(url)
+    if expiry_timestamp:
+        result['hours_left'] = (expiry_timestamp - time.time()) / 3600
+        if result['hours_left'] <= 0:
+            # Đã quá thời điểm hết hạn, không cần gửi request
+            result['status'] = 'expired'
+            return result
+    
+    try:
+        response = http.head(url, headers=get_http_headers(), timeout=5, allow_redirects=True)
+        result['http_status'] = response.status_code
+        content_length = response.headers.get('Content-Length')
+        if content_length:
+            result['size'] = f"{int(content_length) / (1024 * 1024):.2f} MB"
+        if response.status_code < 400:
+            if result['hours_left'] is not None and result['hours_left'] < soon_hours:
+                result['status'] = 'soon'
+            else:
+                result['status'] = 'alive'
+        elif response.status_code in (403, 410) and expiry_timestamp:
+            # Máy chủ từ chối link có chữ ký, thường là do hết hạn
+            result['status'] = 'expired'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+def check_saved_links(paths, workers=None, soon_hours=None):
+    """Kiểm tra đồng thời tất cả link trong các file kết quả và báo cáo link còn sống, hết hạn, sắp hết hạn"""
+    from concurrent.futures import ThreadPoolExecutor
+    
+    if workers is None:
+        workers = int(os.getenv('CHECK_WORKERS', '32'))
+    if soon_hours is None:
+        soon_hours = float(os.getenv('CHECK_SOON_HOURS', '24'))
+    
+    links = []
+    seen = set()
+    for path in paths:
+        for entry in load_links_from_results(path):
+            if entry['download_link'] not in seen:
+                seen.add(entry['download_link'])
+                links.append(entry)
+    if not links:
+        print("❌ Không tìm thấy link nào trong các file đã cho.")
+        return []
+    
+    # Session riêng với connection pool đủ lớn cho số luồng kiểm tra
+    check_session = requests.Session()
+    check_session.cookies.update(session.cookies)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    check_session.mount('http://', adapter)
+    check_session.mount('https://', adapter)
+    
+    print(f"🔎 Đang kiểm tra {len(links)} link với {workers} luồng...")
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        probes = list(executor.map(lambda entry: probe_link(entry['download_link'], check_session, soon_hours), links))
+    check_session.close()
+    
+    results = []
+    counts = {}
+    for entry, probe in zip(links, probes):
+        probe['url'] = entry['url']
+        results.append(probe)
+        counts[probe['status']] = counts.get(probe['status'], 0) + 1
+    
+    labels = [
+        ('alive', '✅ Còn sống'),
+        ('soon', '⚠️ Sắp hết hạn'),
+        ('expired', '⌛ Đã hết hạn'),
+        ('dead', '❌ Không truy cập được'),
+        ('error', '❌ Lỗi khi kiểm tra'),
+    ]
+    print("\n" + "="*60)
+    print("📋 KẾT QUẢ KIỂM TRA LINK".center(60))
+    print("="*60)
+    for status, label in labels:
+        print(f"{label}: {counts.get(status, 0)}")
+    
+    for status, label in labels[1:]:
+        entries = [r for r in results if r['status'] == status]
+        if not entries:
+            continue
+        print(f"\n{label}:")
+        for r in entries:
+            if status == 'soon':
+                detail = f"còn {r['hours_left']:.1f} giờ"
+            elif status == 'expired' and r['hours_left'] is not None and r['hours_left'] <= 0:
+                detail = f"hết hạn {-r['hours_left']:.1f} giờ trước"
+            else:
+                detail = r.get('error') or f"HTTP {r['http_status']}"
+            print(f"  • {r['url'] or r['download_link']} ({detail})")
+    
+    print(f"\n⏱️ Đã kiểm tra {len(links)} link trong {time.time() - start_time:.1f} giây")
+    return results
+
+def is_listing_url(url):
+    """URL Pikbest không phải trang sản phẩm (trang danh mục hoặc kết quả tìm kiếm)"""
+    return 'pikbest.com' in url.lower() and not extract_file_id(url)
+
+def extract_item_urls(html, base_url):
+    """Lấy các URL trang sản phẩm (có ID) từ HTML của trang danh sách"""
+    from urllib.parse import urljoin
+    
+    item_urls = []
+    for href in re.findall(r'href=["\']([^"\'#]+?\.html)(?:\?[^"\']*)?["\']', html):
+        url = urljoin(base_url, href)
+        if 'pikbest.com' in url and extract_file_id(url):
+            item_urls.append(url)
+    return item_urls
+
+def find_next_page_url(html, current_url):
+    """Tìm URL trang kế tiếp của trang danh sách (rel="next", nút next hoặc tham số page)"""
+    from urllib.parse import urljoin
+    
+    patterns = [
+        r'<link[^>]+rel=["\']next["\'][^>]*href=["\']([^"\']+)["\']',
+        r'<link[^>]+href=["\']([^"\']+)["\'][^>]*rel=["\']next["\']',
+        r'<a[^>]+class=["\'][^"\']*next[^"\']*["\'][^>]*href=["\']([^"\']+)["\']',
+        r'<a[^>]+href=["\']([^"\']+)["\'][^>]*class=["\'][^"\']*next[^"\']*["\']',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, html, re.IGNORECASE)
+        if match and not match.group(1).startswith('javascript'):
+            return urljoin(current_url, match.group(1).replace('&amp;', '&'))
+    
+    # Không có liên kết trang sau, thử tăng tham số page/p nếu URL đã có
+    match = re.search(r'([?&](?:page|p)=)(\d+)', current_url)
+    if match:
+        return current_url[:match.start()] + f"{match.group(1)}{int(match.group(2)) + 1}" + current_url[match.end():]
+    return None
+
+def crawl_listing(listing_url, limit=None, prefetch_pages=None, max_pages=None):
+    """Duyệt trang danh mục/tìm kiếm qua HTTP và trả về dần các URL sản phẩm
+    
+    Một luồng nền tải trước các trang kế tiếp (tối đa prefetch_pages trang) trong khi các URL
+    đã trả về đang được xử lý. Dừng khi đủ limit URL, hết trang hoặc đạt max_pages.
+    """
+    if limit is None:
+        limit = int(os.getenv('CRAWL_LIMIT', '500'))
+    if prefetch_pages is None:
+        prefetch_pages = int(os.getenv('CRAWL_PREFETCH_PAGES', '2'))
+    if max_pages is None:
+        max_pages = int(os.getenv('CRAWL_MAX_PAGES', '100'))
+    
+    pages = queue.Queue(maxsize=max(1, prefetch_pages))
+    stop = threading.Event()
+    
+    def fetch_pages():
+        url = listing_url
+        visited = set()
+        try:
+            while url and url not in visited and len(visited) < max_pages and not stop.is_set():
+                visited.add(url)
+                logger.info(f"Đang tải trang danh sách: {url}")
+                try:
+                    response = get_http_session().get(url, headers=get_http_headers(), timeout=15)
+                    response.raise_for_status()
+                except Exception as e:
+                    logger.error(f"Lỗi khi tải trang danh sách {url}: {e}")
+                    break
+                html = response.text
+                page_items = extract_item_urls(html, url)
+                next_url = find_next_page_url(html, url)
+                # Chặn ở đây khi đã tải trước đủ số trang
+                while not stop.is_set():
+                    try:
+                        pages.put(page_items, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if not page_items:
+                    break
+                url = next_url
+        finally:
+            # Báo hết trang cho bên đọc (bỏ qua nếu bên đọc đã dừng)
+            while True:
+                try:
+                    pages.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    if stop.is_set():
+                        break
+    
+    fetcher = threading.Thread(target=fetch_pages, name="ListingCrawler", daemon=True)
+    fetcher.start()
+    
+    seen = set()
+    count = 0
+    try:
+        while count < limit:
+            page_items = pages.get()
+            if page_items is None:
+                break
+            for item_url in page_items:
+                file_id = extract_file_id(item_url)
+                if file_id in seen:
+                    continue
+                seen.add(file_id)
+                count += 1
+                yield item_url
+                if count >= limit:
+                    break
+    finally:
+        stop.set()
+        # Giải phóng luồng tải trang nếu nó đang chờ chỗ trống trong hàng đợi
+        try:
+            while True:
+                pages.get_nowait()
+        except queue.Empty:
+            pass
+        logger.info(f"Đã lấy {count} URL sản phẩm từ trang danh sách: {listing_url}")
+
+def iter_input_urls(urls, limit=None):
+    """Trả về dần các URL cần xử lý, mở rộng URL trang danh sách thành các URL sản phẩm"""
+    for url in urls:
+        if is_listing_url(url):
+            print(f"📄 Đang lấy danh sách sản phẩm từ: {url}")
+            yield from crawl_listing(url, limit=limit)
+        else:
+            yield url
+
+_PIPELINE_DONE = object()  # Tín hiệu kết thúc truyền qua các hàng đợi của pipeline
+
+def _pipeline_put(stage_queue, item, stop):
+    """Đưa item vào hàng đợi có giới hạn; chặn khi đầy (backpressure) cho đến khi có chỗ hoặc pipeline dừng"""
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _pipeline_get(stage_queue, stop):
+    """Lấy item từ hàng đợi, trả về _PIPELINE_DONE nếu pipeline dừng"""
+    while not stop.is_set():
+        try:
+            return stage_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_DONE
+
+def _verify_stage(url, file_id, real_url):
+    """Giai đoạn xác minh: kiểm tra link tải và lấy thông tin file, trả về bản ghi kết quả"""
+    verified_url = verify_download_link(real_url) if real_url else None
+    file_info = None
+    if verified_url:
+        file_info = get_file_info(verified_url)
+        remember_file_info(verified_url, file_info)
+    elif real_url:
+        logger.error(f"Tìm thấy link nhưng không hợp lệ: {real_url}")
+    return build_result_record(url, verified_url, file_info)
+
+def run_pipeline(urls, drivers=None, verify_workers=None, queue_size=None, sink=None):
+    """Xử lý URL theo pipeline: phân tích/lọc trùng -> lấy link (trình duyệt) -> xác minh/lấy thông tin -> ghi kết quả
+    
+    Mỗi giai đoạn có số luồng riêng và được nối bằng hàng đợi có giới hạn, nên khi giai đoạn sau
+    chậm thì giai đoạn trước tự dừng lại (backpressure) thay vì dồn dữ liệu vào bộ nhớ.
+    Trình duyệt không phải đợi các request HEAD và mạng không rảnh khi trình duyệt đang tải trang.
+    """
+    if drivers is None:
+        drivers = int(os.getenv('PIPELINE_DRIVERS', '1'))
+    if verify_workers is None:
+        verify_workers = int(os.getenv('PIPELINE_VERIFY_WORKERS', '4'))
+    if queue_size is None:
+        queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '16'))
+    drivers = max(1, drivers)
+    verify_workers = max(1, verify_workers)
+    
+    resolve_queue = queue.Queue(maxsize=queue_size)
+    verify_queue = queue.Queue(maxsize=queue_size)
+    sink_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    results = []
+    stats = {'parsed': 0, 'done': 0, 'ok': 0, 'failed_resolvers': 0}
+    stats_lock = threading.Lock()
+    progress = BatchProgress(total=None if any(is_listing_url(url) for url in urls) else len(urls))
+    
+    def parse_stage():
+        """Giai đoạn 1: lấy file ID từ URL và bỏ các ID trùng"""
+        seen = set()
+        source = iter_input_urls(urls)
+        try:
+            for url in source:
+                file_id = extract_file_id(url)
+                if not file_id:
+                    logger.error(f"Không tìm thấy ID trong URL: {url}")
+                    if not _pipeline_put(sink_queue, build_result_record(url, None), stop):
+                        break
+                    continue
+                if file_id in seen:
+                    logger.info(f"Bỏ qua ID trùng lặp: {file_id}")
+                    continue
+                seen.add(file_id)
+                stats['parsed'] += 1
+                if not _pipeline_put(resolve_queue, (url, file_id), stop):
+                    break
+        finally:
+            source.close()
+            for _ in range(drivers):
+                _pipeline_put(resolve_queue, _PIPELINE_DONE, stop)
+    
+    def resolve_stage(worker_id):
+        """Giai đoạn 2: mỗi luồng sở hữu một trình duyệt và lấy link tải thật cho từng file ID"""
+        manager = DriverManager(profile_path=_worker_profile_path(worker_id))
+        try:
+            manager.start()
+            while True:
+                item = _pipeline_get(resolve_queue, stop)
+                if item is _PIPELINE_DONE:
+                    break
+                url, file_id = item
+                progress.begin(url)
+                login_generation = session_watchdog.before_task(manager)
+                captchas = captcha_encounters()
+                for _ in range(manager.max_attempts):
+                    real_url, crashed = manager.run(
+                        lambda driver, file_id: get_real_download_link_with_driver(file_id, driver), file_id)
+                    if not crashed:
+                        break
+                if captcha_encounters() > captchas:
+                    progress.mark_captcha(url)
+                if not real_url and get_failure_cache().last_failure(file_id) == FAILURE_LOGIN_EXPIRED:
+                    session_watchdog.report_expired(login_generation)
+                if not _pipeline_put(verify_queue, (url, file_id, real_url), stop):
+                    break
+        except Exception as e:
+            logger.error(f"[pipeline] Lỗi ở luồng lấy link #{worker_id}: {e}", exc_info=True)
+            with stats_lock:
+                stats['failed_resolvers'] += 1
+                if stats['failed_resolvers'] >= drivers:
+                    # Không còn trình duyệt nào, dừng pipeline thay vì để giai đoạn phân tích bị chặn mãi
+                    logger.error("[pipeline] Không còn trình duyệt nào hoạt động, dừng pipeline")
+                    stop.set()
+        finally:
+            manager.close()
+    
+    def verify_stage():
+        """Giai đoạn 3: xác minh link và lấy thông tin file bằng request HEAD"""
+        while True:
+            item = _pipeline_get(verify_queue, stop)
+            if item is _PIPELINE_DONE:
+                break
+            try:
+                record = _verify_stage(*item)
+            except Exception as e:
+                logger.error(f"[pipeline] Lỗi khi xác minh {item[0]}: {e}")
+                record = build_result_record(item[0], None)
+            if not _pipeline_put(sink_queue, record, stop):
+                break
+    
+    def sink_stage():
+        """Giai đoạn 4: ghi kết quả và hiển thị tiến trình"""
+        while True:
+            record = _pipeline_get(sink_queue, stop)
+            if record is _PIPELINE_DONE:
+                break
+            stats['done'] += 1
+            progress.finish(record['url'], bool(record['download_link']))
+            if record['download_link']:
+                stats['ok'] += 1
+                results.append({"url": record['url'], "download_link": record['download_link']})
+                progress.print(f"✅ [{stats['done']}] {record['url']} -> {record['download_link']}")
+            else:
+                progress.print(f"❌ [{stats['done']}] {record['url']}")
+            if sink:
+                sink.write(record)
+    
+    def start(target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        return thread
+    
+    print(f"🚀 Pipeline: {drivers} trình duyệt lấy link, {verify_workers} luồng xác minh")
+    start_time = time.time()
+    progress.start()
+    parse_thread = start(parse_stage, "Pipeline-parse")
+    resolve_threads = [start(resolve_stage, f"Pipeline-resolve-{i}", i) for i in range(drivers)]
+    verify_threads = [start(verify_stage, f"Pipeline-verify-{i}") for i in range(verify_workers)]
+    sink_thread = start(sink_stage, "Pipeline-sink")
+    
+    try:
+        # Đóng từng giai đoạn theo thứ tự, truyền tín hiệu kết thúc xuống giai đoạn sau
+        parse_thread.join()
+        for thread in resolve_threads:
+            thread.join()
+        for _ in verify_threads:
+            _pipeline_put(verify_queue, _PIPELINE_DONE, stop)
+        for thread in verify_threads:
+            thread.join()
+        _pipeline_put(sink_queue, _PIPELINE_DONE, stop)
+        sink_thread.join()
+    except KeyboardInterrupt:
+        print("\nĐang dừng pipeline...")
+        stop.set()
+        for thread in [parse_thread, *resolve_threads, *verify_threads, sink_thread]:
+            thread.join(timeout=30)
+    finally:
+        progress.stop()
+    
+    elapsed = time.time() - start_time
+    print(f"\n⏱️ Pipeline xử lý {stats['done']} URL ({stats['ok']} thành công) trong {elapsed:.1f} giây")
+    return results
+
+def resolve_in_tabs(driver, file_ids, tabs=None, ready_timeout=None, on_result=None):
+    """Lấy link cho nhiều file ID cùng lúc trên nhiều tab của một trình duyệt
+    
+    Mỗi tab được theo dõi bằng window handle: tất cả các tab bắt đầu tải trang song song,
+    tab nào sẵn sàng trước thì được chuyển ngữ cảnh vào để lấy link. Trả về dict file_id -> link
+    (file ID chưa xử lý xong khi trình duyệt gặp lỗi sẽ không có trong kết quả).
+    """
+    if tabs is None:
+        tabs = int(os.getenv('BROWSER_TABS', '4'))
+    if ready_timeout is None:
+        ready_timeout = float(os.getenv('PAGE_READY_TIMEOUT', '15'))
+    url_limit = get_url_deadline_seconds()
+    tabs = max(1, tabs)
+    
+    source = iter(file_ids)
+    main_handle = driver.current_window_handle
+    handles = [main_handle]
+    for _ in range(tabs - 1):
+        driver.switch_to.new_window('tab')
+        # Chặn tài nguyên áp dụng theo từng tab
+        apply_resource_blocking(driver)
+        handles.append(driver.current_window_handle)
+    logger.info(f"Đã mở {len(handles)} tab để xử lý song song")
+    
+    results = {}
+    active = {}  # handle -> (file_id, thời điểm bắt đầu)
+    source_exhausted = False
+    try:
+        while True:
+            # Giao file ID mới cho các tab đang rảnh
+            for handle in handles:
+                if handle in active or source_exhausted:
+                    continue
+                file_id = next(source, None)
+                # ID vừa lỗi xác định thì trả kết quả ngay, không chiếm tab
+                while file_id is not None and get_failure_cache().get(file_id):
+                    logger.info(f"Bỏ qua ID {file_id}: đã lỗi gần đây ({get_failure_cache().get(file_id)})")
+                    results[file_id] = None
+                    if on_result:
+                        on_result(file_id, None)
+                    file_id = next(source, None)
+                if file_id is None:
+                    source_exhausted = True
+                    break
+                driver.switch_to.window(handle)
+                open_download_page(file_id, driver, wait=False)
+                active[handle] = (file_id, time.time())
+            
+            if not active:
+                break
+            
+            # Chuyển vào tab nào đã sẵn sàng (hoặc hết thời gian chờ) để lấy link
+            progressed = False
+            for handle, (file_id, started_at) in list(active.items()):
+                driver.switch_to.window(handle)
+                # Tab được dùng lại vẫn hiện trang của ID trước cho đến khi điều hướng xong, nên phải kiểm tra đúng ID
+                signal = check_download_page_ready(driver, file_id)
+                if signal not in DOWNLOAD_PAGE_READY_SIGNALS and time.time() - started_at < ready_timeout:
+                    continue
+                print(f"⏳ [tab {handles.index(handle) + 1}] Đang lấy link cho ID: {file_id}")
+                # Hạn chót tính từ lúc tab bắt đầu tải trang
+                remaining = url_limit - (time.time() - started_at) if url_limit > 0 else 0
+                snapshot = _failure_snapshot(driver)
+                with url_deadline(max(0.01, remaining) if url_limit > 0 else 0):
+                    link = extract_download_link_from_page(file_id, driver)
+                if not link:
+                    get_failure_cache().record(file_id, classify_download_failure(driver, snapshot))
+                results[file_id] = link
+                del active[handle]
+                progressed = True
+                if on_result:
+                    on_result(file_id, link)
+            if not progressed:
+                time.sleep(0.2)
+    finally:
+        # Đóng các tab phụ và quay lại tab chính
+        for handle in handles[1:]:
+            try:
+                driver.switch_to.window(handle)
+                driver.close()
+            except Exception:
+                pass
+        try:
+            driver.switch_to.window(main_handle)
+        except Exception:
+            pass
+    return results
+
+def process_urls_in_tabs(urls, manager, tabs, sink=None):
+    """Xử lý danh sách URL bằng nhiều tab trong trình duyệt do manager quản lý, xác minh ngay khi có link"""
+    url_by_id = {}
+    
+    def file_ids():
+        for url in iter_input_urls(urls):
+            file_id = extract_file_id(url)
+            if not file_id:
+                logger.error(f"Không tìm thấy ID trong URL: {url}")
+                print(f"❌ Không tìm thấy ID trong URL: {url}")
+                continue
+            if file_id in url_by_id:
+                continue
+            url_by_id[file_id] = url
+            yield file_id
+    
+    def started(file_ids):
+        # ID được lấy ra khi có tab rảnh, tính là bắt đầu xử lý từ lúc đó
+        for file_id in file_ids:
+            progress.begin(file_id)
+            yield file_id
+    
+    results = []
+    handled = set()
+    # Các tab dùng chung một luồng nên không biết captcha thuộc tab nào, không thống kê tỉ lệ captcha
+    progress = BatchProgress(total=None if any(is_listing_url(url) for url in urls) else len(urls),
+                             track_captcha=False)
+    
+    def on_result(file_id, real_url):
+        handled.add(file_id)
+        record = _verify_stage(url_by_id[file_id], file_id, real_url)
+        progress.finish(file_id, bool(record['download_link']))
+        if record['download_link']:
+            results.append({"url": record['url'], "download_link": record['download_link']})
+            progress.print(f"✅ [{len(handled)}] {record['url']} -> {record['download_link']}")
+        else:
+            progress.print(f"❌ [{len(handled)}] {record['url']}")
+        if sink:
+            sink.write(record)
+    
+    source = file_ids()
+    with progress:
+        # Chỉ bỏ cuộc khi trình duyệt lỗi max_attempts lần liên tiếp mà không xử lý thêm được ID nào
+        failures = 0
+        while True:
+            handled_before = len(handled)
+            try:
+                resolve_in_tabs(manager.start(), started(source), tabs, on_result=on_result)
+                break
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý nhiều tab: {e}", exc_info=True)
+            failures = 0 if len(handled) > handled_before else failures + 1
+            if not manager.is_alive():
+                manager.recycle("trình duyệt bị chết")
+            # Xử lý lại các ID đang dở trước, sau đó đến phần còn lại của danh sách
+            unfinished = [file_id for file_id in url_by_id if file_id not in handled]
+            source = itertools.chain(unfinished, source)
+            if failures >= manager.max_attempts:
+                # Báo lỗi cho mọi ID còn lại thay vì bỏ chúng khỏi kết quả mà không thông báo
+                logger.error("Trình duyệt lỗi liên tiếp, dừng xử lý nhiều tab và đánh dấu lỗi các ID còn lại")
+                print("❌ Trình duyệt lỗi liên tiếp, các ID còn lại được đánh dấu lỗi.")
+                for file_id in source:
+                    if file_id not in handled:
+                        on_result(file_id, None)
+                break
+    return results
+
+class LinkRefresher:
+    """Làm mới link tải trong nền trước khi hết hạn, dùng hàng đợi ưu tiên theo thời điểm hết hạn"""
+
+    def __init__(self, store_path, resolve_func, refresh_window=None, min_interval=None, retry_delay=None):
+        self.store_path = store_path
+        # resolve_func nhận URL gốc và trả về link tải mới (hoặc None nếu thất bại)
+        self.resolve_func = resolve_func
+        # Khoảng thời gian trước khi hết hạn mà link sẽ được làm mới
+        if refresh_window is None:
+            refresh_window = float(os.getenv('REFRESH_WINDOW_HOURS', '6')) * 3600
+        self.refresh_window = refresh_window
+        # Khoảng cách tối thiểu giữa hai lần lấy lại link để tránh dồn thành từng đợt
+        if min_interval is None:
+            min_interval = float(os.getenv('REFRESH_MIN_INTERVAL', '30'))
+        self.min_interval = min_interval
+        if retry_delay is None:
+            retry_delay = float(os.getenv('REFRESH_RETRY_DELAY', '300'))
+        self.retry_delay = retry_delay
+        
+        self.links = {}  # file_id -> {url, download_link, expires_at, refresh_at, refreshed_at}
+        self._heap = []  # (refresh_at, file_id), các mục cũ bị bỏ qua khi lấy ra
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_run = 0
+        self.load()
+
+    def _schedule_time(self, expires_at):
+        """Tính thời điểm làm mới, rải ngẫu nhiên trong nửa đầu của cửa sổ làm mới"""
+        now = time.time()
+        if not expires_at:
+            # Link không có tham số e=, làm mới định kỳ theo cửa sổ
+            return now + self.refresh_window
+        window_start = expires_at - self.refresh_window
+        refresh_at = window_start + random.uniform(0, self.refresh_window / 2)
+        return max(now, refresh_at)
+
+    def _schedule(self, file_id, refresh_at):
+        """Đưa file ID vào hàng đợi ưu tiên (phải giữ lock)"""
+        self.links[file_id]['refresh_at'] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, file_id))
+        self._wakeup.set()
+
+    def load(self):
+        """Đọc tập link đã lưu và lập lịch làm mới"""
+        if not os.path.exists(self.store_path):
+            return
+        try:
+            with open(self.store_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except Exception as e:
+            logger.error(f"Lỗi khi đọc file lưu link {self.store_path}: {e}")
+            return
+        
+        with self._lock:
+            for file_id, entry in stored.items():
+                self.links[file_id] = entry
+                if entry.get('download_link'):
+                    refresh_at = entry.get('refresh_at') or self._schedule_time(entry.get('expires_at'))
+                else:
+                    refresh_at = time.time()
+                self._schedule(file_id, refresh_at)
+        logger.info(f"Đã nạp {len(self.links)} link từ {self.store_path}")
+
+    def save(self):
+        """Ghi tập link ra file (ghi file tạm rồi thay thế để tránh hỏng dữ liệu)"""
+        with self._lock:
+            data = json.dumps(self.links, ensure_ascii=False, indent=2)
+        temp_path = f"{self.store_path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(temp_path, self.store_path)
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu file link {self.store_path}: {e}")
+
+    def add(self, url, download_link=None):
+        """Thêm URL vào tập cần giữ mới; nếu chưa có link tải thì lấy link ngay"""
+        file_id = extract_file_id(url)
+        if not file_id:
+            logger.error(f"Không tìm thấy ID trong URL: {url}")
+            return None
+        
+        with self._lock:
+            entry = self.links.get(file_id)
+            if entry and not download_link:
+                return file_id
+            expires_at = get_link_expiry(download_link)
+            self.links[file_id] = {
+                'url': url,
+                'download_link': download_link,
+                'expires_at': expires_at,
+                'refreshed_at': time.time() if download_link else None,
+            }
+            refresh_at = self._schedule_time(expires_at) if download_link else time.time()
+            self._schedule(file_id, refresh_at)
+        self.save()
+        return file_id
+
+    def get_link(self, file_id):
+        """Trả về link tải còn hạn của file ID (không chờ lấy lại link)"""
+        with self._lock:
+            entry = self.links.get(file_id)
+            if not entry or not entry.get('download_link'):
+                return None
+            expires_at = entry.get('expires_at')
+            if expires_at and expires_at <= time.time():
+                return None
+            return entry['download_link']
+
+    def _pop_due(self):
+        """Lấy file ID đến hạn làm mới, hoặc trả về số giây cần đợi"""
+        with self._lock:
+            while self._heap:
+                refresh_at, file_id = self._heap[0]
+                entry = self.links.get(file_id)
+                if not entry or entry.get('refresh_at') != refresh_at:
+                    # Mục đã bị lập lịch lại, bỏ qua
+                    heapq.heappop(self._heap)
+                    continue
+                now = time.time()
+                wait_time = max(refresh_at, self._last_run + self.min_interval) - now
+                if wait_time > 0:
+                    return None, wait_time
+                heapq.heappop(self._heap)
+                return file_id, 0
+        return None, None
+
+    def refresh(self, file_id):
+        """Lấy lại link tải cho một file ID và lập lịch lần làm mới tiếp theo"""
+        with self._lock:
+            entry = dict(self.links.get(file_id) or {})
+        if not entry:
+            return None
+        
+        logger.info(f"Đang làm mới link cho ID: {file_id}")
+        self._last_run = time.time()
+        try:
+            new_link = self.resolve_func(entry['url'])
+        except Exception as e:
+            logger.error(f"Lỗi khi làm mới link cho ID {file_id}: {e}")
+            new_link = None
+        
+        with self._lock:
+            if file_id not in self.links:
+                return None
+            if new_link:
+                expires_at = get_link_expiry(new_link)
+                self.links[file_id].update({
+                    'download_link': new_link,
+                    'expires_at': expires_at,
+                    'refreshed_at': time.time(),
+                })
+                self._schedule(file_id, self._schedule_time(expires_at))
+                logger.info(f"Đã làm mới link cho ID {file_id}, hết hạn: {expires_at}")
+            else:
+                logger.warning(f"Không thể làm mới link cho ID {file_id}, sẽ thử lại sau {self.retry_delay:.0f} giây")
+                self._schedule(file_id, time.time() + self.retry_delay)
+        self.save()
+        return new_link
+
+    def _run(self):
+        """Vòng lặp nền xử lý hàng đợi làm mới"""
+        while not self._stop.is_set():
+            file_id, wait_time = self._pop_due()
+            if file_id:
+                self.refresh(file_id)
+                continue
+            # Đợi đến lần làm mới tiếp theo hoặc đến khi có link mới được thêm
+            self._wakeup.wait(min(wait_time, 60) if wait_time is not None else 60)
+            self._wakeup.clear()
+
+    def start(self):
+        """Chạy bộ làm mới trong luồng nền"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="LinkRefresher", daemon=True)
+        self._thread.start()
+        logger.info(f"Đã khởi động bộ làm mới link (cửa sổ: {self.refresh_window / 3600:.1f} giờ)")
+
+    def stop(self):
+        """Dừng luồng nền và lưu trạng thái"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.save()
+
+def run_link_refresher(manager, store_path, urls=None):
+    """Chạy bộ làm mới link với driver đang được quản lý cho đến khi người dùng dừng (Ctrl+C)"""
+    refresher = LinkRefresher(store_path, lambda url: manager.process_url(url)[0])
+    for url in urls or []:
+        refresher.add(url)
+    
+    refresher.start()
+    print(f"🔄 Đang giữ {len(refresher.links)} link luôn còn hạn trong: {store_path}")
+    print("Nhấn Ctrl+C để dừng.")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print("\nĐang dừng bộ làm mới link...")
+    finally:
+        refresher.stop()
+    return refresher
+
+def _replay_key(script, args):
+    """Khóa của một lần gọi execute_script trong bản ghi (theo nội dung script và tham số)"""
+    # Phần tử trong tham số được thay bằng chỗ giữ chỗ vì id phần tử thay đổi giữa các lần chạy
+    args = ['<element>' if hasattr(arg, 'get_attribute') else arg for arg in args]
+    payload = script + json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+class RecordingDriver:
+    """Bọc driver thật và ghi lại kết quả execute_script, find_elements, page_source để phát lại offline"""
+    
+    def __init__(self, driver):
+        self._driver = driver
+        self.recording = {'scripts': {}, 'elements': {}, 'page_source': [], 'current_url': [], 'http': {}}
+    
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+    
+    def _append(self, table, key, value):
+        self.recording[table].setdefault(key, []).append(value)
+    
+    def execute_script(self, script, *args):
+        result = self._driver.execute_script(script, *args)
+        try:
+            json.dumps(result)
+            recorded = result
+        except TypeError:
+            # Kết quả không ghi được (ví dụ phần tử DOM), khi phát lại sẽ trả về None
+            recorded = None
+        self._append('scripts', _replay_key(script, args), recorded)
+        return result
+    
+    def find_elements(self, by, value):
+        elements = self._driver.find_elements(by, value)
+        data = []
+        for element in elements:
+            try:
+                data.append({'text': element.text, 'displayed': element.is_displayed(),
+                             'attributes': {'href': element.get_attribute('href')}})
+            except Exception:
+                data.append({'text': '', 'displayed': False, 'attributes': {}})
+        self._append('elements', f"{by}:{value}", data)
+        return elements
+    
+    @property
+    def page_source(self):
+        value = self._driver.page_source
+        self.recording['page_source'].append(value)
+        return value
+    
+    @property
+    def current_url(self):
+        value = self._driver.current_url
+        self.recording['current_url'].append(value)
+        return value
+
+class ReplayElement:
+    """Phần tử giả lập từ bản ghi (text, trạng thái hiển thị, thuộc tính)"""
+    
+    def __init__(self, data):
+        self.data = data
+        self.text = data.get('text', '')
+    
+    def is_displayed(self):
+        return self.data.get('displayed', True)
+    
+    def get_attribute(self, name):
+        return self.data.get('attributes', {}).get(name)
+    
+    def click(self):
+        pass
+
+class ReplayDriver:
+    """Driver giả lập, phát lại bản ghi của RecordingDriver hoặc một file page_source_{id}.html, không cần Chrome
+    
+    Mỗi lần gọi trả về giá trị đã ghi tiếp theo cho cùng script/selector; hết bản ghi thì lặp lại giá trị cuối.
+    Với bản ghi chỉ có HTML, trạng thái trang và dữ liệu phân loại lỗi được suy ra từ HTML.
+    """
+    
+    def __init__(self, recording):
+        self.recording = recording
+        self.cursors = {}
+        self.current_window_handle = 'replay'
+        self.calls = 0
+    
+    @classmethod
+    def from_file(cls, path):
+        """Tạo driver từ file bản ghi .json hoặc file page_source_{id}.html"""
+        return cls(load_replay_recording(path))
+    
+    def _next(self, name, values, default=None):
+        if not values:
+            return default
+        position = self.cursors.get(name, 0)
+        self.cursors[name] = position + 1
+        return values[min(position, len(values) - 1)]
+    
+    def _html(self):
+        sources = self.recording.get('page_source') or ['']
+        return sources[-1]
+    
+    def _fallback_script(self, script):
+        """Giá trị suy ra từ HTML cho các script không có trong bản ghi"""
+        html = self._html()
+        if 'innerText' in script and 'readyState' in script:
+            # Script lấy trạng thái trang để phân loại lỗi (read_failure_page_state), bỏ phần menu/banner/footer
+            title = re.search(r'<title[^>]*>(.*?)</title>', html, re.I | re.S)
+            text = re.sub(r'<(script|style|header|nav|footer)[^>]*>.*?</\1>|<[^>]+>', ' ', html, flags=re.I | re.S)
+            return {'url': self.recording.get('url', ''), 'title': title.group(1).strip() if title else '',
+                    'text': ' '.join(text.split())[:5000],
+                    'captcha': self._fallback_script('XPathResult') == 'captcha', 'ready': 'complete'}
+        if 'XPathResult' in script:
+            # Script kiểm tra trạng thái trang download (check_download_page_ready)
+            if re.search(r"<iframe[^>]+(?:src|title)=[\"'][^\"']*captcha", html, re.I):
+                return 'captcha'
+            if '__hash__=' in html:
+                return 'hash'
+            if re.search(r'click\s+here', html, re.I):
+                return 'button'
+            return 'loaded'
+        return None
+    
+    def execute_script(self, script, *args):
+        self.calls += 1
+        values = self.recording.get('scripts', {}).get(_replay_key(script, args))
+        if values is None:
+            return self._fallback_script(script)
+        return self._next(f"script:{_replay_key(script, args)}", values)
+    
+    def find_elements(self, by, value):
+        self.calls += 1
+        key = f"{by}:{value}"
+        data = self._next(f"elements:{key}", self.recording.get('elements', {}).get(key), [])
+        return [ReplayElement(item) for item in data]
+    
+    def find_element(self, by, value):
+        elements = self.find_elements(by, value)
+        if not elements:
+            raise WebDriverException(f"Không có phần tử {by}={value} trong bản ghi")
+        return elements[0]
+    
+    @property
+    def page_source(self):
+        return self._next('page_source', self.recording.get('page_source'), '')
+    
+    @property
+    def current_url(self):
+        return self._next('current_url', self.recording.get('current_url'), self.recording.get('url', ''))
+    
+    def get(self, url):
+        self.recording.setdefault('url', url)
+    
+    def execute_cdp_cmd(self, cmd, params):
+        return {}
+    
+    def set_page_load_timeout(self, seconds):
+        pass
+    
+    def save_screenshot(self, path):
+        return True
+    
+    def quit(self):
+        pass
+
+class RecordingSession(requests.Session):
+    """Session HTTP ghi lại các response (trừ tải file dạng stream) để phát lại offline"""
+    
+    def __init__(self, base, http):
+        super().__init__()
+        self.cookies.update(base.cookies)
+        self.headers.update(base.headers)
+        self.http = http
+    
+    def request(self, method, url, **kwargs):
+        response = super().request(method, url, **kwargs)
+        if not kwargs.get('stream'):
+            self.http[f"{method.upper()} {url}"] = {
+                'status_code': response.status_code,
+                'headers': dict(response.headers),
+                'body': response.text if method.upper() != 'HEAD' else '',
+            }
+        return response
+
+class ReplaySession:
+    """Session HTTP giả lập trả về các response đã ghi; request không có trong bản ghi bị coi là lỗi kết nối"""
+    
+    def __init__(self, http):
+        self.http = http
+    
+    def request(self, method, url, **kwargs):
+        data = self.http.get(f"{method.upper()} {url}")
+        if data is None:
+            raise requests.ConnectionError(f"Không có response cho {method.upper()} {url} trong bản ghi")
+        response = requests.Response()
+        response.status_code = data['status_code']
+        response.headers = requests.structures.CaseInsensitiveDict(data.get('headers', {}))
+        response._content = data.get('body', '').encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = url
+        return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+class ReplayClock:
+    """Đồng hồ ảo khi phát lại: sleep() chỉ tăng thời gian ảo nên các vòng đợi kết thúc ngay"""
+    
+    def __init__(self, real):
+        self.real = real
+        self.offset = 0.0
+    
+    def time(self):
+        return self.real.time() + self.offset
+    
+    def sleep(self, seconds):
+        self.offset += max(0, seconds)
+    
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+def create_replay_resolver(recording, driver):
+    """Resolver dùng session HTTP, cache lỗi và đồng hồ giả lập để phát lại, không lưu file debug"""
+    return PikbestResolver(cookies={}, captcha_api_key='', profile_path='', driver=driver,
+                           session=ReplaySession(recording.get('http', {})), failure_cache=FailureCache(None),
+                           clock=ReplayClock(time), debug_dumps=False)
+
+def load_replay_recording(path):
+    """Đọc bản ghi phát lại từ file .json (RecordingDriver) hoặc file page_source_{id}.html"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if not path.endswith('.html'):
+            return json.load(f)
+        html = f.read()
+    id_match = re.search(r'(\d+)', os.path.basename(path))
+    return {'file_id': id_match.group(1) if id_match else None, 'page_source': [html]}
+
+def record_download_page(file_id, driver, output_dir):
+    """Lấy link bằng trình duyệt thật và ghi lại toàn bộ tương tác vào output_dir/replay_{id}.json"""
+    recorder = RecordingDriver(driver)
+    base = current_resolver()
+    resolver = PikbestResolver(cookies=get_pikbest_cookies(), captcha_api_key=get_captcha_api_key(),
+                               headers=get_http_headers(), driver=recorder,
+                               session=RecordingSession(get_http_session(), recorder.recording['http']),
+                               url_deadline=base.url_deadline if base is not None else None)
+    with resolver.activate():
+        link = get_real_download_link_with_driver(file_id, recorder)
+    
+    recorder.recording.update({
+        'file_id': file_id,
+        'url': f"https://pikbest.com/?m=download&id={file_id}&flag=1",
+        'result': link,
+        'recorded_at': int(time.time()),
+    })
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"replay_{file_id}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(recorder.recording, f, ensure_ascii=False)
+    logger.info(f"Đã ghi bản ghi phát lại: {path}")
+    print(f"💾 Đã ghi bản ghi phát lại: {path}")
+    return link
+
+def run_replay_benchmark(paths, repeat=5):
+    """Chạy lại logic lấy link trên các bản ghi (không cần Chrome), đo thời gian và so với kết quả đã ghi"""
+    summary = []
+    print(f"🧪 Đang phát lại {len(paths)} bản ghi, mỗi bản ghi {repeat} lần...")
+    for path in paths:
+        try:
+            recording = load_replay_recording(path)
+        except Exception as e:
+            logger.error(f"Không thể đọc bản ghi {path}: {e}")
+            print(f"❌ Không thể đọc bản ghi {path}: {e}")
+            continue
+        file_id = recording.get('file_id')
+        timings = []
+        link = None
+        calls = 0
+        for _ in range(max(1, repeat)):
+            driver = ReplayDriver(recording)
+            resolver = create_replay_resolver(recording, driver)
+            with resolver.activate(), contextlib.redirect_stdout(io.StringIO()):
+                start_time = time.perf_counter()
+                link = get_real_download_link_with_driver(file_id, driver)
+                timings.append(time.perf_counter() - start_time)
+            calls = driver.calls
+        
+        # Bản ghi từ RecordingDriver có kết quả gốc để kiểm tra hồi quy
+        if 'result' in recording:
+            status = "✅" if link == recording['result'] else "❌"
+        else:
+            status = "•"
+        best = min(timings) * 1000
+        average = sum(timings) / len(timings) * 1000
+        print(f"{status} {file_id}: {best:.2f} ms (trung bình {average:.2f} ms, {calls} lệnh driver) -> {link}")
+        summary.append({'path': path, 'file_id': file_id, 'link': link, 'status': status,
+                        'best_ms': best, 'average_ms': average, 'driver_calls': calls})
+    
+    mismatches = sum(1 for item in summary if item['status'] == "❌")
+    print(f"\n📊 {len(summary)} bản ghi, {mismatches} kết quả khác với bản ghi gốc")
+    return summary
+
 if __name__ == "__main__":
     main()